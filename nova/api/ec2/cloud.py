@@ -23,6 +23,8 @@ datastore.
 """
 
 import base64
+import collections
+import datetime
 import netaddr
 import os
 import re
@@ -54,6 +56,9 @@ from nova.image import s3
 FLAGS = flags.FLAGS
 flags.DECLARE('dhcp_domain', 'nova.network.manager')
 flags.DECLARE('service_down_time', 'nova.scheduler.driver')
+flags.DEFINE_integer('metadata_cache_expiration', 15,
+                     'Seconds the metadata served to an instance is '
+                     'reused for, 0 to render it on every request')
 
 LOG = logging.getLogger("nova.api.cloud")
 
@@ -209,6 +214,9 @@ class CloudController(object):
         self.compute_api = compute.API(
                 network_api=self.network_api,
                 volume_api=self.volume_api)
+        # Maps fixed address to (expires, data)
+        self.metadata_cache = {}
+        self.metadata_expiry = collections.deque()
         self.setup()
 
     def __str__(self):
@@ -290,6 +298,13 @@ class CloudController(object):
             return services[0]['availability_zone']
         return 'unknown zone'
 
+    def _get_availability_zones_by_host(self, context):
+        """Map every host with a service to its availability zone."""
+        zones = {}
+        for service in db.service_get_all(context.elevated()):
+            zones.setdefault(service['host'], service['availability_zone'])
+        return zones
+
     def _get_image_state(self, image):
         # NOTE(vish): fallback status if image_state isn't set
         state = image.get('status')
@@ -344,6 +359,11 @@ class CloudController(object):
         return mappings
 
     def get_metadata(self, address):
+        # Reuse what was served to this address lately
+        cached = self.metadata_cache.get(address)
+        if cached and cached[0] > utils.utcnow():
+            return cached[1]
+
         ctxt = context.get_admin_context()
         search_opts = {'fixed_ip': address, 'deleted': False}
         try:
@@ -354,9 +374,31 @@ class CloudController(object):
         if not instance_ref:
             return None
 
+        try:
+            data = self._format_metadata(ctxt, address, instance_ref[0]['id'])
+        except exception.InstanceNotFound:
+            return None
+        if FLAGS.metadata_cache_expiration > 0:
+            self._cache_metadata(address, data)
+        return data
+
+    def _cache_metadata(self, address, data):
+        """Remember data for address, dropping entries that expired."""
+        now = utils.utcnow()
+        while self.metadata_expiry and self.metadata_expiry[0][0] <= now:
+            expires, old_address = self.metadata_expiry.popleft()
+            cached = self.metadata_cache.get(old_address)
+            if cached and cached[0] == expires:
+                del self.metadata_cache[old_address]
+        expires = now + datetime.timedelta(
+                seconds=FLAGS.metadata_cache_expiration)
+        self.metadata_cache[address] = (expires, data)
+        self.metadata_expiry.append((expires, address))
+
+    def _format_metadata(self, ctxt, address, instance_id):
         # This ensures that all attributes of the instance
         # are populated.
-        instance_ref = db.instance_get(ctxt, instance_ref[0]['id'])
+        instance_ref = db.instance_get(ctxt, instance_id)
 
         mpi = self._get_mpi_data(ctxt, instance_ref['project_id'])
         hostname = "%s.%s" % (instance_ref['hostname'], FLAGS.dhcp_domain)
@@ -1091,18 +1133,20 @@ class CloudController(object):
                 'status': volume['attach_status'],
                 'volumeId': ec2utils.id_to_ec2_vol_id(volume_id)}
 
-    def _format_kernel_id(self, context, instance_ref, result, key):
+    def _format_kernel_id(self, context, instance_ref, result, key,
+                          image_ids=None):
         kernel_uuid = instance_ref['kernel_id']
         if kernel_uuid is None or kernel_uuid == '':
             return
-        kernel_id = self._get_image_id(context, kernel_uuid)
+        kernel_id = self._get_image_id(context, kernel_uuid, image_ids)
         result[key] = self.image_ec2_id(kernel_id, 'aki')
 
-    def _format_ramdisk_id(self, context, instance_ref, result, key):
+    def _format_ramdisk_id(self, context, instance_ref, result, key,
+                           image_ids=None):
         ramdisk_uuid = instance_ref['ramdisk_id']
         if ramdisk_uuid is None or ramdisk_uuid == '':
             return
-        ramdisk_id = self._get_image_id(context, ramdisk_uuid)
+        ramdisk_id = self._get_image_id(context, ramdisk_uuid, image_ids)
         result[key] = self.image_ec2_id(ramdisk_id, 'ari')
 
     @staticmethod
@@ -1203,12 +1247,19 @@ class CloudController(object):
         return i[0]
 
     def _format_instance_bdm(self, context, instance_id, root_device_name,
-                             result):
-        """Format InstanceBlockDeviceMappingResponseItemType"""
+                             result, bdms=None):
+        """Format InstanceBlockDeviceMappingResponseItemType
+
+        bdms are the instance's mappings with their volumes loaded, if
+        they have been fetched already.
+        """
         root_device_type = 'instance-store'
         mapping = []
-        for bdm in db.block_device_mapping_get_all_by_instance(context,
-                                                               instance_id):
+        prefetched = bdms is not None
+        if not prefetched:
+            bdms = db.block_device_mapping_get_all_by_instance(context,
+                                                               instance_id)
+        for bdm in bdms:
             volume_id = bdm['volume_id']
             if (volume_id is None or bdm['no_device']):
                 continue
@@ -1218,7 +1269,11 @@ class CloudController(object):
                 assert not bdm['virtual_name']
                 root_device_type = 'ebs'
 
-            vol = self.volume_api.get(context, volume_id=volume_id)
+            vol = None
+            if prefetched:
+                vol = bdm['volume']
+            if not vol or vol['deleted']:
+                vol = self.volume_api.get(context, volume_id=volume_id)
             LOG.debug(_("vol = %s\n"), vol)
             # TODO(yamahata): volume attach time
             ebs = {'volumeId': volume_id,
@@ -1279,19 +1334,42 @@ class CloudController(object):
                                                      search_opts=search_opts)
             except exception.NotFound:
                 instances = []
+        if not context.is_admin:
+            instances = [instance for instance in instances
+                         if instance['image_ref'] != str(FLAGS.vpn_image_id)]
+
+        # Look up what the instances refer to for all of them at once,
+        # rather than a few queries per instance.
+        image_ids = {}
+        bdms = {}
+        zones = {}
+        if instances:
+            image_uuids = set()
+            for instance in instances:
+                for key in ('image_ref', 'kernel_id', 'ramdisk_id'):
+                    if instance[key]:
+                        image_uuids.add(instance[key])
+            image_ids = self.image_service.get_image_ids(context,
+                                                         image_uuids)
+            for instance in instances:
+                bdms[instance['id']] = []
+            for bdm in db.block_device_mapping_get_all_by_instances(context,
+                    bdms.keys()):
+                bdms[bdm['instance_id']].append(bdm)
+            zones = self._get_availability_zones_by_host(context)
+
         for instance in instances:
-            if not context.is_admin:
-                if instance['image_ref'] == str(FLAGS.vpn_image_id):
-                    continue
             i = {}
             instance_id = instance['id']
             ec2_id = ec2utils.id_to_ec2_id(instance_id)
             i['instanceId'] = ec2_id
             image_uuid = instance['image_ref']
-            image_id = self._get_image_id(context, image_uuid)
+            image_id = self._get_image_id(context, image_uuid, image_ids)
             i['imageId'] = self.image_ec2_id(image_id)
-            self._format_kernel_id(context, instance, i, 'kernelId')
-            self._format_ramdisk_id(context, instance, i, 'ramdiskId')
+            self._format_kernel_id(context, instance, i, 'kernelId',
+                                   image_ids)
+            self._format_ramdisk_id(context, instance, i, 'ramdiskId',
+                                    image_ids)
             i['instanceState'] = {
                 'code': instance['power_state'],
                 'name': state_description_from_vm_state(instance['vm_state'])}
@@ -1325,9 +1403,9 @@ class CloudController(object):
             i['displayDescription'] = instance['display_description']
             self._format_instance_root_device_name(instance, i)
             self._format_instance_bdm(context, instance_id,
-                                      i['rootDeviceName'], i)
-            host = instance['host']
-            zone = self._get_availability_zone_by_host(context, host)
+                                      i['rootDeviceName'], i,
+                                      bdms[instance_id])
+            zone = zones.get(instance['host'], 'unknown zone')
             i['placement'] = {'availabilityZone': zone}
             if instance['reservation_id'] not in reservations:
                 r = {}
@@ -1548,7 +1626,9 @@ class CloudController(object):
         return self.image_service.get_image_uuid(context, internal_id)
 
     # NOTE(bcwaldon): We also need to be able to map image uuids to integers
-    def _get_image_id(self, context, image_uuid):
+    def _get_image_id(self, context, image_uuid, image_ids=None):
+        if image_ids and image_uuid in image_ids:
+            return image_ids[image_uuid]
         return self.image_service.get_image_id(context, image_uuid)
 
     def _format_image(self, image):
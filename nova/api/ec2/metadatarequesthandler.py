@@ -21,6 +21,7 @@
 import webob.dec
 import webob.exc
 
+from nova import exception
 from nova import log as logging
 from nova import flags
 from nova import utils
@@ -76,6 +77,8 @@ class MetadataRequestHandler(wsgi.Application):
         if FLAGS.use_forwarded_for:
             remote_address = req.headers.get('X-Forwarded-For', remote_address)
         try:
+            if remote_address is None:
+                raise exception.Error(_('No address to look up'))
             meta_data = self.cc.get_metadata(remote_address)
         except Exception:
             LOG.exception(_('Failed to get metadata for ip: %s'),
@@ -99,6 +99,10 @@ class Controller(object):
         search_opts = {}
         search_opts.update(req.str_GET)
 
+        # Paging is done by compute, it is not a filter for child zones.
+        search_opts.pop('marker', None)
+        search_opts.pop('limit', None)
+
         context = req.environ['nova.context']
         remove_invalid_options(context, search_opts,
                 self._get_server_search_options())
@@ -136,11 +140,26 @@ class Controller(object):
                 # No 'changes-since', so we only want non-deleted servers
                 search_opts['deleted'] = False
 
-        instance_list = self.compute_api.get_all(context,
-                                                 search_opts=search_opts)
+        params = common.get_pagination_params(req)
+        limit = min(FLAGS.osapi_max_limit,
+                    params.get('limit', FLAGS.osapi_max_limit))
+        marker = params.get('marker') or None
+
+        # The simple view only needs the instance columns themselves.
+        if is_detail:
+            columns_to_join = ['fixed_ips', 'metadata', 'instance_type']
+        else:
+            columns_to_join = []
+
+        try:
+            instance_list = self.compute_api.get_all(context,
+                    search_opts=search_opts, marker=marker, limit=limit,
+                    columns_to_join=columns_to_join)
+        except exception.MarkerNotFound:
+            msg = _('marker [%s] not found') % marker
+            raise exc.HTTPBadRequest(explanation=msg)
 
-        limited_list = self._limit_items(instance_list, req)
-        return self._build_list(req, limited_list, is_detail=is_detail)
+        return self._build_list(req, instance_list, is_detail=is_detail)
 
     def _get_server(self, context, instance_uuid):
         """Utility function for looking up an instance by uuid"""
@@ -110,6 +110,22 @@ def _is_queued_delete(instance, instance_id):
     return True
 
 
+def _limit_by_marker(instances, marker=None, limit=None):
+    """Return at most limit instances following the one with uuid or
+    id marker."""
+    start = 0
+    if marker is not None:
+        for i, instance in enumerate(instances):
+            if marker in (instance.get('uuid'), str(instance.get('id'))):
+                start = i + 1
+                break
+        else:
+            raise exception.MarkerNotFound(marker=marker)
+    if limit is None:
+        return instances[start:]
+    return instances[start:start + limit]
+
+
 class API(base.Base):
     """API for interacting with the compute manager."""
 
@@ -641,42 +657,41 @@ class API(base.Base):
         Sends an update request to each compute node for whom this is
         relevant.
         """
-        # First, we get the security group rules that reference these groups as
-        # the grantee..
-        security_group_rules = set()
+        # NOTE: compute caches member addresses per group, so every
+        #       changed group has to be refreshed, not just the last
+        security_groups = {}
         for group_id in group_ids:
-            security_group_rules.update(
+            # First, we get the security group rules that reference this
+            # group as the grantee..
+            security_group_rules = \
                 self.db.security_group_rule_get_by_security_group_grantee(
                                                                      context,
-                                                                     group_id))
-
-        # ..then we distill the security groups to which they belong..
-        security_groups = set()
-        for rule in security_group_rules:
-            security_group = self.db.security_group_get(
-                                                    context,
-                                                    rule['parent_group_id'])
-            security_groups.add(security_group)
-
-        # ..then we find the instances that are members of these groups..
-        instances = set()
-        for security_group in security_groups:
-            for instance in security_group['instances']:
-                instances.add(instance)
-
-        # ...then we find the hosts where they live...
-        hosts = set()
-        for instance in instances:
-            if instance['host']:
-                hosts.add(instance['host'])
-
-        # ...and finally we tell these nodes to refresh their view of this
-        # particular security group.
-        for host in hosts:
-            rpc.cast(context,
-                     self.db.queue_get_for(context, FLAGS.compute_topic, host),
-                     {"method": "refresh_security_group_members",
-                      "args": {"security_group_id": group_id}})
+                                                                     group_id)
+
+            # ..then we distill the security groups to which they belong..
+            parent_ids = set(rule['parent_group_id']
+                             for rule in security_group_rules)
+            for parent_id in parent_ids:
+                if parent_id not in security_groups:
+                    security_groups[parent_id] = self.db.security_group_get(
+                                                                    context,
+                                                                    parent_id)
+
+            # ..then we find the hosts where their instances live...
+            hosts = set()
+            for parent_id in parent_ids:
+                for instance in security_groups[parent_id]['instances']:
+                    if instance['host']:
+                        hosts.add(instance['host'])
+
+            # ...and finally we tell these nodes to refresh their view of
+            # this particular security group.
+            for host in hosts:
+                rpc.cast(context,
+                         self.db.queue_get_for(context, FLAGS.compute_topic,
+                                               host),
+                         {"method": "refresh_security_group_members",
+                          "args": {"security_group_id": group_id}})
 
     def trigger_provider_fw_rules_refresh(self, context):
         """Called when a rule is added to or removed from a security_group"""
@@ -956,7 +971,8 @@ class API(base.Base):
         """
         return self.get(context, instance_id)
 
-    def get_all(self, context, search_opts=None):
+    def get_all(self, context, search_opts=None, marker=None, limit=None,
+                columns_to_join=None):
         """Get all instances filtered by one of the given parameters.
 
         If there is no filter and the context is an admin, it will retreive
@@ -964,6 +980,12 @@ class API(base.Base):
 
         Deleted instances will be returned by default, unless there is a
         search option that says otherwise.
+
+        Only instances after the one with uuid or id marker are returned,
+        no more than limit of them. The page is cut in the database
+        unless child zones answer with instances of their own.
+        columns_to_join lists the relations to load with the instances,
+        see db.instance_get_all_by_filters.
         """
 
         if search_opts is None:
@@ -1013,7 +1035,34 @@ class API(base.Base):
 
         local_zone_only = search_opts.get('local_zone_only', False)
 
-        inst_models = self._get_instances_by_filters(context, filters)
+        child_instances = []
+        if not local_zone_only:
+            # Recurse zones. Send along the un-modified search options we
+            # received.
+            children = scheduler_api.call_zone_method(context,
+                    "list",
+                    errors_to_ignore=[novaclient.exceptions.NotFound],
+                    novaclient_collection_name="servers",
+                    search_opts=search_opts)
+
+            for zone, servers in children:
+                # 'servers' can be None if a 404 was returned by a zone
+                if servers is None:
+                    continue
+                for server in servers:
+                    # Results are ready to send to user. No need to scrub.
+                    server._info['_is_precooked'] = True
+                    child_instances.append(server._info)
+
+        if child_instances:
+            # The marker may be one of the child zone instances, so the
+            # page has to be cut from the combined list.
+            inst_models = self._get_instances_by_filters(context, filters,
+                    columns_to_join=columns_to_join)
+        else:
+            inst_models = self._get_instances_by_filters(context, filters,
+                    marker=marker, limit=limit,
+                    columns_to_join=columns_to_join)
 
         # Convert the models to dictionaries
         instances = []
@@ -1023,28 +1072,14 @@ class API(base.Base):
             instance['name'] = inst_model['name']
             instances.append(instance)
 
-        if local_zone_only:
-            return instances
-
-        # Recurse zones. Send along the un-modified search options we received.
-        children = scheduler_api.call_zone_method(context,
-                "list",
-                errors_to_ignore=[novaclient.exceptions.NotFound],
-                novaclient_collection_name="servers",
-                search_opts=search_opts)
-
-        for zone, servers in children:
-            # 'servers' can be None if a 404 was returned by a zone
-            if servers is None:
-                continue
-            for server in servers:
-                # Results are ready to send to user. No need to scrub.
-                server._info['_is_precooked'] = True
-                instances.append(server._info)
+        if child_instances:
+            instances = _limit_by_marker(instances + child_instances,
+                                         marker, limit)
 
         return instances
 
-    def _get_instances_by_filters(self, context, filters):
+    def _get_instances_by_filters(self, context, filters, marker=None,
+                                  limit=None, columns_to_join=None):
         ids = None
         if 'ip6' in filters or 'ip' in filters:
             res = self.network_api.get_instance_uuids_by_ip_filter(context,
@@ -1054,7 +1089,8 @@ class API(base.Base):
             uuids = set([r['instance_uuid'] for r in res])
             filters['uuid'] = uuids
 
-        return self.db.instance_get_all_by_filters(context, filters)
+        return self.db.instance_get_all_by_filters(context, filters,
+                marker=marker, limit=limit, columns_to_join=columns_to_join)
 
     def _cast_compute_message(self, method, context, instance_id, host=None,
                               params=None):
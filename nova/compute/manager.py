@@ -59,6 +59,7 @@ from nova import manager
 from nova import network
 from nova.notifier import api as notifier
 from nova import rpc
+from nova.scheduler import api as scheduler_api
 from nova import utils
 from nova.virt import driver
 from nova import volume
@@ -87,6 +88,12 @@ flags.DEFINE_integer("resize_confirm_window", 0,
                      " Set to 0 to disable.")
 flags.DEFINE_integer('host_state_interval', 120,
                      'Interval in seconds for querying the host status')
+flags.DEFINE_integer('image_cache_manager_interval', 600,
+                     'Interval in seconds between image cache prefetches '
+                     'and evictions. Set to 0 to disable.')
+flags.DEFINE_integer('image_cache_prefetch_count', 0,
+                     'Number of the images used by the most instances to '
+                     'prefetch into the image cache of each host')
 
 LOG = logging.getLogger('nova.compute.manager')
 
@@ -154,6 +161,7 @@ class ComputeManager(manager.SchedulerDependentManager):
         self.network_manager = utils.import_object(FLAGS.network_manager)
         self._last_host_check = 0
         self._last_bw_usage_poll = 0
+        self._last_image_cache_run = 0
         super(ComputeManager, self).__init__(service_name="compute",
                                              *args, **kwargs)
 
@@ -433,6 +441,7 @@ class ComputeManager(manager.SchedulerDependentManager):
         updates['vm_state'] = vm_states.BUILDING
         updates['task_state'] = task_states.NETWORKING
         instance = self.db.instance_update(context, instance_id, updates)
+        scheduler_api.update_instance_info(context, self.host, instance)
         instance['injected_files'] = kwargs.get('injected_files', [])
         instance['admin_pass'] = kwargs.get('admin_password', None)
 
@@ -564,6 +573,7 @@ class ComputeManager(manager.SchedulerDependentManager):
                               terminated_at=utils.utcnow())
 
         self.db.instance_destroy(context, instance_id)
+        scheduler_api.delete_instance_info(context, self.host, instance)
 
         usage_info = utils.usage_from_instance(instance)
         notifier.notify('compute.%s' % self.host,
@@ -1021,6 +1031,12 @@ class ComputeManager(manager.SchedulerDependentManager):
         self.driver.finish_revert_migration(instance_ref)
         self.db.migration_update(context, migration_id,
                 {'status': 'reverted'})
+        scheduler_api.delete_instance_info(context, instance_ref['host'],
+                                           instance_ref)
+        scheduler_api.update_instance_info(context, self.host,
+                dict(id=instance_ref['id'],
+                     local_gb=instance_type['local_gb'],
+                     memory_mb=instance_type['memory_mb']))
         usage_info = utils.usage_from_instance(instance_ref)
         notifier.notify('compute.%s' % self.host,
                             'compute.instance.resize.revert',
@@ -1132,6 +1148,8 @@ class ComputeManager(manager.SchedulerDependentManager):
         resize_instance = False
         instance_ref = self.db.instance_get_by_uuid(context,
                 migration_ref.instance_uuid)
+        scheduler_api.delete_instance_info(context,
+                migration_ref['source_compute'], instance_ref)
         old_instance_type_id = migration_ref['old_instance_type_id']
         new_instance_type_id = migration_ref['new_instance_type_id']
         if old_instance_type_id != new_instance_type_id:
@@ -1161,6 +1179,8 @@ class ComputeManager(manager.SchedulerDependentManager):
                               vm_state=vm_states.ACTIVE,
                               host=migration_ref['dest_compute'],
                               task_state=task_states.RESIZE_VERIFY)
+        scheduler_api.update_instance_info(context,
+                migration_ref['dest_compute'], instance_ref)
 
         self.db.migration_update(context, migration_id,
                 {'status': 'finished', })
@@ -1873,8 +1893,31 @@ class ComputeManager(manager.SchedulerDependentManager):
                         unicode(ex))
             error_list.append(ex)
 
+        try:
+            self._manage_image_cache(context)
+        except NotImplementedError:
+            pass
+        except Exception as ex:
+            LOG.warning(_("Error managing the image cache: %s"),
+                        unicode(ex))
+            error_list.append(ex)
+
         return error_list
 
+    def _manage_image_cache(self, context):
+        """Prefetch popular images and evict unused ones on this host."""
+        if not FLAGS.image_cache_manager_interval:
+            return
+        curr_time = time.time()
+        if (curr_time - self._last_image_cache_run >
+            FLAGS.image_cache_manager_interval):
+            self._last_image_cache_run = curr_time
+            images = []
+            if FLAGS.image_cache_prefetch_count > 0:
+                images = self.db.instance_get_most_used_images(context,
+                                        FLAGS.image_cache_prefetch_count)
+            self.driver.manage_image_cache(context, images)
+
     def _update_bandwidth_usage(self, context, start_time, stop_time=None):
         curr_time = time.time()
         if curr_time - self._last_bw_usage_poll > FLAGS.bandwith_poll_interval:
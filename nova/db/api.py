@@ -172,6 +172,18 @@ def compute_node_get_all(context, session=None):
     return IMPL.compute_node_get_all(context)
 
 
+def compute_node_get_all_with_usage(context, host=None):
+    """Get the free ram, disk and vcpus of all computeNodes.
+
+    Returns a list of dicts with the keys id, host, free_ram_mb,
+    free_disk_gb and free_vcpus. Usage is summed up in the database over
+    the non-deleted instances of each host. Pass host to restrict the
+    result to a single host.
+
+    """
+    return IMPL.compute_node_get_all_with_usage(context, host=host)
+
+
 def compute_node_create(context, values):
     """Create a computeNode from the values dictionary."""
     return IMPL.compute_node_create(context, values)
@@ -304,6 +316,12 @@ def floating_ip_get_by_fixed_address(context, fixed_address):
     return IMPL.floating_ip_get_by_fixed_address(context, fixed_address)
 
 
+def floating_ip_get_by_address_ranges(context, ranges):
+    """Get the floating ips associated with a fixed ip whose IPv4 address
+    is in one of the (first, last) packed address ranges."""
+    return IMPL.floating_ip_get_by_address_ranges(context, ranges)
+
+
 def floating_ip_update(context, address, values):
     """Update a floating ip by address or raise if it doesn't exist."""
     return IMPL.floating_ip_update(context, address, values)
@@ -372,7 +390,7 @@ def fixed_ip_create(context, values):
 
 
 def fixed_ip_bulk_create(context, ips):
-    """Create a lot of fixed ips from the values dictionary."""
+    """Create a lot of fixed ips from a list of values dictionaries."""
     return IMPL.fixed_ip_bulk_create(context, ips)
 
 
@@ -406,6 +424,18 @@ def fixed_ip_get_by_address(context, address):
     return IMPL.fixed_ip_get_by_address(context, address)
 
 
+def fixed_ip_get_by_address_ranges(context, ranges):
+    """Get the allocated fixed ips whose IPv4 address is in one of the
+    (first, last) packed address ranges."""
+    return IMPL.fixed_ip_get_by_address_ranges(context, ranges)
+
+
+def fixed_ip_get_all_addresses(context):
+    """Iterate over (instance_id, address, floating address or None) of
+    the allocated fixed ips, one row per associated floating ip."""
+    return IMPL.fixed_ip_get_all_addresses(context)
+
+
 def fixed_ip_get_by_instance(context, instance_id):
     """Get fixed ips by instance or raise if none exist."""
     return IMPL.fixed_ip_get_by_instance(context, instance_id)
@@ -468,6 +498,11 @@ def virtual_interface_get_by_instance(context, instance_id):
     return IMPL.virtual_interface_get_by_instance(context, instance_id)
 
 
+def virtual_interface_get_by_instances(context, instance_ids):
+    """Gets all virtual_interfaces for the instances in instance_ids."""
+    return IMPL.virtual_interface_get_by_instances(context, instance_ids)
+
+
 def virtual_interface_get_by_instance_and_network(context, instance_id,
                                                            network_id):
     """Gets all virtual interfaces for instance."""
@@ -496,6 +531,12 @@ def virtual_interface_get_all(context):
     return IMPL.virtual_interface_get_all(context)
 
 
+def virtual_interface_get_ipv6_addresses(context, vif_address=None):
+    """Iterate over (instance_id, fixed ipv6 address) of the virtual
+    interfaces, or of the one with mac address vif_address."""
+    return IMPL.virtual_interface_get_ipv6_addresses(context, vif_address)
+
+
 ####################
 
 
@@ -534,9 +575,17 @@ def instance_get_all(context):
     return IMPL.instance_get_all(context)
 
 
-def instance_get_all_by_filters(context, filters):
-    """Get all instances that match all filters."""
-    return IMPL.instance_get_all_by_filters(context, filters)
+def instance_get_all_by_filters(context, filters, marker=None, limit=None,
+                                columns_to_join=None):
+    """Get all instances that match all filters, newest first.
+
+    Only instances after the instance with uuid or id marker are
+    returned, no more than limit of them. columns_to_join lists the
+    relations to load with the instances, all of them by default.
+    """
+    return IMPL.instance_get_all_by_filters(context, filters, marker=marker,
+                                            limit=limit,
+                                            columns_to_join=columns_to_join)
 
 
 def instance_get_active_by_window(context, begin, end=None, project_id=None):
@@ -604,6 +653,12 @@ def instance_get_project_vpn(context, project_id):
     return IMPL.instance_get_project_vpn(context, project_id)
 
 
+def instance_get_most_used_images(context, limit):
+    """Get the image_ref, kernel_id and ramdisk_id used by the most
+    instances, most used first."""
+    return IMPL.instance_get_most_used_images(context, limit)
+
+
 def instance_get_all_hung_in_rebooting(context, reboot_window, session=None):
     """Get all instances stuck in a rebooting state."""
     return IMPL.instance_get_all_hung_in_rebooting(context, reboot_window,
@@ -646,6 +701,41 @@ def instance_get_id_to_uuid_mapping(context, ids):
     return IMPL.instance_get_id_to_uuid_mapping(context, ids)
 
 
+def instance_info_cache_get(context, instance_id):
+    """Get the info cache of an instance, None if it has none.
+
+    Its id is the generation to pass to instance_info_cache_update.
+
+    """
+    return IMPL.instance_info_cache_get(context, instance_id)
+
+
+def instance_info_cache_update(context, instance_id, values,
+                               generation=None):
+    """Replace the info cache of an instance.
+
+    If generation is given, the cache is only replaced if it is still the
+    one with that id, or 0 for no cache, and None is returned otherwise.
+
+    """
+    return IMPL.instance_info_cache_update(context, instance_id, values,
+                                           generation)
+
+
+def instance_info_cache_invalidate(context, instance_id):
+    """Empty the info cache of an instance.
+
+    This starts a new generation, see instance_info_cache_update.
+
+    """
+    return IMPL.instance_info_cache_invalidate(context, instance_id)
+
+
+def instance_info_cache_delete(context, instance_id):
+    """Delete the info cache of an instance that is going away."""
+    return IMPL.instance_info_cache_delete(context, instance_id)
+
+
 ###################
 
 
@@ -759,6 +849,13 @@ def network_get_associated_fixed_ips(context, network_id):
     return IMPL.network_get_associated_fixed_ips(context, network_id)
 
 
+def network_get_fixed_ips_updated_since(context, network_id, updated_since):
+    """Get all network's ips, deleted ones included, updated since
+    updated_since."""
+    return IMPL.network_get_fixed_ips_updated_since(context, network_id,
+                                                    updated_since)
+
+
 def network_get_by_bridge(context, bridge):
     """Get a network by bridge or raise if it does not exist."""
     return IMPL.network_get_by_bridge(context, bridge)
@@ -1044,6 +1141,12 @@ def block_device_mapping_get_all_by_instance(context, instance_id):
     return IMPL.block_device_mapping_get_all_by_instance(context, instance_id)
 
 
+def block_device_mapping_get_all_by_instances(context, instance_ids):
+    """Get all block device mappings of the instances, with their volumes"""
+    return IMPL.block_device_mapping_get_all_by_instances(context,
+                                                          instance_ids)
+
+
 def block_device_mapping_destroy(context, bdm_id):
     """Destroy the block device mapping."""
     return IMPL.block_device_mapping_destroy(context, bdm_id)
@@ -1084,6 +1187,11 @@ def security_group_get_by_instance(context, instance_id):
     return IMPL.security_group_get_by_instance(context, instance_id)
 
 
+def security_group_get_fixed_addresses(context, security_group_id):
+    """Get the fixed ip addresses of the instances in a security group."""
+    return IMPL.security_group_get_fixed_addresses(context, security_group_id)
+
+
 def security_group_exists(context, project_id, group_name):
     """Indicates if a group name exists in a project."""
     return IMPL.security_group_exists(context, project_id, group_name)
@@ -1622,6 +1730,11 @@ def s3_image_get_by_uuid(context, image_uuid):
     return IMPL.s3_image_get_by_uuid(context, image_uuid)
 
 
+def s3_image_get_all_by_uuids(context, image_uuids):
+    """Find the local s3 images there are for the provided uuids"""
+    return IMPL.s3_image_get_all_by_uuids(context, image_uuids)
+
+
 def s3_image_create(context, image_uuid):
     """Create local s3 image represented by provided uuid"""
     return IMPL.s3_image_create(context, image_uuid)
@@ -19,6 +19,8 @@
 """Implementation of SQLAlchemy backend."""
 
 import datetime
+import functools
+import random
 import re
 import warnings
 
@@ -32,12 +34,14 @@ from nova import log as logging
 from nova.compute import vm_states
 from nova.db.sqlalchemy import models
 from nova.db.sqlalchemy.session import get_session
+from sqlalchemy import and_
 from sqlalchemy import or_
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload
 from sqlalchemy.orm import joinedload_all
 from sqlalchemy.sql import func
 from sqlalchemy.sql.expression import desc
+from sqlalchemy.sql.expression import exists
 from sqlalchemy.sql.expression import literal_column
 
 FLAGS = flags.FLAGS
@@ -376,6 +380,49 @@ def compute_node_get_all(context, session=None):
                     filter_by(deleted=can_read_deleted(context))
 
 
+@require_admin_context
+def compute_node_get_all_with_usage(context, host=None):
+    session = get_session()
+    with session.begin():
+        # NOTE: The intended query is below
+        #       SELECT compute_nodes.id, services.host,
+        #              compute_nodes.memory_mb - COALESCE(usage.memory_mb, 0),
+        #              ... (likewise for local_gb and vcpus)
+        #       FROM compute_nodes JOIN services
+        #       ON compute_nodes.service_id = services.id
+        #       LEFT OUTER JOIN
+        #       (SELECT host, SUM(memory_mb) AS memory_mb, ...
+        #        FROM instances GROUP BY host) AS usage
+        #       ON services.host = usage.host
+        usage = session.query(models.Instance.host,
+                    func.sum(models.Instance.memory_mb).label('memory_mb'),
+                    func.sum(models.Instance.local_gb).label('local_gb'),
+                    func.sum(models.Instance.vcpus).label('vcpus')).\
+                        filter_by(deleted=False).\
+                        group_by(models.Instance.host).\
+                        subquery()
+        query = session.query(models.ComputeNode.id,
+                    models.Service.host,
+                    models.ComputeNode.memory_mb -
+                            func.coalesce(usage.c.memory_mb, 0),
+                    models.ComputeNode.local_gb -
+                            func.coalesce(usage.c.local_gb, 0),
+                    models.ComputeNode.vcpus -
+                            func.coalesce(usage.c.vcpus, 0)).\
+                        join((models.Service,
+                              models.ComputeNode.service_id ==
+                                    models.Service.id)).\
+                        outerjoin((usage,
+                                   models.Service.host == usage.c.host)).\
+                        filter(models.ComputeNode.deleted == False).\
+                        filter(models.Service.deleted == False)
+        if host is not None:
+            query = query.filter(models.Service.host == host)
+
+        keys = ('id', 'host', 'free_ram_mb', 'free_disk_gb', 'free_vcpus')
+        return [dict(zip(keys, row)) for row in query.all()]
+
+
 @require_admin_context
 def compute_node_create(context, values):
     compute_node_ref = models.ComputeNode()
@@ -687,6 +734,20 @@ def floating_ip_get_by_fixed_address(context, fixed_address, session=None):
     # NOTE(tr3buchet) please don't invent an exception here, empty list is fine
 
 
+@require_context
+def floating_ip_get_by_address_ranges(context, ranges):
+    if not ranges:
+        return []
+    session = get_session()
+    return session.query(models.FloatingIp).\
+                   options(joinedload('fixed_ip')).\
+                   filter(or_(*[models.FloatingIp.address_int.between(*r)
+                                for r in ranges])).\
+                   filter(models.FloatingIp.fixed_ip_id != None).\
+                   filter_by(deleted=False).\
+                   all()
+
+
 @require_context
 def floating_ip_update(context, address, values):
     session = get_session()
@@ -740,6 +801,13 @@ def fixed_ip_associate(context, address, instance_id, network_id=None,
 @require_admin_context
 def fixed_ip_associate_pool(context, network_id, instance_id=None, host=None):
     session = get_session()
+    if FLAGS.fixed_ip_allocate_optimistically:
+        with session.begin():
+            if instance_id:
+                # NOTE: raises if the instance doesn't exist
+                instance_get(context, instance_id, session=session)
+            return _fixed_ip_claim_free(session, network_id, instance_id,
+                                        host)
     with session.begin():
         network_or_none = or_(models.FixedIp.network_id == network_id,
                               models.FixedIp.network_id == None)
@@ -769,6 +837,51 @@ def fixed_ip_associate_pool(context, network_id, instance_id=None, host=None):
     return fixed_ip_ref['address']
 
 
+def _fixed_ip_claim_free(session, network_id, instance_id, host):
+    """Claims a free fixed ip for instance_id.
+
+    Candidates are picked from a random offset into the free fixed ips, so
+    concurrent allocations rarely want the same row.  Each candidate is
+    claimed with an update that only matches while it is still free, so
+    no row is locked before it is known to be free, and a candidate taken
+    by someone else in the meantime is skipped.
+
+    """
+    network_or_none = or_(models.FixedIp.network_id == network_id,
+                          models.FixedIp.network_id == None)
+    free = session.query(models.FixedIp.id, models.FixedIp.address).\
+                   filter(network_or_none).\
+                   filter_by(reserved=False).\
+                   filter_by(deleted=False).\
+                   filter_by(instance_id=None).\
+                   filter_by(host=None)
+
+    for _attempt in xrange(max(FLAGS.fixed_ip_allocation_retries, 1)):
+        num_free = free.count()
+        if not num_free:
+            break
+        num_candidates = 1 + FLAGS.fixed_ip_allocation_candidates
+        offset = random.randint(0, max(num_free - num_candidates, 0))
+        candidates = free.order_by(models.FixedIp.id).\
+                          offset(offset).\
+                          limit(num_candidates).\
+                          all()
+        random.shuffle(candidates)
+
+        for fixed_ip_id, address in candidates:
+            values = {'network_id': network_id,
+                      'instance_id': instance_id,
+                      'updated_at': utils.utcnow()}
+            if host:
+                values['host'] = host
+            claimed = free.filter_by(id=fixed_ip_id).\
+                           update(values, synchronize_session=False)
+            if claimed:
+                return address
+
+    raise exception.NoMoreFixedIps()
+
+
 @require_context
 def fixed_ip_create(_context, values):
     fixed_ip_ref = models.FixedIp()
@@ -779,12 +892,22 @@ def fixed_ip_create(_context, values):
 
 @require_context
 def fixed_ip_bulk_create(_context, ips):
+    # NOTE: inserted with executemany rather than through the orm,
+    #       so address_int has to be filled in here and the rows
+    #       are grouped by the columns they set
+    batches = {}
+    for ip in ips:
+        if 'address_int' not in ip:
+            ip = dict(ip, address_int=models._address_int(ip['address']))
+        batches.setdefault(tuple(sorted(ip.keys())), []).append(ip)
+
+    insert = models.FixedIp.__table__.insert()
+    batch_size = FLAGS.fixed_ip_bulk_create_batch
     session = get_session()
     with session.begin():
-        for ip in ips:
-            model = models.FixedIp()
-            model.update(ip)
-            session.add(model)
+        for rows in batches.values():
+            for start in xrange(0, len(rows), batch_size):
+                session.execute(insert, rows[start:start + batch_size])
 
 
 @require_context
@@ -885,6 +1008,37 @@ def fixed_ip_get_by_address(context, address, session=None):
     return result
 
 
+@require_context
+def fixed_ip_get_by_address_ranges(context, ranges):
+    if not ranges:
+        return []
+    session = get_session()
+    return session.query(models.FixedIp).\
+                   filter(or_(*[models.FixedIp.address_int.between(*r)
+                                for r in ranges])).\
+                   filter(models.FixedIp.instance_id != None).\
+                   filter(models.FixedIp.virtual_interface_id != None).\
+                   filter_by(deleted=False).\
+                   order_by(models.FixedIp.virtual_interface_id).\
+                   all()
+
+
+@require_context
+def fixed_ip_get_all_addresses(context):
+    session = get_session()
+    floating_join = and_(models.FloatingIp.fixed_ip_id == models.FixedIp.id,
+                         models.FloatingIp.deleted == False)
+    return session.query(models.FixedIp.instance_id,
+                         models.FixedIp.address,
+                         models.FloatingIp.address).\
+                   outerjoin((models.FloatingIp, floating_join)).\
+                   filter(models.FixedIp.instance_id != None).\
+                   filter(models.FixedIp.virtual_interface_id != None).\
+                   filter(models.FixedIp.deleted == False).\
+                   order_by(models.FixedIp.virtual_interface_id).\
+                   yield_per(1000)
+
+
 @require_context
 def fixed_ip_get_by_instance(context, instance_id):
     session = get_session()
@@ -1054,6 +1208,22 @@ def virtual_interface_get_by_instance(context, instance_id):
     return vif_refs
 
 
+@require_context
+def virtual_interface_get_by_instances(context, instance_ids):
+    """Gets all virtual interfaces for the instances in instance_ids.
+
+    :param instance_ids: = ids of the instances to retrieve vifs for
+    """
+    if not instance_ids:
+        return []
+    session = get_session()
+    vif_refs = session.query(models.VirtualInterface).\
+                       filter(models.VirtualInterface.instance_id.in_(
+                                                        instance_ids)).\
+                       all()
+    return vif_refs
+
+
 @require_context
 def virtual_interface_get_by_instance_and_network(context, instance_id,
                                                            network_id):
@@ -1118,6 +1288,30 @@ def virtual_interface_get_all(context):
     return vif_refs
 
 
+@require_context
+def virtual_interface_get_ipv6_addresses(context, vif_address=None):
+    """Yields (instance_id, fixed ipv6 address) of the vifs on networks
+    with an ipv6 cidr.
+
+    :param vif_address: = only yield the vif with this mac address
+    """
+    session = get_session()
+    query = session.query(models.VirtualInterface.instance_id,
+                          models.VirtualInterface.address,
+                          models.Network.cidr_v6,
+                          models.Instance.project_id).\
+                    join((models.Network, models.VirtualInterface.network_id
+                                          == models.Network.id)).\
+                    join((models.Instance, models.VirtualInterface.instance_id
+                                           == models.Instance.id)).\
+                    filter(models.Network.cidr_v6 != None)
+    if vif_address is not None:
+        query = query.filter(models.VirtualInterface.address == vif_address)
+    for instance_id, address, cidr_v6, project_id in \
+            query.order_by(models.VirtualInterface.id).yield_per(1000):
+        yield instance_id, ipv6.to_global(cidr_v6, address, project_id)
+
+
 ###################
 
 
@@ -1266,11 +1460,62 @@ def instance_get_all(context):
                    all()
 
 
+def _regexp_prefix(pattern):
+    """Return the literal text every string matched by re.match(pattern)
+    starts with, or None if there is no such text we can work out."""
+    if '|' in pattern:
+        return None
+    if pattern.startswith('^'):
+        pattern = pattern[1:]
+    prefix = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            if i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+                prefix.append(pattern[i + 1])
+                i += 2
+                continue
+            break
+        if char in '.^$*+?{}[]()':
+            if char in '*?{' and prefix:
+                # The last character is optional
+                prefix.pop()
+            break
+        prefix.append(char)
+        i += 1
+    return ''.join(prefix) or None
+
+
+def _like_prefix(prefix):
+    """LIKE pattern for strings starting with prefix, escaped with '!'."""
+    for char in '!%_':
+        prefix = prefix.replace(char, '!' + char)
+    return prefix + '%'
+
+
+_instance_joins = {
+    'fixed_ips': [joinedload_all('fixed_ips.floating_ips'),
+                  joinedload_all('fixed_ips.network'),
+                  joinedload_all('fixed_ips.virtual_interface')],
+    'security_groups': [joinedload('security_groups')],
+    'metadata': [joinedload('metadata')],
+    'instance_type': [joinedload('instance_type')],
+}
+
+
 @require_context
-def instance_get_all_by_filters(context, filters):
+def instance_get_all_by_filters(context, filters, marker=None, limit=None,
+                                columns_to_join=None):
     """Return instances that match all filters.  Deleted instances
     will be returned by default, unless there's a filter that says
-    otherwise"""
+    otherwise
+
+    Instances are returned newest first. If marker (an instance uuid or
+    id) is given, only instances after it are returned, and no more than
+    limit of them if limit is given. columns_to_join lists the relations
+    to load along with the instances, which are all of them by default.
+    """
 
     def _regexp_filter_by_metadata(instance, meta):
         inst_metadata = [{node['key']: node['value']} \
@@ -1307,14 +1552,14 @@ def instance_get_all_by_filters(context, filters):
             return query.filter_by(**filter_dict)
 
     session = get_session()
-    query_prefix = session.query(models.Instance).\
-            options(joinedload_all('fixed_ips.floating_ips')).\
-            options(joinedload_all('fixed_ips.network')).\
-            options(joinedload_all('fixed_ips.virtual_interface')).\
-            options(joinedload('security_groups')).\
-            options(joinedload('metadata')).\
-            options(joinedload('instance_type')).\
-            order_by(desc(models.Instance.created_at))
+    query_prefix = session.query(models.Instance)
+    if columns_to_join is None:
+        columns_to_join = _instance_joins.keys()
+    for column in columns_to_join:
+        for option in _instance_joins[column]:
+            query_prefix = query_prefix.options(option)
+    query_prefix = query_prefix.order_by(desc(models.Instance.created_at),
+                                         desc(models.Instance.id))
 
     # Make a copy of the filters dictionary to use going forward, as we'll
     # be modifying it and we shouldn't affect the caller's use of it.
@@ -1358,31 +1603,90 @@ def instance_get_all_by_filters(context, filters):
         query_prefix = _exact_match_filter(query_prefix, filter_name,
                 filters.pop(filter_name))
 
-    instances = query_prefix.all()
-    if not instances:
-        return []
-
-    # Now filter on everything else for regexp matching..
-    # For filters not in the list, we'll attempt to use the filter_name
-    # as a column name in Instance..
-    regexp_filter_funcs = {}
-
-    for filter_name in filters.iterkeys():
-        filter_func = regexp_filter_funcs.get(filter_name, None)
-        filter_re = re.compile(str(filters[filter_name]))
-        if filter_func:
-            filter_l = lambda instance: filter_func(instance, filter_re)
-        elif filter_name == 'metadata':
-            filter_l = lambda instance: _regexp_filter_by_metadata(instance,
-                    filters[filter_name])
+    # Everything else is matched in python below. Narrow the query down
+    # as far as SQL can first, so only likely matches get loaded: regexps
+    # on columns become prefix LIKEs and each metadata pair an EXISTS.
+    # These may let through more than the python matching (e.g. LIKE is
+    # case insensitive on some databases), never less.
+    instance_columns = models.Instance.__table__.columns
+    filter_funcs = []
+    for filter_name, value in filters.iteritems():
+        if filter_name == 'metadata':
+            if isinstance(value, dict):
+                pairs = value.items()
+            elif isinstance(value, list):
+                pairs = [pair for node in value
+                         if isinstance(node, dict)
+                         for pair in node.items()]
+            else:
+                pairs = []
+            for key, meta_value in pairs:
+                query_prefix = query_prefix.filter(exists().where(and_(
+                        models.InstanceMetadata.instance_id ==
+                                models.Instance.id,
+                        models.InstanceMetadata.deleted == False,
+                        models.InstanceMetadata.key == key,
+                        models.InstanceMetadata.value == meta_value)))
+            filter_funcs.append(functools.partial(_regexp_filter_by_metadata,
+                                                  meta=value))
+            continue
+
+        if not hasattr(models.Instance, filter_name):
+            # Not something an instance has, so it can't filter anything
+            continue
+        filter_re = re.compile(str(value))
+        prefix = _regexp_prefix(str(value))
+        if prefix and filter_name in instance_columns:
+            column = getattr(models.Instance, filter_name)
+            query_prefix = query_prefix.filter(
+                    column.like(_like_prefix(prefix), escape='!'))
+        filter_funcs.append(functools.partial(_regexp_filter_by_column,
+                                              filter_name=filter_name,
+                                              filter_re=filter_re))
+
+    def _after(query, instance):
+        """Page past instance, keeping to the created_at, id order."""
+        return query.filter(or_(
+                models.Instance.created_at < instance['created_at'],
+                and_(models.Instance.created_at == instance['created_at'],
+                     models.Instance.id < instance['id'])))
+
+    if marker is not None:
+        marker_query = session.query(models.Instance)
+        if utils.is_uuid_like(marker):
+            marker_query = marker_query.filter_by(uuid=marker)
         else:
-            filter_l = lambda instance: _regexp_filter_by_column(instance,
-                    filter_name, filter_re)
-        instances = filter(filter_l, instances)
-        if not instances:
-            break
+            marker_query = marker_query.filter_by(id=marker)
+        marker_instance = marker_query.first()
+        if not marker_instance:
+            raise exception.MarkerNotFound(marker=marker)
+        query_prefix = _after(query_prefix, marker_instance)
+
+    if not filter_funcs:
+        if limit is not None:
+            query_prefix = query_prefix.limit(limit)
+        return query_prefix.all()
+
+    def _matches(instance):
+        for filter_func in filter_funcs:
+            if not filter_func(instance):
+                return False
+        return True
 
-    return instances
+    if limit is None:
+        return [instance for instance in query_prefix.all()
+                if _matches(instance)]
+
+    # Keep reading pages until enough instances pass the python filters.
+    instances = []
+    query = query_prefix
+    while len(instances) < limit:
+        page = query.limit(limit).all()
+        instances.extend(instance for instance in page if _matches(instance))
+        if len(page) < limit:
+            break
+        query = _after(query_prefix, page[-1])
+    return instances[:limit]
 
 
 @require_context
@@ -1553,6 +1857,25 @@ def instance_get_floating_address(context, instance_id):
     return fixed_ip_refs[0].floating_ips[0]['address']
 
 
+@require_admin_context
+def instance_get_most_used_images(context, limit):
+    session = get_session()
+    used = func.count(models.Instance.id)
+    rows = session.query(models.Instance.image_ref,
+                         models.Instance.kernel_id,
+                         models.Instance.ramdisk_id).\
+                   filter_by(deleted=False).\
+                   group_by(models.Instance.image_ref,
+                            models.Instance.kernel_id,
+                            models.Instance.ramdisk_id).\
+                   order_by(used.desc()).\
+                   limit(limit).\
+                   all()
+    return [dict(image_ref=image_ref, kernel_id=kernel_id,
+                 ramdisk_id=ramdisk_id)
+            for image_ref, kernel_id, ramdisk_id in rows]
+
+
 @require_admin_context
 def instance_get_all_hung_in_rebooting(context, reboot_window, session=None):
     reboot_window = datetime.datetime.utcnow() - datetime.timedelta(
@@ -1651,6 +1974,84 @@ def instance_get_id_to_uuid_mapping(context, ids):
     return mapping
 
 
+@require_context
+def instance_info_cache_get(context, instance_id):
+    session = get_session()
+    return session.query(models.InstanceInfoCache).\
+                   filter_by(instance_id=instance_id).\
+                   order_by(desc(models.InstanceInfoCache.id)).\
+                   first()
+
+
+@require_context
+def instance_info_cache_update(context, instance_id, values,
+                               generation=None):
+    session = get_session()
+    with session.begin():
+        if generation is not None:
+            info_cache_ref = session.query(models.InstanceInfoCache).\
+                                     filter_by(instance_id=instance_id).\
+                                     order_by(desc(
+                                         models.InstanceInfoCache.id)).\
+                                     with_lockmode('update').\
+                                     first()
+            # NOTE: if with_lockmode isn't supported, as in sqlite,
+            #       then this has concurrency issues
+            if (info_cache_ref and info_cache_ref['id'] or 0) != generation:
+                return None
+        # NOTE: a cache is replaced rather than updated, so that
+        #       every write gets a new id to compare generations by.
+        #       The old rows go after the insert, so that ids are
+        #       never reused.
+        info_cache_ref = models.InstanceInfoCache()
+        info_cache_ref.update(values)
+        info_cache_ref.instance_id = instance_id
+        info_cache_ref.save(session=session)
+        session.query(models.InstanceInfoCache).\
+                filter_by(instance_id=instance_id).\
+                filter(models.InstanceInfoCache.id < info_cache_ref.id).\
+                delete(synchronize_session=False)
+    return info_cache_ref
+
+
+@require_context
+def instance_info_cache_invalidate(context, instance_id):
+    session = get_session()
+    with session.begin():
+        _instance_info_cache_invalidate(session, [instance_id])
+
+
+@require_context
+def instance_info_cache_delete(context, instance_id):
+    session = get_session()
+    with session.begin():
+        session.query(models.InstanceInfoCache).\
+                filter_by(instance_id=instance_id).\
+                delete(synchronize_session=False)
+
+
+def _instance_info_cache_invalidate(session, instance_ids):
+    """Replaces the info caches of instance_ids with empty ones.
+
+    The empty rows get new ids, so a cache that was being built before
+    the invalidation is not written afterwards.
+
+    """
+    instance_ids = list(instance_ids)
+    if not instance_ids:
+        return
+    newest = session.query(func.max(models.InstanceInfoCache.id)).scalar()
+    session.execute(models.InstanceInfoCache.__table__.insert(),
+                    [{'instance_id': instance_id, 'network_info': None}
+                     for instance_id in instance_ids])
+    if newest is not None:
+        session.query(models.InstanceInfoCache).\
+                filter(models.InstanceInfoCache.instance_id.in_(
+                    instance_ids)).\
+                filter(models.InstanceInfoCache.id <= newest).\
+                delete(synchronize_session=False)
+
+
 ###################
 
 
@@ -1911,6 +2312,7 @@ def network_get_associated_fixed_ips(context, network_id):
     session = get_session()
     return session.query(models.FixedIp).\
                    options(joinedload_all('instance')).\
+                   options(joinedload('virtual_interface')).\
                    filter_by(network_id=network_id).\
                    filter(models.FixedIp.instance_id != None).\
                    filter(models.FixedIp.virtual_interface_id != None).\
@@ -1918,6 +2320,17 @@ def network_get_associated_fixed_ips(context, network_id):
                    all()
 
 
+@require_admin_context
+def network_get_fixed_ips_updated_since(context, network_id, updated_since):
+    session = get_session()
+    return session.query(models.FixedIp).\
+                   options(joinedload_all('instance')).\
+                   options(joinedload('virtual_interface')).\
+                   filter_by(network_id=network_id).\
+                   filter(models.FixedIp.updated_at >= updated_since).\
+                   all()
+
+
 @require_admin_context
 def network_get_by_bridge(context, bridge):
     session = get_session()
@@ -2033,6 +2446,15 @@ def network_update(context, network_id, values):
         network_ref = network_get(context, network_id, session=session)
         network_ref.update(values)
         network_ref.save(session=session)
+        # NOTE: the network info of its instances includes the
+        #       network's settings, so their caches are stale now
+        fixed_ips = session.query(models.FixedIp.instance_id).\
+                            filter_by(network_id=network_id).\
+                            filter_by(deleted=False).\
+                            filter(models.FixedIp.instance_id != None).\
+                            distinct()
+        _instance_info_cache_invalidate(session,
+                [fixed_ip.instance_id for fixed_ip in fixed_ips])
         return network_ref
 
 
@@ -2633,6 +3055,18 @@ def block_device_mapping_get_all_by_instance(context, instance_id):
     return result
 
 
+@require_context
+def block_device_mapping_get_all_by_instances(context, instance_ids):
+    if not instance_ids:
+        return []
+    session = get_session()
+    return session.query(models.BlockDeviceMapping).\
+             options(joinedload('volume')).\
+             filter(models.BlockDeviceMapping.instance_id.in_(instance_ids)).\
+             filter_by(deleted=False).\
+             all()
+
+
 @require_context
 def block_device_mapping_destroy(context, bdm_id):
     session = get_session()
@@ -2733,6 +3167,24 @@ def security_group_get_by_instance(context, instance_id):
                    all()
 
 
+@require_admin_context
+def security_group_get_fixed_addresses(context, security_group_id):
+    session = get_session()
+    association = models.SecurityGroupInstanceAssociation
+    rows = session.query(models.FixedIp.address).\
+                   join((models.Instance,
+                         models.Instance.id == models.FixedIp.instance_id)).\
+                   join((association,
+                         association.instance_id == models.Instance.id)).\
+                   filter(association.security_group_id == security_group_id).\
+                   filter(association.deleted == False).\
+                   filter(models.Instance.deleted == False).\
+                   filter(models.FixedIp.deleted == False).\
+                   order_by(models.Instance.id, models.FixedIp.id).\
+                   all()
+    return [row.address for row in rows]
+
+
 @require_context
 def security_group_exists(context, project_id, group_name):
     try:
@@ -4057,6 +4509,16 @@ def s3_image_get_by_uuid(context, image_uuid):
     return res
 
 
+def s3_image_get_all_by_uuids(context, image_uuids):
+    """Find the local s3 images there are for the provided uuids"""
+    if not image_uuids:
+        return []
+    session = get_session()
+    return session.query(models.S3Image)\
+                  .filter(models.S3Image.uuid.in_(image_uuids))\
+                  .all()
+
+
 def s3_image_create(context, image_uuid):
     """Create local s3 image represented by provided uuid"""
     try:
@@ -0,0 +1,47 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import Index, MetaData, Table
+
+meta = MetaData()
+
+
+def _indexes():
+    # NOTE: instance lists are ordered by created_at and paged by
+    # (created_at, id), name searches are prefix matches on display_name
+    # and metadata searches look up key/value pairs.
+    instances = Table('instances', meta, autoload=True)
+    instance_metadata = Table('instance_metadata', meta, autoload=True)
+    return [Index('instances_created_at_idx',
+                  instances.c.created_at, instances.c.id),
+            Index('instances_project_id_created_at_idx',
+                  instances.c.project_id, instances.c.created_at),
+            Index('instances_display_name_idx', instances.c.display_name),
+            Index('instance_metadata_key_value_idx',
+                  instance_metadata.c.key, instance_metadata.c.value)]
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    for index in _indexes():
+        index.create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    for index in _indexes():
+        index.drop(migrate_engine)
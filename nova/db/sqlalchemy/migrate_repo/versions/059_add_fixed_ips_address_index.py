@@ -0,0 +1,37 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import Index, MetaData, Table
+
+meta = MetaData()
+
+
+def _index():
+    # NOTE: the metadata service looks up the calling instance by the
+    # fixed address its request comes from.
+    fixed_ips = Table('fixed_ips', meta, autoload=True)
+    return Index('fixed_ips_address_idx', fixed_ips.c.address)
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    _index().create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    _index().drop(migrate_engine)
@@ -0,0 +1,61 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import netaddr
+from sqlalchemy import BigInteger, Column, Index, MetaData, Table
+
+
+meta = MetaData()
+
+
+def _address_int(address):
+    # NOTE: only IPv4 addresses are packed, IPv6 ones don't fit
+    try:
+        address = netaddr.IPAddress(address)
+    except (netaddr.AddrFormatError, TypeError, ValueError):
+        return None
+    if address.version != 4:
+        return None
+    return int(address)
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    # NOTE: instance ip searches turn address prefixes into ranges of
+    # packed addresses and scan them with this index.
+    for table_name in ('fixed_ips', 'floating_ips'):
+        table = Table(table_name, meta, autoload=True)
+        address_int = Column('address_int', BigInteger())
+        table.create_column(address_int)
+
+        rows = migrate_engine.execute(table.select())
+        for row in rows:
+            migrate_engine.execute(table.update()\
+                    .where(table.c.id == row['id'])\
+                    .values(address_int=_address_int(row['address'])))
+
+        Index('%s_address_int_idx' % table_name,
+              table.c.address_int).create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    for table_name in ('fixed_ips', 'floating_ips'):
+        table = Table(table_name, meta, autoload=True)
+        Index('%s_address_int_idx' % table_name,
+              table.c.address_int).drop(migrate_engine)
+        table.c.address_int.drop()
@@ -0,0 +1,58 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Index
+from sqlalchemy import Integer, MetaData, Table, Text
+
+from nova import log as logging
+
+
+meta = MetaData()
+
+
+def _instance_info_caches():
+    # NOTE: autoloaded for the foreign key
+    Table('instances', meta, autoload=True)
+    return Table('instance_info_caches', meta,
+            Column('created_at', DateTime(timezone=False)),
+            Column('updated_at', DateTime(timezone=False)),
+            Column('deleted_at', DateTime(timezone=False)),
+            Column('deleted', Boolean(create_constraint=True, name=None)),
+            Column('id', Integer(), primary_key=True, nullable=False),
+            Column('network_info', Text()),
+            Column('instance_id', Integer(), ForeignKey('instances.id'),
+                   nullable=False))
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    instance_info_caches = _instance_info_caches()
+
+    try:
+        instance_info_caches.create()
+        Index('instance_info_caches_instance_id_idx',
+              instance_info_caches.c.instance_id).create(migrate_engine)
+    except Exception:
+        logging.exception("Exception while creating table "
+                          "'instance_info_caches'")
+        meta.drop_all(tables=[instance_info_caches])
+        raise
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    _instance_info_caches().drop()
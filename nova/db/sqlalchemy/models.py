@@ -20,7 +20,8 @@
 SQLAlchemy models for nova data.
 """
 
-from sqlalchemy.orm import relationship, backref, object_mapper
+import netaddr
+from sqlalchemy.orm import relationship, backref, object_mapper, validates
 from sqlalchemy import Column, Integer, BigInteger, String, schema
 from sqlalchemy import ForeignKey, DateTime, Boolean, Text, Float
 from sqlalchemy.exc import IntegrityError
@@ -295,6 +296,16 @@ class InstanceActions(BASE, NovaBase):
     error = Column(Text)
 
 
+class InstanceInfoCache(BASE, NovaBase):
+    """Represents what other services cache about an instance"""
+    __tablename__ = 'instance_info_caches'
+    id = Column(Integer, primary_key=True)
+    instance_id = Column(Integer, ForeignKey('instances.id'), nullable=False)
+
+    # serialized record built by the network manager
+    network_info = Column(Text)
+
+
 class InstanceTypes(BASE, NovaBase):
     """Represent possible instance_types or flavor of VM offered"""
     __tablename__ = "instance_types"
@@ -663,12 +674,25 @@ class VirtualInterface(BASE, NovaBase):
         return ipv6_address
 
 
+def _address_int(address):
+    """Packs an IPv4 address into an integer, None for anything else."""
+    try:
+        address = netaddr.IPAddress(address)
+    except (netaddr.AddrFormatError, TypeError, ValueError):
+        return None
+    if address.version != 4:
+        return None
+    return int(address)
+
+
 # TODO(vish): can these both come from the same baseclass?
 class FixedIp(BASE, NovaBase):
     """Represents a fixed ip for an instance."""
     __tablename__ = 'fixed_ips'
     id = Column(Integer, primary_key=True)
     address = Column(String(255))
+    # NOTE: kept in step with address, ip searches scan ranges of it
+    address_int = Column(BigInteger)
     network_id = Column(Integer, ForeignKey('networks.id'), nullable=True)
     network = relationship(Network, backref=backref('fixed_ips'))
     virtual_interface_id = Column(Integer, ForeignKey('virtual_interfaces.id'),
@@ -690,12 +714,19 @@ class FixedIp(BASE, NovaBase):
     reserved = Column(Boolean, default=False)
     host = Column(String(255))
 
+    @validates('address')
+    def _set_address_int(self, key, address):
+        self.address_int = _address_int(address)
+        return address
+
 
 class FloatingIp(BASE, NovaBase):
     """Represents a floating ip that dynamically forwards to a fixed ip."""
     __tablename__ = 'floating_ips'
     id = Column(Integer, primary_key=True)
     address = Column(String(255))
+    # NOTE: kept in step with address, ip searches scan ranges of it
+    address_int = Column(BigInteger)
     fixed_ip_id = Column(Integer, ForeignKey('fixed_ips.id'), nullable=True)
     fixed_ip = relationship(FixedIp,
                             backref=backref('floating_ips'),
@@ -707,6 +738,11 @@ class FloatingIp(BASE, NovaBase):
     host = Column(String(255))  # , ForeignKey('hosts.id'))
     auto_assigned = Column(Boolean, default=False, nullable=False)
 
+    @validates('address')
+    def _set_address_int(self, key, address):
+        self.address_int = _address_int(address)
+        return address
+
 
 class AuthToken(BASE, NovaBase):
     """Represents an authorization token for all API transactions.
@@ -914,7 +950,8 @@ def register_models():
     connection is lost and needs to be reestablished.
     """
     from sqlalchemy import create_engine
-    models = (Service, Instance, InstanceActions, InstanceTypes,
+    models = (Service, Instance, InstanceActions, InstanceInfoCache,
+              InstanceTypes,
               Volume, ExportDevice, IscsiTarget, FixedIp, FloatingIp,
               Network, SecurityGroup, SecurityGroupIngressRule,
               SecurityGroupInstanceAssociation, AuthToken, User,
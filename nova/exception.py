@@ -421,6 +421,10 @@ class ListingImageRefsNotSupported(Invalid):
         + " This version of the api does not support displaying image hrefs.")
 
 
+class MarkerNotFound(NotFound):
+    message = _("Marker %(marker)s could not be found.")
+
+
 class ImageNotFound(NotFound):
     message = _("Image %(image_id)s could not be found.")
 
@@ -299,6 +299,14 @@ DEFINE_list('glance_api_servers',
             'list of glance api servers available to nova (host:port)')
 DEFINE_integer('glance_num_retries', 0,
                'The number of times to retry downloading an image from glance')
+DEFINE_integer('glance_download_concurrency', 4,
+               'Number of ranged requests to download an image from glance '
+               'with at once, 1 downloads it in a single request')
+DEFINE_integer('glance_download_range_size', 16 * 1024 * 1024,
+               'Bytes of an image to download per ranged request')
+DEFINE_integer('glance_image_cache_ttl', 15,
+               'Seconds to cache the metadata of active glance images for, '
+               '0 disables the cache')
 DEFINE_integer('s3_port', 3333, 's3 port')
 DEFINE_string('s3_host', '$my_ip', 's3 host (for infrastructure)')
 DEFINE_string('s3_dmz', '$my_ip', 's3 dmz ip (for instances)')
@@ -386,6 +394,18 @@ DEFINE_integer('sql_idle_timeout',
               'timeout for idle sql database connections')
 DEFINE_integer('sql_max_retries', 12, 'sql connection attempts')
 DEFINE_integer('sql_retry_interval', 10, 'sql connection retry interval')
+DEFINE_bool('fixed_ip_allocate_optimistically', False,
+            'Claim fixed ips from random free candidates with conditional '
+            'updates, instead of locking the first free fixed ip')
+DEFINE_integer('fixed_ip_allocation_candidates', 16,
+               'Number of free fixed ips to pick from per allocation round '
+               'when allocating optimistically')
+DEFINE_integer('fixed_ip_allocation_retries', 5,
+               'Number of allocation rounds before giving up when '
+               'allocating optimistically')
+DEFINE_integer('fixed_ip_bulk_create_batch', 1000,
+               'Number of fixed ips inserted per statement when creating '
+               'the fixed ips of a network')
 
 DEFINE_string('compute_manager', 'nova.compute.manager.ComputeManager',
               'Manager for compute')
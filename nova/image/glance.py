@@ -19,6 +19,7 @@
 
 from __future__ import absolute_import
 
+import collections
 import copy
 import datetime
 import json
@@ -26,6 +27,7 @@ import random
 import time
 from urlparse import urlparse
 
+import eventlet
 from glance.common import exception as glance_exception
 
 from nova import exception
@@ -42,6 +44,9 @@ FLAGS = flags.FLAGS
 
 GlanceClient = utils.import_class('glance.client.Client')
 
+# NOTE: the same as glance.client uses to read image bodies
+_CHUNK_SIZE = 65536
+
 
 def _parse_image_ref(image_href):
     """Parse an image href into composite parts.
@@ -120,11 +125,158 @@ def get_glance_client(context, image_href):
         return (glance_client, image_id)
 
 
+def _get_image_from(client, image_id, offset):
+    """Requests the image from offset on.
+
+    Returns how many bytes to skip at the start of the returned chunks,
+    as glance may ignore the Range header and send the whole image.
+
+    """
+    res = client.do_request('GET', '/images/%s' % image_id,
+                            headers={'Range': 'bytes=%d-' % offset})
+    if res.status == 206:
+        offset = 0
+    return offset, iter(lambda: res.read(_CHUNK_SIZE), '')
+
+
+def _fetch_range(client, image_id, start, end):
+    """Returns bytes start to end - 1 of the image, or None if glance
+    does not support ranged requests.  A failed request is resumed from
+    the last byte received."""
+    received = []
+    offset = start
+    num_retries = FLAGS.glance_num_retries
+    for count in xrange(1 + num_retries):
+        try:
+            res = client.do_request('GET', '/images/%s' % image_id,
+                    headers={'Range': 'bytes=%d-%d' % (offset, end - 1)})
+            if res.status != 206:
+                res.close()
+                return None
+            while offset < end:
+                chunk = res.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                received.append(chunk)
+                offset += len(chunk)
+            if offset >= end:
+                return ''.join(received)
+        except glance_exception.NotFound:
+            raise exception.ImageNotFound(image_id=image_id)
+        except Exception:
+            if count == num_retries:
+                raise
+        LOG.warn(_("Download of image %(image_id)s failed at byte "
+                   "%(offset)d, resuming"), locals())
+        time.sleep(1)
+    raise exception.Error(_("Download of image %(image_id)s ended at byte "
+                            "%(offset)d") % locals())
+
+
+def _fetch_ranges(client, image_id, size):
+    """Yields the image in order, in pieces of glance_download_range_size.
+
+    The first piece is fetched on its own, and is None if glance does not
+    support ranged requests.  The others are fetched
+    glance_download_concurrency at a time.
+
+    """
+    range_size = FLAGS.glance_download_range_size
+    first = _fetch_range(client, image_id, 0, min(range_size, size))
+    yield first
+    if first is None:
+        return
+
+    window = FLAGS.glance_download_concurrency
+    pending = collections.deque()
+    try:
+        for start in xrange(range_size, size, range_size):
+            pending.append(eventlet.spawn(_fetch_range, client, image_id,
+                                          start,
+                                          min(start + range_size, size)))
+            if len(pending) >= window:
+                yield pending.popleft().wait()
+        while pending:
+            yield pending.popleft().wait()
+    finally:
+        for thread in pending:
+            thread.kill()
+
+
+class _ImageMetaCache(object):
+    """Glance metadata of active images, by id and by name.
+
+    Entries expire glance_image_cache_ttl seconds after they were fetched.
+    Images that are not active yet are not cached, as their status is
+    what callers wait on.
+
+    Glance decides which private images a token may see, so only public
+    images are shared. Private images are only served back to the
+    project that fetched them.
+
+    """
+
+    def __init__(self):
+        self.images = {}
+        self.names = {}
+
+    @staticmethod
+    def _scope(context, image_meta=None):
+        if image_meta is not None and image_meta.get('is_public'):
+            return None
+        return ('project', getattr(context, 'project_id', None))
+
+    def get(self, context, image_id):
+        entries = self.images.get(str(image_id), {})
+        for scope in (None, self._scope(context)):
+            try:
+                expires, image_meta = entries[scope]
+            except KeyError:
+                continue
+            if expires <= time.time():
+                self.remove(image_id)
+                return None
+            return copy.deepcopy(image_meta)
+        return None
+
+    def get_by_name(self, context, name):
+        image_metas = [self.get(context, image_id)
+                       for image_id in list(self.names.get(name, ()))]
+        return [image_meta for image_meta in image_metas if image_meta]
+
+    def add(self, context, image_meta):
+        if (not FLAGS.glance_image_cache_ttl or
+            image_meta.get('status') != 'active'):
+            return
+        image_id = str(image_meta['id'])
+        # NOTE: fresher metadata invalidates what other projects
+        #       cached, in case the image was renamed or unshared
+        entries = self.images.get(image_id, {})
+        if any(cached != image_meta for _e, cached in entries.values()):
+            self.remove(image_id)
+        expires = time.time() + FLAGS.glance_image_cache_ttl
+        scope = self._scope(context, image_meta)
+        self.images.setdefault(image_id, {})[scope] = (
+                expires, copy.deepcopy(image_meta))
+        self.names.setdefault(image_meta.get('name'), set()).add(image_id)
+
+    def remove(self, image_id):
+        try:
+            entries = self.images.pop(str(image_id))
+        except KeyError:
+            return
+        for name in set(meta.get('name') for _e, meta in entries.values()):
+            self.names[name].discard(str(image_id))
+            if not self.names[name]:
+                del self.names[name]
+
+
 class GlanceImageService(object):
     """Provides storage and retrieval of disk image objects within Glance."""
 
     def __init__(self, client=None):
         self._client = client
+        self._cache = _ImageMetaCache()
 
     def _get_client(self, context):
         # NOTE(sirp): we want to load balance each request across glance
@@ -157,6 +309,7 @@ class GlanceImageService(object):
 
         images = []
         for image_meta in image_metas:
+            self._cache.add(context, image_meta)
             if self._is_image_available(context, image_meta):
                 base_image_meta = self._translate_from_glance(image_meta)
                 images.append(base_image_meta)
@@ -185,39 +338,41 @@ class GlanceImageService(object):
 
     def _fetch_images(self, fetch_func, **kwargs):
         """Paginate through results from glance server"""
-        images = fetch_func(**kwargs)
+        while True:
+            images = fetch_func(**kwargs)
 
-        if not images:
-            # break out of recursive loop to end pagination
-            return
+            if not images:
+                # an empty page ends pagination
+                return
 
-        for image in images:
-            yield image
+            for image in images:
+                yield image
 
-        try:
-            # attempt to advance the marker in order to fetch next page
-            kwargs['marker'] = images[-1]['id']
-        except KeyError:
-            raise exception.ImagePaginationFailed()
-
-        try:
-            kwargs['limit'] = kwargs['limit'] - len(images)
-            # break if we have reached a provided limit
-            if kwargs['limit'] <= 0:
-                return
-        except KeyError:
-            # ignore missing limit, just proceed without it
-            pass
+            try:
+                # attempt to advance the marker in order to fetch next page
+                kwargs['marker'] = images[-1]['id']
+            except KeyError:
+                raise exception.ImagePaginationFailed()
 
-        for image in self._fetch_images(fetch_func, **kwargs):
-            yield image
+            try:
+                kwargs['limit'] = kwargs['limit'] - len(images)
+                # break if we have reached a provided limit
+                if kwargs['limit'] <= 0:
+                    return
+            except KeyError:
+                # ignore missing limit, just proceed without it
+                pass
 
     def show(self, context, image_id):
         """Returns a dict with image data for the given opaque image id."""
-        try:
-            image_meta = self._get_client(context).get_image_meta(image_id)
-        except glance_exception.NotFound:
-            raise exception.ImageNotFound(image_id=image_id)
+        image_meta = self._cache.get(context, image_id)
+        if image_meta is None:
+            try:
+                image_meta = self._get_client(context).get_image_meta(
+                        image_id)
+            except glance_exception.NotFound:
+                raise exception.ImageNotFound(image_id=image_id)
+            self._cache.add(context, image_meta)
 
         if not self._is_image_available(context, image_meta):
             raise exception.ImageNotFound(image_id=image_id)
@@ -227,34 +382,103 @@ class GlanceImageService(object):
 
     def show_by_name(self, context, name):
         """Returns a dict containing image data for the given name."""
-        # TODO(vish): replace this with more efficient call when glance
-        #             supports it.
-        image_metas = self.detail(context)
+        for image_meta in self._cache.get_by_name(context, name):
+            if self._is_image_available(context, image_meta):
+                return self._translate_from_glance(image_meta)
+
+        image_metas = self._get_images(context, filters={'name': name})
         for image_meta in image_metas:
-            if name == image_meta.get('name'):
-                return image_meta
+            # NOTE: older glance servers ignore the name filter
+            if image_meta.get('name') != name:
+                continue
+            self._cache.add(context, image_meta)
+            if self._is_image_available(context, image_meta):
+                return self._translate_from_glance(image_meta)
         raise exception.ImageNotFound(image_id=name)
 
     def get(self, context, image_id, data):
-        """Calls out to Glance for metadata and data and writes data."""
+        """Calls out to Glance for metadata and data and writes data.
+
+        Large images are fetched with several ranged requests at once if
+        glance supports them.  Either way, a failed request is resumed
+        from the last byte written, up to glance_num_retries times.
+
+        """
+        client = self._get_client(context)
+        image_meta = None
+        if (FLAGS.glance_download_concurrency > 1 and
+            hasattr(client, 'do_request')):
+            try:
+                image_meta = client.get_image_meta(image_id)
+            except glance_exception.NotFound:
+                raise exception.ImageNotFound(image_id=image_id)
+            size = image_meta.get('size') or 0
+            if size > FLAGS.glance_download_range_size:
+                written = 0
+                for piece in _fetch_ranges(client, image_id, size):
+                    if piece is None:
+                        # NOTE: glance ignored the Range header
+                        break
+                    data.write(piece)
+                    written += len(piece)
+                if 0 < written < size:
+                    # NOTE: glance stopped honouring the Range header
+                    #       partway, so carry on from what was written
+                    self._stream_image(context, client, image_id, data,
+                                       written)
+                if written:
+                    return self._translate_from_glance(image_meta)
+
+        image_meta = self._stream_image(context, client, image_id, data)
+
+        base_image_meta = self._translate_from_glance(image_meta)
+        return base_image_meta
+
+    def _stream_image(self, context, client, image_id, data, offset=0):
+        """Writes the image from byte offset on from a single request,
+        which is resumed from the last byte written if it fails."""
+        image_meta = None
         num_retries = FLAGS.glance_num_retries
         for count in xrange(1 + num_retries):
-            client = self._get_client(context)
             try:
-                image_meta, image_chunks = client.get_image(image_id)
-                break
+                if offset and hasattr(client, 'do_request'):
+                    skip, image_chunks = _get_image_from(client, image_id,
+                                                         offset)
+                else:
+                    image_meta, image_chunks = client.get_image(image_id)
+                    skip = offset
             except glance_exception.NotFound:
                 raise exception.ImageNotFound(image_id=image_id)
             except Exception:
                 if count == num_retries:
                     raise
+                time.sleep(1)
+                client = self._get_client(context)
+                continue
+
+            image_chunks = iter(image_chunks)
+            while True:
+                try:
+                    chunk = image_chunks.next()
+                except StopIteration:
+                    return image_meta
+                except Exception:
+                    if count == num_retries:
+                        raise
+                    LOG.warn(_("Download of image %(image_id)s failed at "
+                               "byte %(offset)d, resuming"), locals())
+                    break
+                if skip:
+                    # NOTE: glance resent what was already written
+                    if len(chunk) <= skip:
+                        skip -= len(chunk)
+                        continue
+                    chunk = chunk[skip:]
+                    skip = 0
+                data.write(chunk)
+                offset += len(chunk)
             time.sleep(1)
-
-        for chunk in image_chunks:
-            data.write(chunk)
-
-        base_image_meta = self._translate_from_glance(image_meta)
-        return base_image_meta
+            client = self._get_client(context)
 
     def create(self, context, image_meta, data=None):
         """Store the image data and return the new image id.
@@ -286,6 +510,7 @@ class GlanceImageService(object):
         """
         # NOTE(vish): show is to check if image is available
         self.show(context, image_id)
+        self._cache.remove(image_id)
         image_meta = self._translate_to_glance(image_meta)
         try:
             client = self._get_client(context)
@@ -322,6 +547,7 @@ class GlanceImageService(object):
                 and (context.project_id != properties['owner_id'])):
                 raise exception.NotAuthorized(_("Not the image owner"))
 
+        self._cache.remove(image_id)
         try:
             result = self._get_client(context).delete_image(image_id)
         except glance_exception.NotFound:
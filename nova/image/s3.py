@@ -19,14 +19,14 @@
 """Proxy AMI-related calls from cloud controller to objectstore service."""
 
 import binascii
-import os
-import shutil
+import collections
 import tarfile
-import tempfile
+import time
 from xml.etree import ElementTree
 
 import boto.s3.connection
 import eventlet
+from eventlet.green import subprocess
 
 from nova import crypto
 import nova.db.api
@@ -40,12 +40,12 @@ from nova.api.ec2 import ec2utils
 
 LOG = logging.getLogger("nova.image.s3")
 FLAGS = flags.FLAGS
-flags.DEFINE_string('image_decryption_dir', '/tmp',
-                    'parent dir for tempdir used for image decryption')
 flags.DEFINE_string('s3_access_key', 'notchecked',
                     'access key to use for s3 server for images')
 flags.DEFINE_string('s3_secret_key', 'notchecked',
                     'secret key to use for s3 server for images')
+flags.DEFINE_integer('s3_image_download_concurrency', 4,
+                     'number of image parts to download from s3 at once')
 
 
 class S3ImageService(object):
@@ -61,6 +61,12 @@ class S3ImageService(object):
     def get_image_id(self, context, image_uuid):
         return nova.db.api.s3_image_get_by_uuid(context, image_uuid)['id']
 
+    def get_image_ids(self, context, image_uuids):
+        """Map those of image_uuids that have an image id to it."""
+        images = nova.db.api.s3_image_get_all_by_uuids(context,
+                                                       list(image_uuids))
+        return dict((image['uuid'], image['id']) for image in images)
+
     def _create_image_id(self, context, image_uuid):
         return nova.db.api.s3_image_create(context, image_uuid)['id']
 
@@ -151,11 +157,30 @@ class S3ImageService(object):
                                                host=FLAGS.s3_host)
 
     @staticmethod
-    def _download_file(bucket, filename, local_dir):
+    def _download_part(bucket, filename):
         key = bucket.get_key(filename)
-        local_filename = os.path.join(local_dir, filename)
-        key.get_contents_to_filename(local_filename)
-        return local_filename
+        return key.get_contents_as_string()
+
+    def _download_parts(self, bucket, filenames):
+        """Yields the contents of the parts in order.
+
+        Up to FLAGS.s3_image_download_concurrency parts are downloaded or
+        waiting to be consumed at any time.
+
+        """
+        window = max(FLAGS.s3_image_download_concurrency, 1)
+        pending = collections.deque()
+        try:
+            for filename in filenames:
+                pending.append(eventlet.spawn(self._download_part,
+                                              bucket, filename))
+                if len(pending) >= window:
+                    yield pending.popleft().wait()
+            while pending:
+                yield pending.popleft().wait()
+        finally:
+            for thread in pending:
+                thread.kill()
 
     def _s3_parse_manifest(self, context, metadata, manifest):
         manifest = ElementTree.fromstring(manifest)
@@ -247,8 +272,6 @@ class S3ImageService(object):
     def _s3_create(self, context, metadata):
         """Gets a manifext from s3 and makes an image."""
 
-        image_path = tempfile.mkdtemp(dir=FLAGS.image_decryption_dir)
-
         image_location = metadata['properties']['image_location']
         bucket_name = image_location.split('/')[0]
         manifest_path = image_location[len(bucket_name) + 1:]
@@ -261,37 +284,37 @@ class S3ImageService(object):
                                                               manifest)
 
         def delayed_create():
-            """This handles the fetching and decrypting of the part files."""
-            log_vars = {'image_location': image_location,
-                        'image_path': image_path}
-            metadata['properties']['image_state'] = 'downloading'
-            self.service.update(context, image_uuid, metadata)
+            """This streams the part files through openssl and tar into
+            the image service, without writing them to local disk."""
+            log_vars = {'image_location': image_location}
+            stage = {'state': None, 'started_at': time.time()}
+            started_at = stage['started_at']
+
+            def _set_image_state(state):
+                now = time.time()
+                if stage['state']:
+                    LOG.info(_("%(image_location)s spent %(elapsed).2f "
+                               "seconds %(state)s"),
+                             dict(log_vars, state=stage['state'],
+                                  elapsed=now - stage['started_at']))
+                stage.update(state=state, started_at=now)
+                metadata['properties']['image_state'] = state
+                self.service.update(context, image_uuid, metadata)
 
-            try:
-                parts = []
-                elements = manifest.find('image').getiterator('filename')
-                for fn_element in elements:
-                    part = self._download_file(bucket,
-                                               fn_element.text,
-                                               image_path)
-                    parts.append(part)
-
-                # NOTE(vish): this may be suboptimal, should we use cat?
-                enc_filename = os.path.join(image_path, 'image.encrypted')
-                with open(enc_filename, 'w') as combined:
-                    for filename in parts:
-                        with open(filename) as part:
-                            shutil.copyfileobj(part, combined)
+            _set_image_state('downloading')
 
+            elements = manifest.find('image').getiterator('filename')
+            parts = self._download_parts(bucket,
+                                         [fn.text for fn in elements])
+            try:
+                first_part = parts.next()
             except Exception:
-                LOG.exception(_("Failed to download %(image_location)s "
-                                "to %(image_path)s"), log_vars)
-                metadata['properties']['image_state'] = 'failed_download'
-                self.service.update(context, image_uuid, metadata)
+                LOG.exception(_("Failed to download %(image_location)s"),
+                              log_vars)
+                _set_image_state('failed_download')
                 return
 
-            metadata['properties']['image_state'] = 'decrypting'
-            self.service.update(context, image_uuid, metadata)
+            _set_image_state('decrypting')
 
             try:
                 hex_key = manifest.find('image/ec2_encrypted_key').text
@@ -303,55 +326,111 @@ class S3ImageService(object):
                 #              any host.
                 cloud_pk = crypto.key_path(context.project_id)
 
-                dec_filename = os.path.join(image_path, 'image.tar.gz')
-                self._decrypt_image(enc_filename, encrypted_key,
-                                    encrypted_iv, cloud_pk,
-                                    dec_filename)
+                key, iv = self._decrypt_image_key(encrypted_key,
+                                                  encrypted_iv, cloud_pk)
+                decrypter = self._decrypt_image_stream(key, iv)
             except Exception:
-                LOG.exception(_("Failed to decrypt %(image_location)s "
-                                "to %(image_path)s"), log_vars)
-                metadata['properties']['image_state'] = 'failed_decrypt'
-                self.service.update(context, image_uuid, metadata)
+                LOG.exception(_("Failed to decrypt %(image_location)s"),
+                              log_vars)
+                parts.close()
+                _set_image_state('failed_decrypt')
                 return
 
-            metadata['properties']['image_state'] = 'untarring'
-            self.service.update(context, image_uuid, metadata)
+            feeder = eventlet.spawn(self._write_parts, first_part, parts,
+                                    decrypter.stdin)
 
+            # NOTE: from here on the stages overlap. The state moves
+            #       on when the next stage sees its first data.
+            failed_state = None
+            image_file = None
             try:
-                unz_filename = self._untarzip_image(image_path, dec_filename)
+                tar_file = tarfile.open(mode='r|gz',
+                                        fileobj=decrypter.stdout)
+                _set_image_state('untarring')
+                image_file = _ImageReader(
+                        tar_file.extractfile(tar_file.next()))
+                _set_image_state('uploading')
+                self.service.update(context, image_uuid,
+                                    metadata, image_file)
             except Exception:
-                LOG.exception(_("Failed to untar %(image_location)s "
-                                "to %(image_path)s"), log_vars)
-                metadata['properties']['image_state'] = 'failed_untar'
-                self.service.update(context, image_uuid, metadata)
+                if image_file is None or image_file.failed:
+                    LOG.exception(_("Failed to untar %(image_location)s"),
+                                  log_vars)
+                    failed_state = 'failed_untar'
+                else:
+                    LOG.exception(_("Failed to upload %(image_location)s"),
+                                  log_vars)
+                    failed_state = 'failed_upload'
+
+            if failed_state and not feeder.dead:
+                # NOTE: openssl has not seen every part yet, so it cannot
+                #       have found a bad key. Stop fetching the rest.
+                feeder.kill()
+                decrypter.kill()
+                decrypter.wait()
+                _set_image_state(failed_state)
                 return
 
-            metadata['properties']['image_state'] = 'uploading'
-            self.service.update(context, image_uuid, metadata)
+            # NOTE: let openssl finish, so it gets to tell us whether
+            #       decrypting failed. This also lets it flush the tar
+            #       padding.
+            while decrypter.stdout.read(65536):
+                pass
             try:
-                with open(unz_filename) as image_file:
-                    self.service.update(context, image_uuid,
-                                        metadata, image_file)
-            except Exception:
-                LOG.exception(_("Failed to upload %(image_location)s "
-                                "to %(image_path)s"), log_vars)
-                metadata['properties']['image_state'] = 'failed_upload'
-                self.service.update(context, image_uuid, metadata)
+                downloaded = feeder.wait()
+            except IOError:
+                # NOTE: openssl went away before reading everything
+                downloaded = True
+            err = decrypter.stderr.read()
+            decrypter.wait()
+
+            # NOTE: a failure early in the pipeline breaks the stages
+            #       after it, so report the earliest one.
+            if not downloaded:
+                failed_state = 'failed_download'
+            elif decrypter.returncode or err:
+                LOG.error(_("Failed to decrypt %(image_location)s: "
+                            "%(err)s"), dict(log_vars, err=err))
+                failed_state = 'failed_decrypt'
+            if failed_state:
+                _set_image_state(failed_state)
                 return
 
-            metadata['properties']['image_state'] = 'available'
             metadata['status'] = 'active'
-            self.service.update(context, image_uuid, metadata)
-
-            shutil.rmtree(image_path)
+            _set_image_state('available')
+            LOG.info(_("%(image_location)s registered in %(elapsed).2f "
+                       "seconds"),
+                     dict(log_vars, elapsed=time.time() - started_at))
 
         eventlet.spawn_n(delayed_create)
 
         return image
 
     @staticmethod
-    def _decrypt_image(encrypted_filename, encrypted_key, encrypted_iv,
-                       cloud_private_key, decrypted_filename):
+    def _write_parts(first_part, parts, stream):
+        """Writes the parts to stream and closes it.
+
+        Returns False if downloading a part failed. Writing to a stream
+        that was closed on the other end raises IOError.
+
+        """
+        try:
+            stream.write(first_part)
+            while True:
+                try:
+                    part = parts.next()
+                except StopIteration:
+                    return True
+                except Exception:
+                    LOG.exception(_("Failed to download image part"))
+                    return False
+                stream.write(part)
+        finally:
+            parts.close()
+            stream.close()
+
+    @staticmethod
+    def _decrypt_image_key(encrypted_key, encrypted_iv, cloud_private_key):
         key, err = utils.execute('openssl',
                                  'rsautl',
                                  '-decrypt',
@@ -370,24 +449,36 @@ class S3ImageService(object):
         if err:
             raise exception.Error(_('Failed to decrypt initialization '
                                     'vector: %s') % err)
-
-        _out, err = utils.execute('openssl', 'enc',
-                                  '-d', '-aes-128-cbc',
-                                  '-in', '%s' % (encrypted_filename,),
-                                  '-K', '%s' % (key,),
-                                  '-iv', '%s' % (iv,),
-                                  '-out', '%s' % (decrypted_filename,),
-                                  check_exit_code=False)
-        if err:
-            raise exception.Error(_('Failed to decrypt image file '
-                                    '%(image_file)s: %(err)s') %
-                                    {'image_file': encrypted_filename,
-                                     'err': err})
+        return key, iv
 
     @staticmethod
-    def _untarzip_image(path, filename):
-        tar_file = tarfile.open(filename, 'r|gz')
-        tar_file.extractall(path)
-        image_file = tar_file.getnames()[0]
-        tar_file.close()
-        return os.path.join(path, image_file)
+    def _decrypt_image_stream(key, iv):
+        """Starts openssl decrypting its stdin to its stdout."""
+        cmd = ('openssl', 'enc', '-d', '-aes-128-cbc',
+               '-K', '%s' % (key,), '-iv', '%s' % (iv,))
+        LOG.debug(_('Running cmd (subprocess): %s'), ' '.join(cmd[:4]))
+        return subprocess.Popen(cmd,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                close_fds=True)
+
+
+class _ImageReader(object):
+    """Reads the image out of the tar stream.
+
+    Remembers when reading fails, so that a broken tar stream is not
+    reported as a failed upload.
+
+    """
+
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.failed = False
+
+    def read(self, size=None):
+        try:
+            return self.file_obj.read(size)
+        except Exception:
+            self.failed = True
+            raise
@@ -24,11 +24,20 @@ from nova import flags
 from nova import log as logging
 from nova import rpc
 from nova.rpc import common as rpc_common
+from nova import utils
 
 
 FLAGS = flags.FLAGS
+flags.DEFINE_integer('network_info_cache_ttl', 600,
+                     'Seconds to trust the network info cached for an '
+                     'instance, 0 to always ask the network manager')
 LOG = logging.getLogger('nova.network')
 
+# NOTE: bump this whenever the layout of the network info returned
+#       by the network manager changes, so that cached copies written
+#       by older code are ignored.
+NW_INFO_CACHE_VERSION = 1
+
 
 class API(base.Base):
     """API for interacting with the network manager."""
@@ -152,6 +161,9 @@ class API(base.Base):
 
     def get_instance_nw_info(self, context, instance):
         """Returns all network info related to an instance."""
+        network_info = self._get_cached_nw_info(context, instance)
+        if network_info is not None:
+            return network_info
         args = {'instance_id': instance['id'],
                 'instance_type_id': instance['instance_type_id'],
                 'host': instance['host']}
@@ -175,6 +187,33 @@ class API(base.Base):
                 raise exception.InstanceNotFound(instance_id=instance['id'])
             raise
 
+    def _get_cached_nw_info(self, context, instance):
+        """Returns the network info cached for instance by the network
+        manager, or None if there is none or it is stale."""
+        if FLAGS.network_info_cache_ttl <= 0:
+            return None
+        info_cache = self.db.instance_info_cache_get(context, instance['id'])
+        if not info_cache or not info_cache['network_info']:
+            return None
+        # NOTE: the ttl bounds how long changes that don't
+        #       invalidate the cache take to show up
+        if utils.is_older_than(info_cache['created_at'],
+                               FLAGS.network_info_cache_ttl):
+            return None
+        try:
+            record = utils.loads(info_cache['network_info'])
+        except ValueError:
+            LOG.warn(_('Ignoring unreadable network info cache for '
+                       'instance %s'), instance['id'])
+            return None
+        # NOTE: network info depends on the host and instance type
+        #       it was built for, so a cache built for others is stale
+        if (record.get('version') != NW_INFO_CACHE_VERSION or
+            record.get('host') != instance['host'] or
+            record.get('instance_type_id') != instance['instance_type_id']):
+            return None
+        return record['network_info']
+
     def validate_networks(self, context, requested_networks):
         """validate the networks passed at the time of creating
         the server
@@ -19,10 +19,13 @@
 """Implements vlans, bridges, and iptables rules using linux utilities."""
 
 import calendar
+import datetime
 import inspect
 import netaddr
 import os
 
+from eventlet import greenthread
+
 from nova import db
 from nova import exception
 from nova import flags
@@ -70,6 +73,16 @@ flags.DEFINE_bool('send_arp_for_ha', False,
 flags.DEFINE_bool('use_single_default_gateway',
                    False, 'Use single default gateway. Only first nic of vm'
                           ' will get default gateway from dhcp server')
+flags.DEFINE_float('iptables_apply_delay', 0.05,
+                   'Seconds to wait for more rule changes before applying '
+                   'iptables rules, so that they share one restore')
+flags.DEFINE_float('dhcp_hup_delay', 0.1,
+                   'Seconds to wait for more dhcp host changes before '
+                   'signalling dnsmasq, so that they share one HUP')
+flags.DEFINE_integer('dhcp_update_margin', 10,
+                     'Seconds a dhcp host update looks back past the '
+                     'previous one for changed fixed ips, to allow for '
+                     'clock skew and transactions that were in flight')
 binary_name = os.path.basename(inspect.stack()[-1][1])
 
 
@@ -111,6 +124,8 @@ class IptablesTable(object):
         self.rules = []
         self.chains = set()
         self.unwrapped_chains = set()
+        # Set whenever the table changes, cleared once it has been applied.
+        self.dirty = True
 
     def add_chain(self, name, wrap=True):
         """Adds a named chain to the table.
@@ -125,9 +140,13 @@ class IptablesTable(object):
 
         """
         if wrap:
-            self.chains.add(name)
+            chain_set = self.chains
         else:
-            self.unwrapped_chains.add(name)
+            chain_set = self.unwrapped_chains
+
+        if name not in chain_set:
+            chain_set.add(name)
+            self.dirty = True
 
     def remove_chain(self, name, wrap=True):
         """Remove named chain.
@@ -149,14 +168,15 @@ class IptablesTable(object):
             return
 
         chain_set.remove(name)
-        self.rules = filter(lambda r: r.chain != name, self.rules)
 
         if wrap:
             jump_snippet = '-j %s-%s' % (binary_name, name)
         else:
             jump_snippet = '-j %s' % (name,)
 
-        self.rules = filter(lambda r: jump_snippet not in r.rule, self.rules)
+        self.rules = [r for r in self.rules
+                      if r.chain != name and jump_snippet not in r.rule]
+        self.dirty = True
 
     def add_rule(self, chain, rule, wrap=True, top=False):
         """Add a rule to the table.
@@ -176,6 +196,7 @@ class IptablesTable(object):
             rule = ' '.join(map(self._wrap_target_chain, rule.split(' ')))
 
         self.rules.append(IptablesRule(chain, rule, wrap, top))
+        self.dirty = True
 
     def _wrap_target_chain(self, s):
         if s.startswith('$'):
@@ -192,6 +213,7 @@ class IptablesTable(object):
         """
         try:
             self.rules.remove(IptablesRule(chain, rule, wrap, top))
+            self.dirty = True
         except ValueError:
             LOG.debug(_('Tried to remove rule that was not there:'
                         ' %(chain)r %(rule)r %(wrap)r %(top)r'),
@@ -200,10 +222,11 @@ class IptablesTable(object):
 
     def empty_chain(self, chain, wrap=True):
         """Remove all rules from a chain."""
-        chained_rules = [rule for rule in self.rules
-                              if rule.chain == chain and rule.wrap == wrap]
-        for rule in chained_rules:
-            self.rules.remove(rule)
+        rules = [rule for rule in self.rules
+                      if rule.chain != chain or rule.wrap != wrap]
+        if len(rules) != len(self.rules):
+            self.rules = rules
+            self.dirty = True
 
 
 class IptablesManager(object):
@@ -227,6 +250,9 @@ class IptablesManager(object):
     wrapped in the same was as the built-in filter chains. Additionally,
     there's a snat chain that is applied after the POSTROUTING chain.
 
+    Only tables that changed since they were last applied are saved and
+    restored.
+
     """
 
     def __init__(self, execute=None):
@@ -288,10 +314,23 @@ class IptablesManager(object):
         self.ipv4['nat'].add_chain('float-snat')
         self.ipv4['nat'].add_rule('snat', '-j $float-snat')
 
-    @utils.synchronized('iptables', external=True)
     def apply(self):
         """Apply the current in-memory set of iptables rules.
 
+        Waits iptables_apply_delay seconds first, so that rule changes
+        made by other greenthreads in the meantime go out in the same
+        restore. Returns once our changes are in place, whether this call
+        or another one applied them.
+
+        """
+        if FLAGS.iptables_apply_delay:
+            greenthread.sleep(FLAGS.iptables_apply_delay)
+        self._apply()
+
+    @utils.synchronized('iptables', external=True)
+    def _apply(self):
+        """Restore the tables that changed since they were last applied.
+
         This will blow away any rules left over from previous runs of the
         same component of Nova, and replace them with our current set of
         rules. This happens atomically, thanks to iptables-restore.
@@ -303,16 +342,25 @@ class IptablesManager(object):
 
         for cmd, tables in s:
             for table in tables:
+                if not tables[table].dirty:
+                    continue
                 current_table, _ = self.execute('%s-save' % (cmd,),
                                                 '-t', '%s' % (table,),
                                                 run_as_root=True,
                                                 attempts=5)
                 current_lines = current_table.split('\n')
+                # Changes made from here on are not part of this restore
+                # and mark the table dirty again.
+                tables[table].dirty = False
                 new_filter = self._modify_rules(current_lines,
                                                 tables[table])
-                self.execute('%s-restore' % (cmd,), run_as_root=True,
-                             process_input='\n'.join(new_filter),
-                             attempts=5)
+                try:
+                    self.execute('%s-restore' % (cmd,), run_as_root=True,
+                                 process_input='\n'.join(new_filter),
+                                 attempts=5)
+                except Exception:
+                    tables[table].dirty = True
+                    raise
         LOG.debug("IPTablesManager.Apply completed with succeess")
 
     def _modify_rules(self, current_lines, table, binary=None):
@@ -335,16 +383,19 @@ class IptablesManager(object):
                     break
 
         our_rules = []
+        top_rules = set()
         for rule in rules:
             rule_str = str(rule)
             if rule.top:
-                # rule.top == True means we want this rule to be at the top.
-                # Further down, we weed out duplicates from the bottom of the
-                # list, so here we remove the dupes ahead of time.
-                new_filter = filter(lambda s: s.strip() != rule_str.strip(),
-                                    new_filter)
+                top_rules.add(rule_str.strip())
             our_rules += [rule_str]
 
+        # rule.top == True means we want this rule to be at the top.
+        # Further down, we weed out duplicates from the bottom of the
+        # list, so here we remove the dupes ahead of time.
+        if top_rules:
+            new_filter = [s for s in new_filter if s.strip() not in top_rules]
+
         new_filter[rules_index:rules_index] = our_rules
 
         new_filter[rules_index:rules_index] = [':%s - [0:0]' % \
@@ -568,28 +619,113 @@ def _add_dnsmasq_accept_rules(dev):
 
 def get_dhcp_opts(context, network_ref):
     """Get network's hosts config in dhcp-opts format."""
-    hosts = []
     ips_ref = db.network_get_associated_fixed_ips(context, network_ref['id'])
+    return '\n'.join(opts for _address, opts in
+                     _dhcp_opts_for(context, ips_ref))
+
+
+def _dhcp_opts_for(context, fixed_ip_refs):
+    """Return (address, dhcp-opts entry) for each of fixed_ip_refs that
+    is not on the network its instance gets the default gateway from."""
+    instance_ids = set([fixed_ip_ref['instance_id']
+                        for fixed_ip_ref in fixed_ip_refs])
+    vifs = db.virtual_interface_get_by_instances(context, list(instance_ids))
+    default_gw_network_node = {}
+    for vif in sorted(vifs, key=lambda vif: vif['id']):
+        #offer a default gateway to the first virtual interface
+        default_gw_network_node.setdefault(vif['instance_id'],
+                                           vif['network_id'])
+
+    hosts = []
+    for fixed_ip_ref in fixed_ip_refs:
+        instance_id = fixed_ip_ref['instance_id']
+        if instance_id in default_gw_network_node:
+            target_network_id = default_gw_network_node[instance_id]
+            # we don't want default gateway for this fixed ip
+            if target_network_id != fixed_ip_ref['network_id']:
+                hosts.append((fixed_ip_ref['address'],
+                              _host_dhcp_opts(fixed_ip_ref)))
+    return hosts
+
+
+class DhcpHosts(object):
+    """The dhcp-host and dhcp-opts entries of a device's dnsmasq.
+
+    The entries are kept in memory, keyed by address, so that after the
+    first update only the fixed ips updated since the previous one are
+    read from the db.
+
+    """
+
+    def __init__(self):
+        self.hosts = {}
+        self.opts = {}
+        self.updated_at = None
+        # Set whenever the files change, cleared once dnsmasq has been
+        # (re)started or HUPed to pick them up.
+        self.dirty = True
+
+    def update(self, context, network_ref):
+        """Apply the fixed ips updated since the last update.
+
+        Returns whether the entries changed.
+
+        """
+        now = utils.utcnow()
+        if self.updated_at is None:
+            changed_ips = db.network_get_associated_fixed_ips(
+                    context, network_ref['id'])
+        else:
+            since = self.updated_at - datetime.timedelta(
+                    seconds=FLAGS.dhcp_update_margin)
+            changed_ips = db.network_get_fixed_ips_updated_since(
+                    context, network_ref['id'], since)
+
+        hosts = dict(self.hosts)
+        opts = dict(self.opts)
+        fixed_ip_refs = []
+        for fixed_ip_ref in changed_ips:
+            hosts.pop(fixed_ip_ref['address'], None)
+            opts.pop(fixed_ip_ref['address'], None)
+            if self._is_served(network_ref, fixed_ip_ref):
+                fixed_ip_refs.append(fixed_ip_ref)
+
+        for fixed_ip_ref in fixed_ip_refs:
+            hosts[fixed_ip_ref['address']] = _host_dhcp(fixed_ip_ref)
+        if FLAGS.use_single_default_gateway and fixed_ip_refs:
+            opts.update(_dhcp_opts_for(context, fixed_ip_refs))
+
+        changed = (self.updated_at is None or
+                   hosts != self.hosts or opts != self.opts)
+        self.hosts = hosts
+        self.opts = opts
+        self.updated_at = now
+        return changed
+
+    def _is_served(self, network_ref, fixed_ip_ref):
+        if self.updated_at is not None:
+            # NOTE: the changed ips include the disassociated and
+            #       deleted ones, which are only there for removal
+            if (fixed_ip_ref['instance_id'] is None or
+                fixed_ip_ref['virtual_interface_id'] is None or
+                fixed_ip_ref['deleted']):
+                return False
+        host = fixed_ip_ref['instance']['host']
+        return not (network_ref['multi_host'] and FLAGS.host != host)
+
+    def hosts_text(self):
+        return self._text(self.hosts)
+
+    def opts_text(self):
+        return self._text(self.opts)
+
+    def _text(self, entries):
+        return '\n'.join(entries[address] for address in
+                         sorted(entries, key=netaddr.IPAddress))
 
-    if ips_ref:
-        #set of instance ids
-        instance_set = set([fixed_ip_ref['instance_id']
-                            for fixed_ip_ref in ips_ref])
-        default_gw_network_node = {}
-        for instance_id in instance_set:
-            vifs = db.virtual_interface_get_by_instance(context, instance_id)
-            if vifs:
-                #offer a default gateway to the first virtual interface
-                default_gw_network_node[instance_id] = vifs[0]['network_id']
-
-        for fixed_ip_ref in ips_ref:
-            instance_id = fixed_ip_ref['instance_id']
-            if instance_id in default_gw_network_node:
-                target_network_id = default_gw_network_node[instance_id]
-                # we don't want default gateway for this fixed ip
-                if target_network_id != fixed_ip_ref['network_id']:
-                    hosts.append(_host_dhcp_opts(fixed_ip_ref))
-    return '\n'.join(hosts)
+
+# NOTE: the host entries of each device, see update_dhcp
+_dhcp_hosts = {}
 
 
 def release_dhcp(dev, address, mac_address):
@@ -597,10 +733,44 @@ def release_dhcp(dev, address, mac_address):
 
 
 def update_dhcp(context, dev, network_ref):
-    conffile = _dhcp_file(dev, 'conf')
-    with open(conffile, 'w') as f:
-        f.write(get_dhcp_hosts(context, network_ref))
-    restart_dhcp(dev, network_ref)
+    """Bring the dnsmasq host entries of dev up to date with the db and
+    make sure dnsmasq serves them.
+
+    Only the fixed ips updated since the previous update are read, and
+    the hosts and opts files are replaced and dnsmasq HUPed only if an
+    entry changed.  The HUP waits dhcp_hup_delay seconds first, so that
+    concurrent updates share it.
+
+    """
+    hosts = _update_dhcp_hosts(context, dev, network_ref)
+    if not hosts.dirty:
+        return
+
+    if FLAGS.dhcp_hup_delay:
+        greenthread.sleep(FLAGS.dhcp_hup_delay)
+    _restart_dhcp_if_dirty(dev, network_ref)
+
+
+@utils.synchronized('dnsmasq_hosts')
+def _update_dhcp_hosts(context, dev, network_ref):
+    hosts = _dhcp_hosts.setdefault(dev, DhcpHosts())
+    if hosts.update(context, network_ref):
+        _write_file_atomically(_dhcp_file(dev, 'conf'), hosts.hosts_text())
+        if FLAGS.use_single_default_gateway:
+            _write_file_atomically(_dhcp_file(dev, 'opts'),
+                                   hosts.opts_text())
+        hosts.dirty = True
+    return hosts
+
+
+def _write_file_atomically(path, data):
+    """Replace path with data, so that readers see either file whole."""
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+    # Make sure dnsmasq can actually read it (it setuid()s to "nobody")
+    os.chmod(tmp_path, 0644)
+    os.rename(tmp_path, path)
 
 
 def update_dhcp_hostfile_with_text(dev, hosts_text):
@@ -625,13 +795,31 @@ def restart_dhcp(dev, network_ref):
     signal causing it to reload, otherwise spawn a new instance.
 
     """
+    _restart_dhcp(dev, network_ref)
+
+
+@utils.synchronized('dnsmasq_start')
+def _restart_dhcp_if_dirty(dev, network_ref):
+    """(Re)starts dnsmasq unless another update already did since the
+    host entries of dev last changed."""
+    hosts = _dhcp_hosts[dev]
+    if not hosts.dirty:
+        return
+    hosts.dirty = False
+    try:
+        _restart_dhcp(dev, network_ref)
+    except Exception:
+        hosts.dirty = True
+        raise
+
+
+def _restart_dhcp(dev, network_ref):
     conffile = _dhcp_file(dev, 'conf')
 
     if FLAGS.use_single_default_gateway:
         optsfile = _dhcp_file(dev, 'opts')
-        with open(optsfile, 'w') as f:
-            f.write(get_dhcp_opts(context, network_ref))
-        os.chmod(optsfile, 0644)
+        if not os.path.exists(optsfile):
+            _write_file_atomically(optsfile, '')
 
     # Make sure dnsmasq can actually read it (it setuid()s to "nobody")
     os.chmod(conffile, 0644)
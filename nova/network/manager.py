@@ -51,6 +51,7 @@ import netaddr
 import random
 import re
 import socket
+import struct
 from eventlet import greenpool
 
 from nova.compute import api as compute_api
@@ -118,6 +119,56 @@ flags.DEFINE_string('dhcp_domain',
                     'domain to use for building the hostnames')
 
 
+# NOTE: the start of an IPv4 address, dots may be escaped and it may
+#       be anchored at either end like a regex
+_IPV4_PREFIX_RE = re.compile(r'^\^?((?:\d{1,3}\\?\.){0,3})(\d{0,3})(\$?)$')
+
+
+def _valid_octet(octet):
+    return octet == '0' or (not octet.startswith('0') and int(octet) < 256)
+
+
+def _ipv4_prefix_ranges(prefix, exact=False):
+    """Return the (first, last) ranges of packed IPv4 addresses starting
+    with prefix, or the one matching it if exact or anchored with a '$'.
+
+    Returns None if prefix is a regex rather than the start of an address.
+
+    """
+    match = _IPV4_PREFIX_RE.match(prefix)
+    if not match:
+        return None
+    octets = match.group(1).replace('\\', '').split('.')[:-1]
+    partial = match.group(2)
+    if exact or match.group(3):
+        if len(octets) != 3 or not partial:
+            return None
+        exact = True
+    if not all(_valid_octet(octet) for octet in octets):
+        return []
+
+    if not partial:
+        spans = [(0, 255)]
+    else:
+        spans = []
+        if _valid_octet(partial):
+            spans.append((int(partial), int(partial)))
+        if not exact and not partial.startswith('0'):
+            # NOTE: the octet may go on for one or two more digits
+            for width in (10, 100):
+                first = int(partial) * width
+                if first < 256:
+                    spans.append((first, min(first + width - 1, 255)))
+
+    shift = 8 * (3 - len(octets))
+    base = 0
+    for octet in octets:
+        base = base << 8 | int(octet)
+    base <<= shift + 8
+    return [(base | first << shift, base | ((last + 1) << shift) - 1)
+            for first, last in spans]
+
+
 class AddressAlreadyAllocated(exception.Error):
     """Address was already allocated."""
     pass
@@ -340,6 +391,8 @@ class FloatingIP(object):
             raise exception.FloatingIpAssociated(address=floating_address)
 
         fixed_ip = self.db.fixed_ip_get_by_address(context, fixed_address)
+        self.db.instance_info_cache_invalidate(context,
+                                               fixed_ip['instance_id'])
 
         # send to correct host, unless i'm the correct host
         if fixed_ip['network']['multi_host']:
@@ -393,6 +446,8 @@ class FloatingIP(object):
             raise exception.FloatingIpNotAssociated(address=floating_address)
 
         fixed_ip = self.db.fixed_ip_get(context, floating_ip['fixed_ip_id'])
+        self.db.instance_info_cache_invalidate(context,
+                                               fixed_ip['instance_id'])
 
         # send to correct host, unless i'm the correct host
         if fixed_ip['network']['multi_host']:
@@ -542,45 +597,41 @@ class NetworkManager(manager.SchedulerDependentManager):
         return []
 
     def get_instance_uuids_by_ip_filter(self, context, filters):
-        fixed_ip_filter = filters.get('fixed_ip')
-        ip_filter = re.compile(str(filters.get('ip')))
-        ipv6_filter = re.compile(str(filters.get('ip6')))
+        """Returns the instances with an address matching filters.
 
-        # NOTE(jkoelker) Should probably figure out a better way to do
-        #                this. But for now it "works", this could suck on
-        #                large installs.
+        fixed_ip is an exact fixed address.  ip and ip6 are regexes
+        matched against the start of the fixed and floating IPv4 addresses
+        and of the fixed IPv6 ones.  An ip that is the start of an address,
+        or an ip6 that is a whole address, is looked up in the db's index,
+        only other regexes scan every address.
 
-        vifs = self.db.virtual_interface_get_all(context)
+        """
         results = []
 
-        for vif in vifs:
-            if vif['instance_id'] is None:
-                continue
-
-            fixed_ipv6 = vif.get('fixed_ipv6')
-            if fixed_ipv6 and ipv6_filter.match(fixed_ipv6):
-                # NOTE(jkoelker) Will need to update for the UUID flip
-                results.append({'instance_id': vif['instance_id'],
-                                'ip': fixed_ipv6})
-
-            for fixed_ip in vif['fixed_ips']:
-                if not fixed_ip or not fixed_ip['address']:
-                    continue
-                if fixed_ip['address'] == fixed_ip_filter:
-                    results.append({'instance_id': vif['instance_id'],
-                                    'ip': fixed_ip['address']})
-                    continue
-                if ip_filter.match(fixed_ip['address']):
-                    results.append({'instance_id': vif['instance_id'],
-                                    'ip': fixed_ip['address']})
-                    continue
-                for floating_ip in fixed_ip.get('floating_ips', []):
-                    if not floating_ip or not floating_ip['address']:
-                        continue
-                    if ip_filter.match(floating_ip['address']):
-                        results.append({'instance_id': vif['instance_id'],
-                                        'ip': floating_ip['address']})
-                        continue
+        fixed_ip_filter = filters.get('fixed_ip')
+        if fixed_ip_filter:
+            ranges = _ipv4_prefix_ranges(fixed_ip_filter, exact=True)
+            results.extend(self._get_instances_by_ipv4_ranges(
+                    context, ranges or [], floating=False))
+
+        ip_filter = filters.get('ip')
+        if ip_filter:
+            ranges = _ipv4_prefix_ranges(ip_filter)
+            if ranges is not None:
+                results.extend(self._get_instances_by_ipv4_ranges(context,
+                                                                  ranges))
+            else:
+                results.extend(self._scan_instances_by_ipv4(
+                        context, re.compile(ip_filter)))
+
+        ipv6_filter = filters.get('ip6')
+        if ipv6_filter:
+            if netaddr.valid_ipv6(ipv6_filter):
+                results.extend(self._get_instances_by_ipv6(context,
+                                                           ipv6_filter))
+            else:
+                results.extend(self._scan_instances_by_ipv6(
+                        context, re.compile(ipv6_filter)))
 
         # NOTE(jkoelker) Until we switch over to instance_uuid ;)
         ids = [res['instance_id'] for res in results]
@@ -589,6 +640,65 @@ class NetworkManager(manager.SchedulerDependentManager):
             res['instance_uuid'] = uuid_map.get(res['instance_id'])
         return results
 
+    def _get_instances_by_ipv4_ranges(self, context, ranges, floating=True):
+        results = []
+        fixed_addresses = set()
+        for fixed_ip in self.db.fixed_ip_get_by_address_ranges(context,
+                                                               ranges):
+            fixed_addresses.add(fixed_ip['address'])
+            results.append({'instance_id': fixed_ip['instance_id'],
+                            'ip': fixed_ip['address']})
+        if not floating:
+            return results
+
+        for floating_ip in self.db.floating_ip_get_by_address_ranges(context,
+                                                                     ranges):
+            fixed_ip = floating_ip['fixed_ip']
+            # NOTE: an instance matching by its fixed ip isn't listed
+            #       again for the floating ips of that fixed ip
+            if (fixed_ip['address'] in fixed_addresses or
+                fixed_ip['instance_id'] is None or
+                fixed_ip['virtual_interface_id'] is None or
+                fixed_ip['deleted']):
+                continue
+            results.append({'instance_id': fixed_ip['instance_id'],
+                            'ip': floating_ip['address']})
+        return results
+
+    def _scan_instances_by_ipv4(self, context, ip_filter):
+        results = []
+        fixed_addresses = set()
+        for instance_id, address, floating_address in \
+                self.db.fixed_ip_get_all_addresses(context):
+            if ip_filter.match(address):
+                if address not in fixed_addresses:
+                    fixed_addresses.add(address)
+                    results.append({'instance_id': instance_id,
+                                    'ip': address})
+            elif floating_address and ip_filter.match(floating_address):
+                results.append({'instance_id': instance_id,
+                                'ip': floating_address})
+        return results
+
+    def _get_instances_by_ipv6(self, context, address):
+        address = netaddr.IPAddress(address)
+        try:
+            vif_address = ipv6.to_mac(str(address))
+        except (netaddr.AddrFormatError, TypeError, ValueError):
+            return []
+        return [{'instance_id': instance_id, 'ip': fixed_ipv6}
+                for instance_id, fixed_ipv6 in
+                self.db.virtual_interface_get_ipv6_addresses(context,
+                                                             vif_address)
+                if netaddr.IPAddress(fixed_ipv6) == address]
+
+    def _scan_instances_by_ipv6(self, context, ipv6_filter):
+        # NOTE(jkoelker) Will need to update for the UUID flip
+        return [{'instance_id': instance_id, 'ip': fixed_ipv6}
+                for instance_id, fixed_ipv6 in
+                self.db.virtual_interface_get_ipv6_addresses(context)
+                if ipv6_filter.match(fixed_ipv6)]
+
     def _get_networks_for_instance(self, context, instance_id, project_id,
                                    requested_networks=None):
         """Determine & return which networks an instance should connect to."""
@@ -651,6 +761,7 @@ class NetworkManager(manager.SchedulerDependentManager):
 
         # deallocate vifs (mac addresses)
         self.db.virtual_interface_delete_by_instance(context, instance_id)
+        self.db.instance_info_cache_delete(context, instance_id)
 
     def get_instance_nw_info(self, context, instance_id,
                              instance_type_id, host):
@@ -661,14 +772,29 @@ class NetworkManager(manager.SchedulerDependentManager):
         :returns: network info list [(network,info),(network,info)...]
         where network = dict containing pertinent data from a network db object
         and info = dict containing pertinent networking data
+
+        The network info is also cached for the instance, see
+        network_api.API.get_instance_nw_info.
         """
-        # TODO(tr3buchet) should handle floating IPs as well?
-        try:
-            fixed_ips = self.db.fixed_ip_get_by_instance(context, instance_id)
-        except exception.FixedIpNotFoundForInstance:
-            LOG.warn(_('No fixed IPs for instance %s'), instance_id)
-            fixed_ips = []
+        # NOTE: if the cache is invalidated while this is being
+        #       built, what is built may be stale, so don't write it
+        info_cache = self.db.instance_info_cache_get(context, instance_id)
+        generation = info_cache and info_cache['id'] or 0
+        network_info = self._build_instance_nw_info(context, instance_id,
+                                                    instance_type_id, host)
+        record = {'version': network_api.NW_INFO_CACHE_VERSION,
+                  'host': host,
+                  'instance_type_id': instance_type_id,
+                  'network_info': network_info}
+        self.db.instance_info_cache_update(context, instance_id,
+                {'network_info': utils.dumps(record)}, generation)
+        return network_info
 
+    def _build_instance_nw_info(self, context, instance_id,
+                                instance_type_id, host):
+        # TODO(tr3buchet) should handle floating IPs as well?
+        # NOTE: the vifs come with their network and fixed ips
+        #       joined in, so that is all one query
         vifs = self.db.virtual_interface_get_by_instance(context, instance_id)
         instance_type = instance_types.get_instance_type(instance_type_id)
         network_info = []
@@ -681,8 +807,8 @@ class NetworkManager(manager.SchedulerDependentManager):
                 continue
 
             # determine which of the instance's IPs belong to this network
-            network_IPs = [fixed_ip['address'] for fixed_ip in fixed_ips if
-                           fixed_ip['network_id'] == network['id']]
+            network_IPs = [fixed_ip['address'] for fixed_ip in vif['fixed_ips']
+                           if not fixed_ip['deleted']]
 
             # TODO(tr3buchet) eventually "enabled" should be determined
             def ip_dict(ip):
@@ -807,6 +933,7 @@ class NetworkManager(manager.SchedulerDependentManager):
             values = {'allocated': True,
                       'virtual_interface_id': vif['id']}
             self.db.fixed_ip_update(context, address, values)
+            self.db.instance_info_cache_invalidate(context, instance_id)
 
         self._setup_network(context, network)
         return address
@@ -819,6 +946,7 @@ class NetworkManager(manager.SchedulerDependentManager):
         fixed_ip_ref = self.db.fixed_ip_get_by_address(context, address)
         instance_ref = fixed_ip_ref['instance']
         instance_id = instance_ref['id']
+        self.db.instance_info_cache_invalidate(context, instance_id)
         self._do_trigger_security_group_members_refresh_for_instance(
                                                                    instance_id)
         if FLAGS.force_dhcp_release:
@@ -887,8 +1015,6 @@ class NetworkManager(manager.SchedulerDependentManager):
         if cidr:
             fixed_net_v4 = netaddr.IPNetwork(cidr)
             prefixlen_v4 = 32 - subnet_bits
-            subnets_v4 = list(fixed_net_v4.subnet(prefixlen_v4,
-                                                  count=num_networks))
 
             # NOTE(jkoelker): This replaces the _validate_cidrs call and
             #                 prevents looping multiple times
@@ -896,42 +1022,10 @@ class NetworkManager(manager.SchedulerDependentManager):
                 nets = self.db.network_get_all(context)
             except exception.NoNetworksFound:
                 nets = []
-            used_subnets = [netaddr.IPNetwork(net['cidr']) for net in nets]
-
-            def find_next(subnet):
-                next_subnet = subnet.next()
-                while next_subnet in subnets_v4:
-                    next_subnet = next_subnet.next()
-                if next_subnet in fixed_net_v4:
-                    return next_subnet
-
-            for subnet in list(subnets_v4):
-                if subnet in used_subnets:
-                    next_subnet = find_next(subnet)
-                    if next_subnet:
-                        subnets_v4.remove(subnet)
-                        subnets_v4.append(next_subnet)
-                        subnet = next_subnet
-                    else:
-                        raise ValueError(_('cidr already in use'))
-                for used_subnet in used_subnets:
-                    if subnet in used_subnet:
-                        msg = _('requested cidr (%(cidr)s) conflicts with '
-                                'existing supernet (%(super)s)')
-                        raise ValueError(msg % {'cidr': subnet,
-                                                'super': used_subnet})
-                    if used_subnet in subnet:
-                        next_subnet = find_next(subnet)
-                        if next_subnet:
-                            subnets_v4.remove(subnet)
-                            subnets_v4.append(next_subnet)
-                            subnet = next_subnet
-                        else:
-                            msg = _('requested cidr (%(cidr)s) conflicts '
-                                    'with existing smaller cidr '
-                                    '(%(smaller)s)')
-                            raise ValueError(msg % {'cidr': subnet,
-                                                    'smaller': used_subnet})
+            used_subnets = [netaddr.IPNetwork(net['cidr']) for net in nets
+                            if net['cidr']]
+            subnets_v4 = self._find_free_subnets(fixed_net_v4, prefixlen_v4,
+                                                 num_networks, used_subnets)
 
         networks = []
         subnets = itertools.izip_longest(subnets_v4, subnets_v6)
@@ -992,6 +1086,73 @@ class NetworkManager(manager.SchedulerDependentManager):
                 self._create_fixed_ips(context, network['id'])
         return networks
 
+    def _find_free_subnets(self, fixed_net, prefixlen, num_networks,
+                           used_subnets):
+        """Returns the first num_networks subnets of fixed_net with
+        prefixlen that do not overlap any of used_subnets.
+
+        The candidate subnets and the used subnets are walked in address
+        order side by side as integer intervals, so a used subnet is
+        stepped over in one go however many candidates it covers.
+        Candidates that are already in use or that contain a smaller used
+        subnet are skipped, but a candidate inside a larger used subnet
+        is rejected straight away.
+        """
+        size = 2 ** (32 - prefixlen)
+        if num_networks * size > fixed_net.size:
+            raise ValueError(_('Not enough subnets avail to satisfy '
+                               'requested num_networks'))
+
+        used = sorted((net.first, net.last, net) for net in used_subnets
+                      if net.version == 4 and
+                         net.first <= fixed_net.last and
+                         net.last >= fixed_net.first)
+        subnets = []
+        conflict = None
+        index = 0
+        first = fixed_net.first
+        while len(subnets) < num_networks:
+            last = first + size - 1
+            if last > fixed_net.last:
+                break
+            while index < len(used) and used[index][1] < first:
+                index += 1
+            if index < len(used) and used[index][0] <= last:
+                supernet = index
+                while supernet < len(used) and used[supernet][0] <= first:
+                    used_first, used_last, used_subnet = used[supernet]
+                    if (used_last >= last and
+                        (used_first, used_last) != (first, last)):
+                        subnet = netaddr.IPNetwork('%s/%d' % (
+                                netaddr.IPAddress(first), prefixlen))
+                        msg = _('requested cidr (%(cidr)s) conflicts with '
+                                'existing supernet (%(super)s)')
+                        raise ValueError(msg % {'cidr': subnet,
+                                                'super': used_subnet})
+                    supernet += 1
+                used_last, used_subnet = used[index][1:]
+                if not conflict:
+                    conflict = (first, last, used_subnet)
+                # NOTE: skip to the first subnet after the used one
+                first += ((used_last - first) // size + 1) * size
+                continue
+            subnets.append(netaddr.IPNetwork('%s/%d' % (
+                    netaddr.IPAddress(first), prefixlen)))
+            first += size
+
+        if len(subnets) < num_networks:
+            first, last, used_subnet = conflict
+            subnet = netaddr.IPNetwork('%s/%d' % (netaddr.IPAddress(first),
+                                                  prefixlen))
+            if (first, last) == (used_subnet.first, used_subnet.last):
+                raise ValueError(_('cidr already in use'))
+            msg = _('requested cidr (%(cidr)s) conflicts '
+                    'with existing smaller cidr '
+                    '(%(smaller)s)')
+            raise ValueError(msg % {'cidr': subnet,
+                                    'smaller': used_subnet})
+        return subnets
+
     def delete_network(self, context, fixed_range, uuid,
             require_disassociated=True):
 
@@ -1024,17 +1185,21 @@ class NetworkManager(manager.SchedulerDependentManager):
         bottom_reserved = self._bottom_reserved_ips
         top_reserved = self._top_reserved_ips
         project_net = netaddr.IPNetwork(network['cidr'])
-        num_ips = len(project_net)
+        num_ips = project_net.size
+        # NOTE: addresses are counted up from the first one as
+        #       integers, indexing project_net is slow on large nets
         ips = []
-        for index in range(num_ips):
-            address = str(project_net[index])
+        for index in xrange(num_ips):
+            address_int = project_net.first + index
             if index < bottom_reserved or num_ips - index <= top_reserved:
                 reserved = True
             else:
                 reserved = False
 
             ips.append({'network_id': network_id,
-                        'address': address,
+                        'address': socket.inet_ntoa(struct.pack('!I',
+                                                                address_int)),
+                        'address_int': address_int,
                         'reserved': reserved})
         self.db.fixed_ip_bulk_create(context, ips)
 
@@ -1236,6 +1401,7 @@ class VlanManager(RPCAllocateFixedIP, FloatingIP, NetworkManager):
         values = {'allocated': True,
                   'virtual_interface_id': vif['id']}
         self.db.fixed_ip_update(context, address, values)
+        self.db.instance_info_cache_invalidate(context, instance_id)
         self._setup_network(context, network)
         return address
 
@@ -1271,7 +1437,8 @@ class VlanManager(RPCAllocateFixedIP, FloatingIP, NetworkManager):
                   '%(num_networks)s. Network size is %(network_size)s') %
                   kwargs)
 
-        NetworkManager.create_networks(self, context, vpn=True, **kwargs)
+        return NetworkManager.create_networks(self, context, vpn=True,
+                                              **kwargs)
 
     def _setup_network(self, context, network_ref):
         """Sets up network on this host."""
@@ -53,6 +53,8 @@ from nova import wsgi
 FLAGS = flags.FLAGS
 flags.DEFINE_string('buckets_path', '$state_path/buckets',
                     'path to s3 buckets')
+flags.DEFINE_integer('s3_chunk_size', 65536,
+                     'bytes of an object read or written at a time')
 
 
 def get_wsgi_server():
@@ -62,6 +64,20 @@ def get_wsgi_server():
                        host=FLAGS.s3_host)
 
 
+def _file_iter(file_obj, offset, length):
+    """Yield length bytes of file_obj from offset, then close it."""
+    try:
+        file_obj.seek(offset)
+        while length > 0:
+            chunk = file_obj.read(min(FLAGS.s3_chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file_obj.close()
+
+
 class S3Application(wsgi.Router):
     """Implementation of an S3-like storage server based on local files.
 
@@ -147,6 +163,27 @@ class BaseRequestHandler(object):
     def finish(self, body=''):
         self.response.body = utils.utf8(body)
 
+    def finish_file(self, file_obj, offset, length):
+        """Respond with length bytes of file_obj starting at offset, read
+        a chunk at a time as the response is sent.
+        """
+        self.response.app_iter = _file_iter(file_obj, offset, length)
+        self.response.content_length = length
+
+    def iter_body(self):
+        """Yield the request body a chunk at a time."""
+        body_file = self.request.environ['wsgi.input']
+        remaining = self.request.content_length
+        while remaining is None or remaining > 0:
+            chunk_size = FLAGS.s3_chunk_size
+            if remaining is not None:
+                chunk_size = min(chunk_size, remaining)
+                remaining -= chunk_size
+            chunk = body_file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
     def invalid(self, **kwargs):
         pass
 
@@ -305,11 +342,19 @@ class ObjectHandler(BaseRequestHandler):
         self.set_header("Content-Type", "application/unknown")
         self.set_header("Last-Modified", datetime.datetime.utcfromtimestamp(
             info.st_mtime))
-        object_file = open(path, "r")
-        try:
-            self.finish(object_file.read())
-        finally:
-            object_file.close()
+        self.set_header("Accept-Ranges", "bytes")
+        start, end = 0, info.st_size
+        if self.request.range:
+            byte_range = self.request.range.range_for_length(info.st_size)
+            if byte_range is None:
+                self.set_status(416)
+                self.set_header("Content-Range", "bytes */%d" % info.st_size)
+                return
+            start, end = byte_range
+            self.set_status(206)
+            self.set_header("Content-Range", "bytes %d-%d/%d" %
+                            (start, end - 1, info.st_size))
+        self.finish_file(open(path, "rb"), start, end - start)
 
     def put(self, bucket, object_name):
         object_name = urllib.unquote(object_name)
@@ -326,11 +371,15 @@ class ObjectHandler(BaseRequestHandler):
         directory = os.path.dirname(path)
         if not os.path.exists(directory):
             os.makedirs(directory)
-        object_file = open(path, "w")
-        object_file.write(self.request.body)
-        object_file.close()
-        self.set_header('ETag',
-                        '"%s"' % hashlib.md5(self.request.body).hexdigest())
+        md5 = hashlib.md5()
+        object_file = open(path, "wb")
+        try:
+            for chunk in self.iter_body():
+                md5.update(chunk)
+                object_file.write(chunk)
+        finally:
+            object_file.close()
+        self.set_header('ETag', '"%s"' % md5.hexdigest())
         self.finish()
 
     def delete(self, bucket, object_name):
@@ -41,17 +41,21 @@ def create_connection(new=True):
     return get_impl().create_connection(new=new)
 
 
-def call(context, topic, msg):
-    return get_impl().call(context, topic, msg)
+def call(context, topic, msg, timeout=None):
+    return get_impl().call(context, topic, msg, timeout=timeout)
 
 
 def cast(context, topic, msg):
     return get_impl().cast(context, topic, msg)
 
 
+def bulk_cast(context, topic_msgs):
+    return get_impl().bulk_cast(context, topic_msgs)
+
+
 def fanout_cast(context, topic, msg):
     return get_impl().fanout_cast(context, topic, msg)
 
 
-def multicall(context, topic, msg):
-    return get_impl().multicall(context, topic, msg)
+def multicall(context, topic, msg, timeout=None):
+    return get_impl().multicall(context, topic, msg, timeout=timeout)
@@ -8,6 +8,32 @@ flags.DEFINE_integer('rpc_thread_pool_size', 1024,
                              'Size of RPC thread pool')
 flags.DEFINE_integer('rpc_conn_pool_size', 30,
                              'Size of RPC connection pool')
+flags.DEFINE_integer('rpc_response_timeout', None,
+                             'Seconds to wait for a response from a call, '
+                             'unset waits forever')
+flags.DEFINE_bool('rpc_shared_reply_queue', False,
+                  'Have calls wait for their responses on one reply queue '
+                  'per process.  Only turn this on once every service '
+                  'understands it, older ones reply on a queue per call')
+flags.DEFINE_list('rpc_method_concurrency',
+                  ['run_instance:8',
+                   'refresh_security_group_rules:1',
+                   'refresh_security_group_members:1',
+                   'refresh_provider_fw_rules:1'],
+                  'method:limit pairs capping how many messages for a '
+                  'method a service runs at once')
+flags.DEFINE_list('rpc_coalesce_methods',
+                  ['refresh_security_group_rules',
+                   'refresh_security_group_members',
+                   'refresh_provider_fw_rules'],
+                  'Idempotent methods whose casts are dropped when an '
+                  'identical one is already waiting to run')
+flags.DEFINE_integer('rpc_max_queued_messages', 256,
+                     'Messages a service holds back behind method limits '
+                     'before it stops taking more off the queue')
+flags.DEFINE_integer('rpc_prefetch_count', 64,
+                     'Unacknowledged messages the broker may push to a '
+                     'consumer, 0 for no limit')
 
 
 class RemoteError(exception.NovaException):
@@ -26,3 +52,12 @@ class RemoteError(exception.NovaException):
         self.value = value
         self.traceback = traceback
         super(RemoteError, self).__init__(**self.__dict__)
+
+
+class Timeout(exception.NovaException):
+    """Signifies that a timeout has occurred.
+
+    This exception is raised if the rpc_response_timeout is reached while
+    waiting for a response from the remote side.
+    """
+    message = _("Timeout while waiting on RPC response.")
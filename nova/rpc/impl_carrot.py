@@ -43,7 +43,7 @@ from nova import context
 from nova import exception
 from nova import fakerabbit
 from nova import flags
-from nova.rpc.common import RemoteError, LOG
+from nova.rpc.common import RemoteError, Timeout, LOG
 
 # Needed for tests
 eventlet.monkey_patch()
@@ -132,6 +132,10 @@ class Connection(carrot_connection.BrokerConnection):
                 pass
             self._rpc_consumer_thread = None
 
+    def get_dispatch_stats(self):
+        """Carrot consumers don't track the messages they are running."""
+        return {}
+
     def create_consumer(self, topic, proxy, fanout=False):
         """Create a consumer that calls methods in the proxy"""
         if fanout:
@@ -512,8 +516,12 @@ class RpcContext(context.RequestContext):
         msg_reply(self.msg_id, *args, **kwargs)
 
 
-def multicall(context, topic, msg):
-    """Make a call that returns multiple times."""
+def multicall(context, topic, msg, timeout=None):
+    """Make a call that returns multiple times.
+
+    Timeout is how many seconds to wait for each response,
+    rpc_response_timeout by default.
+    """
     LOG.debug(_('Making asynchronous call on %s ...'), topic)
     msg_id = uuid.uuid4().hex
     msg.update({'_msg_id': msg_id})
@@ -522,7 +530,9 @@ def multicall(context, topic, msg):
 
     con_conn = ConnectionPool.get()
     consumer = DirectConsumer(connection=con_conn, msg_id=msg_id)
-    wait_msg = MulticallWaiter(consumer)
+    if timeout is None:
+        timeout = FLAGS.rpc_response_timeout
+    wait_msg = MulticallWaiter(consumer, timeout)
     consumer.register_callback(wait_msg)
 
     publisher = TopicPublisher(connection=con_conn, topic=topic)
@@ -533,8 +543,9 @@ def multicall(context, topic, msg):
 
 
 class MulticallWaiter(object):
-    def __init__(self, consumer):
+    def __init__(self, consumer, timeout):
         self._consumer = consumer
+        self._timeout = timeout
         self._results = queue.Queue()
         self._closed = False
 
@@ -557,12 +568,18 @@ class MulticallWaiter(object):
     def wait(self):
         while True:
             rv = None
+            deadline = None
+            if self._timeout is not None:
+                deadline = time.time() + self._timeout
             while rv is None and not self._closed:
                 try:
                     rv = self._consumer.fetch(enable_callbacks=True)
                 except Exception:
                     self.close()
                     raise
+                if rv is None and deadline and time.time() > deadline:
+                    self.close()
+                    raise Timeout()
                 time.sleep(0.01)
 
             result = self._results.get()
@@ -580,9 +597,9 @@ def create_connection(new=True):
     return Connection.instance(new=new)
 
 
-def call(context, topic, msg):
+def call(context, topic, msg, timeout=None):
     """Sends a message on a topic and wait for a response."""
-    rv = multicall(context, topic, msg)
+    rv = multicall(context, topic, msg, timeout=timeout)
     # NOTE(vish): return the last result from the multicall
     rv = list(rv)
     if not rv:
@@ -600,6 +617,17 @@ def cast(context, topic, msg):
         publisher.close()
 
 
+def bulk_cast(context, topic_msgs):
+    """Sends each (topic, msg) pair without waiting for responses."""
+    LOG.debug(_('Making %d asynchronous casts...'), len(topic_msgs))
+    with ConnectionPool.item() as conn:
+        for topic, msg in topic_msgs:
+            _pack_context(msg, context)
+            publisher = TopicPublisher(connection=conn, topic=topic)
+            publisher.send(msg)
+            publisher.close()
+
+
 def fanout_cast(context, topic, msg):
     """Sends a message on a fanout exchange without waiting for a response."""
     LOG.debug(_('Making asynchronous fanout cast...'))
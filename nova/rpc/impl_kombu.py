@@ -18,7 +18,10 @@ import kombu
 import kombu.entity
 import kombu.messaging
 import kombu.connection
+import collections
 import itertools
+import json
+import socket
 import sys
 import time
 import traceback
@@ -28,12 +31,14 @@ import uuid
 import eventlet
 from eventlet import greenpool
 from eventlet import pools
+from eventlet import queue
+from eventlet import semaphore
 import greenlet
 
 from nova import context
 from nova import exception
 from nova import flags
-from nova.rpc.common import RemoteError, LOG
+from nova.rpc.common import RemoteError, Timeout, LOG
 
 # Needed for tests
 eventlet.monkey_patch()
@@ -213,6 +218,11 @@ class FanoutConsumer(ConsumerBase):
 class Publisher(object):
     """Base Publisher class"""
 
+    @classmethod
+    def cache_key(cls, topic):
+        """Key a Connection caches this kind of publisher for topic by"""
+        return (cls, topic)
+
     def __init__(self, channel, exchange_name, routing_key, **kwargs):
         """Init the Publisher class with the exchange_name, routing_key,
         and other options
@@ -229,7 +239,7 @@ class Publisher(object):
         self.producer = kombu.messaging.Producer(exchange=self.exchange,
                 channel=channel, routing_key=self.routing_key)
 
-    def send(self, msg):
+    def send(self, msg, topic=None):
         """Send a message"""
         self.producer.publish(msg)
 
@@ -254,7 +264,16 @@ class DirectPublisher(Publisher):
 
 
 class TopicPublisher(Publisher):
-    """Publisher class for 'topic'"""
+    """Publisher class for 'topic'
+
+    All topics share the control exchange, so one publisher sends to
+    any topic by routing key.
+    """
+
+    @classmethod
+    def cache_key(cls, topic):
+        return (cls, None)
+
     def __init__(self, channel, topic, **kwargs):
         """init a 'topic' publisher.
 
@@ -270,6 +289,10 @@ class TopicPublisher(Publisher):
                 type='topic',
                 **options)
 
+    def send(self, msg, topic=None):
+        """Send a message to topic, or to the one we were created for"""
+        self.producer.publish(msg, routing_key=topic or self.routing_key)
+
 
 class FanoutPublisher(Publisher):
     """Publisher class for 'fanout'"""
@@ -292,8 +315,14 @@ class FanoutPublisher(Publisher):
 class Connection(object):
     """Connection object."""
 
+    # Publishers for direct replies are keyed by msg_id, so don't let
+    # them pile up.
+    max_cached_publishers = 100
+
     def __init__(self):
         self.consumers = []
+        self.publishers = {}
+        self.proxy_callbacks = {}
         self.consumer_thread = None
         self.max_retries = FLAGS.rabbit_max_retries
         # Try forever?
@@ -356,6 +385,7 @@ class Connection(object):
             consumer.reconnect(self.channel)
         if self.consumers:
             LOG.debug(_("Re-established AMQP queues"))
+        self.publishers = {}
 
     def get_channel(self):
         """Convenience call for bin/clear_rabbit_queues"""
@@ -379,12 +409,17 @@ class Connection(object):
     def reset(self):
         """Reset a connection so it can be used again"""
         self.cancel_consumer_thread()
+        if not self.consumers:
+            # Nothing to tear down, and the publishers on this channel
+            # stay good for the next caller.
+            return
         self.channel.close()
         self.channel = self.connection.channel()
         # work around 'memory' transport bug in 1.1.3
         if self.memory_transport:
             self.channel._new_queue('ae.undeliver')
         self.consumers = []
+        self.publishers = {}
 
     def declare_consumer(self, consumer_cls, topic, callback):
         """Create a Consumer using the class that was passed in and
@@ -399,6 +434,11 @@ class Connection(object):
         """Return an iterator that will consume from all queues/consumers"""
         while True:
             try:
+                if FLAGS.rpc_prefetch_count:
+                    # Stop the broker pushing more at us while the
+                    # callbacks are holding messages back.
+                    self.channel.basic_qos(0, FLAGS.rpc_prefetch_count,
+                                           False)
                 queues_head = self.consumers[:-1]
                 queues_tail = self.consumers[-1]
                 for queue in queues_head:
@@ -424,26 +464,35 @@ class Connection(object):
                 pass
             self.consumer_thread = None
 
+    def get_publisher(self, cls, topic):
+        """Return the publisher of class cls for topic on our channel,
+        declaring its exchange only the first time it is needed.
+        """
+        key = cls.cache_key(topic)
+        publisher = self.publishers.get(key)
+        if publisher is None:
+            if len(self.publishers) >= self.max_cached_publishers:
+                self.publishers.clear()
+            publisher = cls(self.channel, topic)
+            self.publishers[key] = publisher
+        return publisher
+
     def publisher_send(self, cls, topic, msg):
         """Send to a publisher based on the publisher class"""
         while True:
-            publisher = None
             try:
-                publisher = cls(self.channel, topic)
-                publisher.send(msg)
+                self.get_publisher(cls, topic).send(msg, topic)
                 return
             except self.connection.connection_errors, e:
                 LOG.exception(_('Failed to publish message %s' % str(e)))
                 try:
                     self.reconnect()
-                    if publisher:
-                        publisher.reconnect(self.channel)
                 except self.connection.connection_errors, e:
                     pass
 
     def declare_direct_consumer(self, topic, callback):
         """Create a 'direct' queue.
-        In nova's use, this is generally a msg_id queue used for
+        In nova's use, this is generally the reply queue used for
         responses for call/multicall
         """
         self.declare_consumer(DirectConsumer, topic, callback)
@@ -464,6 +513,13 @@ class Connection(object):
         """Send a 'topic' message"""
         self.publisher_send(TopicPublisher, topic, msg)
 
+    def topic_send_many(self, topic_msgs):
+        """Send a 'topic' message for each (topic, msg) pair, all through
+        the one publisher of this channel.
+        """
+        for topic, msg in topic_msgs:
+            self.publisher_send(TopicPublisher, topic, msg)
+
     def fanout_send(self, topic, msg):
         """Send a 'fanout' message"""
         self.publisher_send(FanoutPublisher, topic, msg)
@@ -490,10 +546,27 @@ class Connection(object):
 
     def create_consumer(self, topic, proxy, fanout=False):
         """Create a consumer that calls a method in a proxy object"""
+        # All consumers for a proxy share its method limits.
+        callback = self.proxy_callbacks.get(id(proxy))
+        if callback is None:
+            callback = ProxyCallback(proxy)
+            self.proxy_callbacks[id(proxy)] = callback
         if fanout:
-            self.declare_fanout_consumer(topic, ProxyCallback(proxy))
+            self.declare_fanout_consumer(topic, callback)
         else:
-            self.declare_topic_consumer(topic, ProxyCallback(proxy))
+            self.declare_topic_consumer(topic, callback)
+
+    def get_dispatch_stats(self):
+        """Messages running and waiting to run on this connection's
+        consumers, by method.
+        """
+        stats = {}
+        for callback in self.proxy_callbacks.values():
+            for method, counts in callback.get_stats().iteritems():
+                total = stats.setdefault(method, dict(running=0, queued=0))
+                total['running'] += counts['running']
+                total['queued'] += counts['queued']
+        return stats
 
 
 class Pool(pools.Pool):
@@ -577,12 +650,36 @@ class ConnectionContext(object):
             raise exception.InvalidRPCConnectionReuse()
 
 
+def _method_limits():
+    """Parse FLAGS.rpc_method_concurrency into a dict of method: limit."""
+    limits = {}
+    for item in FLAGS.rpc_method_concurrency:
+        method, _sep, limit = item.partition(':')
+        try:
+            limits[method.strip()] = int(limit)
+        except ValueError:
+            LOG.warn(_('Ignoring bad rpc_method_concurrency entry %s'), item)
+    return limits
+
+
 class ProxyCallback(object):
-    """Calls methods on a proxy object based on method and args."""
+    """Calls methods on a proxy object based on method and args.
+
+    No more than the limit in FLAGS.rpc_method_concurrency run at once
+    for a method; the rest wait their turn in order.  Once
+    FLAGS.rpc_max_queued_messages are waiting, the consumer blocks
+    until one starts, leaving further messages with the broker.
+    """
 
     def __init__(self, proxy):
         self.proxy = proxy
         self.pool = greenpool.GreenPool(FLAGS.rpc_thread_pool_size)
+        self.limits = _method_limits()
+        self.coalesce_methods = set(FLAGS.rpc_coalesce_methods)
+        self.running = collections.defaultdict(int)
+        self.waiting = collections.defaultdict(collections.deque)
+        self.waiting_keys = set()
+        self.backlog = semaphore.Semaphore(FLAGS.rpc_max_queued_messages)
 
     def __call__(self, message_data):
         """Consumer callback to call a method on a proxy object.
@@ -605,7 +702,67 @@ class ProxyCallback(object):
             LOG.warn(_('no method for message: %s') % message_data)
             ctxt.reply(_('No method for message: %s') % message_data)
             return
-        self.pool.spawn_n(self._process_data, ctxt, method, args)
+        if self._can_run(method):
+            self._start(ctxt, method, args)
+            return
+
+        key = None
+        if method in self.coalesce_methods and not ctxt.msg_id:
+            key = (method, json.dumps(args, sort_keys=True))
+            if key in self.waiting_keys:
+                LOG.debug(_('Dropped duplicate %s cast'), method)
+                return
+        self.backlog.acquire()
+        self.waiting[method].append((ctxt, args, key))
+        if key:
+            self.waiting_keys.add(key)
+        # What held it back may have finished while we were blocked.
+        if self._can_run(method):
+            ctxt, args = self._next_waiting(method)
+            self._start(ctxt, method, args)
+
+    def get_stats(self):
+        """Return running and queued message counts by method."""
+        stats = {}
+        for method in set(self.running.keys() + self.waiting.keys()):
+            running = self.running[method]
+            queued = len(self.waiting[method])
+            if running or queued:
+                stats[method] = dict(running=running, queued=queued)
+        return stats
+
+    def _can_run(self, method):
+        limit = self.limits.get(method)
+        return not limit or self.running[method] < limit
+
+    def _next_waiting(self, method):
+        """Pop the oldest message waiting for method, if there is one."""
+        waiting = self.waiting.get(method)
+        if not waiting:
+            return None
+        ctxt, args, key = waiting.popleft()
+        self.waiting_keys.discard(key)
+        self.backlog.release()
+        return ctxt, args
+
+    def _start(self, ctxt, method, args):
+        self.running[method] += 1
+        self.pool.spawn_n(self._run, ctxt, method, args)
+
+    def _run(self, ctxt, method, args):
+        """Process a message, then any that queued behind it."""
+        try:
+            while True:
+                try:
+                    self._process_data(ctxt, method, args)
+                except Exception:
+                    LOG.exception(_('Failed to process %s message'), method)
+                next_message = self._next_waiting(method)
+                if next_message is None:
+                    return
+                ctxt, args = next_message
+        finally:
+            self.running[method] -= 1
 
     @exception.wrap_exception()
     def _process_data(self, ctxt, method, args):
@@ -643,6 +800,7 @@ def _unpack_context(msg):
             value = msg.pop(key)
             context_dict[key[9:]] = value
     context_dict['msg_id'] = msg.pop('_msg_id', None)
+    context_dict['reply_q'] = msg.pop('_reply_q', None)
     LOG.debug(_('unpacked context: %s'), context_dict)
     return RpcContext.from_dict(context_dict)
 
@@ -665,18 +823,83 @@ class RpcContext(context.RequestContext):
     """Context that supports replying to a rpc.call"""
     def __init__(self, *args, **kwargs):
         msg_id = kwargs.pop('msg_id', None)
+        reply_q = kwargs.pop('reply_q', None)
         self.msg_id = msg_id
+        self.reply_q = reply_q
         super(RpcContext, self).__init__(*args, **kwargs)
 
     def reply(self, *args, **kwargs):
         if self.msg_id:
+            kwargs.setdefault('reply_q', self.reply_q)
             msg_reply(self.msg_id, *args, **kwargs)
 
 
-class MulticallWaiter(object):
-    def __init__(self, connection):
+class ReplyProxy(object):
+    """The one queue all responses to this process's calls arrive on.
+
+    Responses carry the msg_id of their call and are handed to the
+    MulticallWaiter registered for it.  Replies are only consumed while
+    some call is waiting for one.
+    """
+
+    def __init__(self):
+        self.reply_q = 'reply_%s' % uuid.uuid4().hex
+        self.waiters = {}
+        self.consumer_thread = None
+        self.connection = Connection()
+        self.consumer = self.connection.declare_consumer(DirectConsumer,
+                self.reply_q, self._process_data)
+        self.consumer.consume()
+
+    def _process_data(self, data):
+        msg_id = data.pop('_msg_id', None)
+        waiter = self.waiters.get(msg_id)
+        if waiter is None:
+            LOG.warn(_('No calling threads waiting for msg_id %s'), msg_id)
+        else:
+            waiter.put(data)
+
+    def _consume(self):
+        """Deliver responses until no call is waiting any more."""
+        connection = self.connection
+        while self.waiters:
+            try:
+                connection.connection.drain_events(timeout=1)
+            except socket.timeout:
+                pass
+            except connection.connection.connection_errors, e:
+                LOG.exception(_('Failed to consume message from queue: '
+                        '%s' % str(e)))
+                connection.reconnect()
+                self.consumer.consume()
+        self.consumer_thread = None
+
+    def add_waiter(self, msg_id, waiter):
+        self.waiters[msg_id] = waiter
+        if self.consumer_thread is None:
+            self.consumer_thread = eventlet.spawn(self._consume)
+
+    def remove_waiter(self, msg_id):
+        self.waiters.pop(msg_id, None)
+
+
+_reply_proxy = None
+
+
+def _get_reply_proxy():
+    """Return the ReplyProxy of this process, creating it on first use."""
+    global _reply_proxy
+    if _reply_proxy is None:
+        _reply_proxy = ReplyProxy()
+    return _reply_proxy
+
+
+class DirectMulticallWaiter(object):
+    """Waits for the responses to one call on a queue of its own."""
+    def __init__(self, connection, timeout):
         self._connection = connection
         self._iterator = connection.iterconsume()
+        self._timeout = timeout
         self._result = None
         self._done = False
 
@@ -696,7 +919,12 @@ class MulticallWaiter(object):
         if self._done:
             raise StopIteration
         while True:
-            self._iterator.next()
+            try:
+                with eventlet.Timeout(self._timeout, Timeout()):
+                    self._iterator.next()
+            except Timeout:
+                self.done()
+                raise
             result = self._result
             if isinstance(result, Exception):
                 self.done()
@@ -707,33 +935,96 @@ class MulticallWaiter(object):
             yield result
 
 
+class MulticallWaiter(object):
+    """Waits for the responses to one call on the ReplyProxy."""
+    def __init__(self, reply_proxy, msg_id, timeout):
+        self._reply_proxy = reply_proxy
+        self._msg_id = msg_id
+        self._timeout = timeout
+        self._results = queue.Queue()
+        self._done = False
+        reply_proxy.add_waiter(msg_id, self)
+
+    def done(self):
+        self._done = True
+        self._reply_proxy.remove_waiter(self._msg_id)
+
+    def put(self, data):
+        """The ReplyProxy will call this.  Store the result."""
+        if data['failure']:
+            self._results.put(RemoteError(*data['failure']))
+        else:
+            self._results.put(data['result'])
+
+    def __iter__(self):
+        """Return a result until we get a 'None' response from consumer"""
+        if self._done:
+            raise StopIteration
+        while True:
+            try:
+                result = self._results.get(timeout=self._timeout)
+            except queue.Empty:
+                self.done()
+                raise Timeout()
+            if isinstance(result, Exception):
+                self.done()
+                raise result
+            if result == None:
+                self.done()
+                raise StopIteration
+            yield result
+
+
 def create_connection(new=True):
     """Create a connection"""
     return ConnectionContext(pooled=not new)
 
 
-def multicall(context, topic, msg):
-    """Make a call that returns multiple times."""
-    # Can't use 'with' for multicall, as it returns an iterator
-    # that will continue to use the connection.  When it's done,
-    # connection.close() will get called which will put it back into
-    # the pool
+def multicall(context, topic, msg, timeout=None):
+    """Make a call that returns multiple times.
+
+    The responses come back on the per-process reply queue if
+    rpc_shared_reply_queue is set, and on a queue for this call
+    otherwise.  Timeout is how many seconds to wait for each of them,
+    rpc_response_timeout by default.
+    """
     LOG.debug(_('Making asynchronous call on %s ...'), topic)
     msg_id = uuid.uuid4().hex
     msg.update({'_msg_id': msg_id})
+    if timeout is None:
+        timeout = FLAGS.rpc_response_timeout
+
+    if not FLAGS.rpc_shared_reply_queue:
+        LOG.debug(_('MSG_ID is %s') % (msg_id))
+        _pack_context(msg, context)
+        # Can't use 'with' for multicall, as it returns an iterator
+        # that will continue to use the connection.  When it's done,
+        # connection.close() will get called which will put it back into
+        # the pool
+        conn = ConnectionContext()
+        wait_msg = DirectMulticallWaiter(conn, timeout)
+        conn.declare_direct_consumer(msg_id, wait_msg)
+        conn.topic_send(topic, msg)
+        return wait_msg
+
+    reply_proxy = _get_reply_proxy()
+    msg.update({'_reply_q': reply_proxy.reply_q})
     LOG.debug(_('MSG_ID is %s') % (msg_id))
     _pack_context(msg, context)
 
-    conn = ConnectionContext()
-    wait_msg = MulticallWaiter(conn)
-    conn.declare_direct_consumer(msg_id, wait_msg)
-    conn.topic_send(topic, msg)
+    wait_msg = MulticallWaiter(reply_proxy, msg_id, timeout)
+    try:
+        with ConnectionContext() as conn:
+            conn.topic_send(topic, msg)
+    except Exception:
+        wait_msg.done()
+        raise
     return wait_msg
 
 
-def call(context, topic, msg):
+def call(context, topic, msg, timeout=None):
     """Sends a message on a topic and wait for a response."""
-    rv = multicall(context, topic, msg)
+    rv = multicall(context, topic, msg, timeout=timeout)
     # NOTE(vish): return the last result from the multicall
     rv = list(rv)
     if not rv:
@@ -749,6 +1040,18 @@ def cast(context, topic, msg):
         conn.topic_send(topic, msg)
 
 
+def bulk_cast(context, topic_msgs):
+    """Sends each (topic, msg) pair without waiting for responses.
+
+    The messages all go out over one pooled connection and channel.
+    """
+    LOG.debug(_('Making %d asynchronous casts...'), len(topic_msgs))
+    for topic, msg in topic_msgs:
+        _pack_context(msg, context)
+    with ConnectionContext() as conn:
+        conn.topic_send_many(topic_msgs)
+
+
 def fanout_cast(context, topic, msg):
     """Sends a message on a fanout exchange without waiting for a response."""
     LOG.debug(_('Making asynchronous fanout cast...'))
@@ -757,10 +1060,11 @@ def fanout_cast(context, topic, msg):
         conn.fanout_send(topic, msg)
 
 
-def msg_reply(msg_id, reply=None, failure=None):
+def msg_reply(msg_id, reply=None, failure=None, reply_q=None):
     """Sends a reply or an error on the channel signified by msg_id.
 
-    Failure should be a sys.exc_info() tuple.
+    Failure should be a sys.exc_info() tuple.  When the caller named a
+    reply_q, the reply goes there, tagged with msg_id.
 
     """
     with ConnectionContext() as conn:
@@ -777,4 +1081,8 @@ def msg_reply(msg_id, reply=None, failure=None):
             msg = {'result': dict((k, repr(v))
                             for k, v in reply.__dict__.iteritems()),
                     'failure': failure}
-        conn.direct_send(msg_id, msg)
+        if reply_q:
+            msg['_msg_id'] = msg_id
+            conn.direct_send(reply_q, msg)
+        else:
+            conn.direct_send(msg_id, msg)
@@ -17,7 +17,7 @@
 Handles all requests relating to schedulers.
 """
 
-import functools
+import time
 
 from novaclient import v1_1 as novaclient
 from novaclient import exceptions as novaclient_exceptions
@@ -29,12 +29,19 @@ from nova import log as logging
 from nova import rpc
 from nova import utils
 
+import eventlet
 from eventlet import greenpool
 
 FLAGS = flags.FLAGS
 flags.DEFINE_bool('enable_zone_routing',
     False,
     'When True, routing to child zones will occur.')
+flags.DEFINE_float('zone_call_timeout', 30.0,
+    'Seconds to wait for child zones to answer a call. Zones that have '
+    'not answered by then are left out of the results.')
+flags.DEFINE_integer('zone_client_pool_size', 100,
+    'Maximum number of zone and credential combinations to keep '
+    'authenticated novaclient clients for.')
 
 LOG = logging.getLogger('nova.scheduler.api')
 
@@ -105,6 +112,90 @@ def update_service_capabilities(context, service_name, host, capabilities):
     return rpc.fanout_cast(context, 'scheduler', kwargs)
 
 
+def _instance_info(instance):
+    """The part of an instance the schedulers account resources by."""
+    return dict(id=instance['id'],
+                local_gb=instance['local_gb'],
+                memory_mb=instance['memory_mb'])
+
+
+def update_instance_info(context, host, instance):
+    """Send an update to all the scheduler services informing them
+       of the resources an instance consumes on host."""
+    kwargs = dict(method='update_instance_info',
+                  args=dict(host=host, instance_info=_instance_info(instance)))
+    return rpc.fanout_cast(context, 'scheduler', kwargs)
+
+
+def delete_instance_info(context, host, instance):
+    """Send an update to all the scheduler services informing them
+       that an instance no longer consumes resources on host."""
+    kwargs = dict(method='delete_instance_info',
+                  args=dict(host=host, instance_info=_instance_info(instance)))
+    return rpc.fanout_cast(context, 'scheduler', kwargs)
+
+
+class ZoneClientPool(object):
+    """Keeps authenticated novaclient clients for the child zones, so
+    calls to a zone don't have to authenticate again each time. Each
+    client is only handed to one caller at a time."""
+    def __init__(self):
+        self.clients = {}  # { (<zone url, credentials>, token) : [client] }
+
+    def _key(self, zone, token):
+        return (zone.api_url, zone.name, zone.username, zone.password,
+                token)
+
+    def get(self, zone, token=None):
+        """Return an authenticated client for the zone, acting with the
+        given auth token or as the zone admin if there is none."""
+        idle = self.clients.get(self._key(zone, token), None)
+        if idle:
+            return idle.pop()
+        nova = novaclient.Client(zone.username, zone.password, None,
+                zone.api_url, region_name=zone.name, token=token)
+        nova.authenticate()
+        return nova
+
+    def put(self, zone, nova, token=None):
+        """Give back a client that is in a good state for reuse."""
+        key = self._key(zone, token)
+        if (key not in self.clients and
+                len(self.clients) >= FLAGS.zone_client_pool_size):
+            self.clients.clear()
+        self.clients.setdefault(key, []).append(nova)
+
+    def clear(self):
+        self.clients.clear()
+
+
+zone_client_pool = ZoneClientPool()
+
+
+def wait_for_zones(zone_threads, timeout=None):
+    """Wait for the green threads in [(zone, thread), ...], but not
+    longer than timeout seconds (zone_call_timeout by default) overall.
+    Returns [(zone, result), ...] for the threads that finished in time.
+    The others are killed and left out."""
+    if timeout is None:
+        timeout = FLAGS.zone_call_timeout
+    deadline = time.time() + timeout
+    results = []
+    for zone, thread in zone_threads:
+        finished = False
+        with eventlet.Timeout(max(deadline - time.time(), 0), False):
+            result = thread.wait()
+            finished = True
+        if not finished:
+            thread.kill()
+            url = zone.api_url
+            LOG.warn(_("Zone %(url)s did not answer within %(timeout)s "
+                       "seconds") % locals())
+            continue
+        results.append((zone, result))
+    return results
+
+
 def call_zone_method(context, method_name, errors_to_ignore=None,
                      novaclient_collection_name='zones', zones=None,
                      *args, **kwargs):
@@ -113,17 +204,13 @@ def call_zone_method(context, method_name, errors_to_ignore=None,
         # This will also handle the default None
         errors_to_ignore = [errors_to_ignore]
 
-    pool = greenpool.GreenPool()
-    results = []
-    if zones is None:
-        zones = db.zone_get_all(context.elevated())
-    for zone in zones:
+    token = context.auth_token
+    _auth_failed = object()
+
+    def _error_trap(zone, *args, **kwargs):
         try:
             # Do this on behalf of the user ...
-            nova = novaclient.Client(zone.username, zone.password, None,
-                    zone.api_url, region_name=zone.name,
-                    token=context.auth_token)
-            nova.authenticate()
+            nova = zone_client_pool.get(zone, token)
         except novaclient_exceptions.BadRequest, e:
             url = zone.api_url
             name = zone.name
@@ -131,22 +218,28 @@ def call_zone_method(context, method_name, errors_to_ignore=None,
                        "'%(name)s' URL=%(url)s: %(e)s") % locals())
             #TODO (dabo) - add logic for failure counts per zone,
             # with escalation after a given number of failures.
-            continue
+            return _auth_failed
         novaclient_collection = getattr(nova, novaclient_collection_name)
         collection_method = getattr(novaclient_collection, method_name)
-
-        def _error_trap(*args, **kwargs):
-            try:
-                return collection_method(*args, **kwargs)
-            except Exception as e:
-                if type(e) in errors_to_ignore:
-                    return None
-                raise
-
-        res = pool.spawn(_error_trap, *args, **kwargs)
-        results.append((zone, res))
-    pool.waitall()
-    return [(zone.id, res.wait()) for zone, res in results]
+        try:
+            result = collection_method(*args, **kwargs)
+        except Exception as e:
+            if type(e) in errors_to_ignore:
+                zone_client_pool.put(zone, nova, token)
+                return None
+            raise
+        zone_client_pool.put(zone, nova, token)
+        return result
+
+    # Each zone authenticates and answers in its own green thread, so
+    # a slow zone only costs us up to the deadline.
+    pool = greenpool.GreenPool()
+    if zones is None:
+        zones = db.zone_get_all(context.elevated())
+    threads = [(zone, pool.spawn(_error_trap, zone, *args, **kwargs))
+               for zone in zones]
+    return [(zone.id, result) for zone, result in wait_for_zones(threads)
+            if result is not _auth_failed]
 
 
 def child_zone_helper(context, zone_list, func):
@@ -160,29 +253,36 @@ def child_zone_helper(context, zone_list, func):
         """Worker stub for green thread pool. Give the worker
         an authenticated nova client and zone info."""
         try:
-            nova = novaclient.Client(zone.username, zone.password, None,
-                    zone.api_url, region_name=zone.name,
-                    token=context.auth_token)
-            nova.authenticate()
+            nova = zone_client_pool.get(zone, context.auth_token)
         except novaclient_exceptions.BadRequest, e:
             url = zone.api_url
             LOG.warn(_("Failed request to zone; URL=%(url)s: %(e)s")
                     % locals())
             # This is being returned instead of raised, so that when
             # results are processed in unmarshal_result() after the
-            # greenpool.imap completes, the exception can be raised
+            # zones have answered, the exception can be raised
             # there if no other zones had a response.
             return exception.ZoneRequestError()
         else:
             try:
                 answer = func(nova, zone)
-                return answer
+            except novaclient_exceptions.ClientException, e:
+                # The zone answered, so the client is still good.
+                zone_client_pool.put(zone, nova, context.auth_token)
+                return e
             except Exception, e:
                 return e
+            zone_client_pool.put(zone, nova, context.auth_token)
+            return answer
 
     green_pool = greenpool.GreenPool()
-    return [result for result in green_pool.imap(
-                    functools.partial(_process, func, context), zone_list)]
+    threads = [(zone, green_pool.spawn(_process, func, context, zone))
+               for zone in zone_list]
+    answers = dict((id(zone), result)
+                   for zone, result in wait_for_zones(threads))
+    # Zones that didn't answer in time count as failed requests.
+    return [answers.get(id(zone), exception.ZoneRequestError())
+            for zone in zone_list]
 
 
 def _issue_novaclient_command(nova, zone, collection,
@@ -19,6 +19,9 @@ You can customize this scheduler by specifying your own Host Filters and
 Weighing Functions.
 """
 
+import datetime
+import hashlib
+import heapq
 import json
 import operator
 import types
@@ -26,7 +29,6 @@ import types
 import M2Crypto
 
 from nova.compute import api as compute_api
-from novaclient import v1_1 as novaclient
 from novaclient import exceptions as novaclient_exceptions
 from nova import crypto
 from nova import db
@@ -46,6 +48,9 @@ FLAGS = flags.FLAGS
 flags.DEFINE_list('default_host_filters', ['InstanceTypeFilter'],
         'Which filters to use for filtering hosts when not specified '
         'in the request.')
+flags.DEFINE_integer('zone_select_cache_seconds', 5,
+        'Seconds to reuse the answers of the child zones to an '
+        'identical select request. 0 disables the cache.')
 
 LOG = logging.getLogger('nova.scheduler.distributed_scheduler')
 
@@ -62,8 +67,17 @@ class DistributedScheduler(driver.Scheduler):
     def __init__(self, *args, **kwargs):
         super(DistributedScheduler, self).__init__(*args, **kwargs)
         self.cost_function_cache = {}
+        self.host_filter_cache = {}
+        # { <request spec and zones hash> : (expires, child results) }
+        self.child_select_cache = {}
         self.options = scheduler_options.SchedulerOptions()
 
+    def set_zone_manager(self, zone_manager):
+        """Called by the Scheduler Service to supply a ZoneManager.
+        Cached filters hold on to the old one, so drop them."""
+        super(DistributedScheduler, self).set_zone_manager(zone_manager)
+        self.host_filter_cache = {}
+
     def schedule(self, context, topic, method, *args, **kwargs):
         """The schedule() contract requires we return the one
         best-suited host for this request.
@@ -106,21 +120,27 @@ class DistributedScheduler(driver.Scheduler):
             raise exception.NoValidHost(reason=_(""))
 
         instances = []
-        for num in xrange(num_instances):
-            if not weighted_hosts:
-                break
-            weighted_host = weighted_hosts.pop(0)
-
-            instance = None
-            if weighted_host.host:
-                instance = self._provision_resource_locally(elevated,
-                                        weighted_host, request_spec, kwargs)
-            else:
-                instance = self._ask_child_zone_to_create_instance(elevated,
-                                        weighted_host, request_spec, kwargs)
-
-            if instance:
-                instances.append(instance)
+        # Local instances are cast to their hosts together at the end.
+        casts = []
+        try:
+            for num in xrange(num_instances):
+                if not weighted_hosts:
+                    break
+                weighted_host = weighted_hosts.pop(0)
+
+                instance = None
+                if weighted_host.host:
+                    instance = self._provision_resource_locally(elevated,
+                            weighted_host, request_spec, kwargs, casts=casts)
+                else:
+                    instance = self._ask_child_zone_to_create_instance(
+                            elevated, weighted_host, request_spec, kwargs)
+
+                if instance:
+                    instances.append(instance)
+        finally:
+            # Whatever was created before a failure still gets built.
+            driver.cast_to_compute_hosts(elevated, 'run_instance', casts)
 
         return instances
 
@@ -139,12 +159,43 @@ class DistributedScheduler(driver.Scheduler):
         """Call novaclient zone method. Broken out for testing."""
         return api.call_zone_method(context, method, specs=specs, zones=zones)
 
+    def _select_from_child_zones(self, context, request_spec, zones):
+        """Ask the child zones to select hosts for the request. Answers
+        to an identical request are reused for zone_select_cache_seconds,
+        so retries and repeated requests don't wait on the children."""
+        key = hashlib.sha1(json.dumps(request_spec, sort_keys=True) +
+                str(sorted(zone['id'] for zone in zones))).hexdigest()
+        now = utils.utcnow()
+        cached = self.child_select_cache.get(key, None)
+        if cached and cached[0] > now:
+            return cached[1]
+
+        child_results = self._call_zone_method(context, "select",
+                specs=json.dumps(request_spec), zones=zones)
+        if FLAGS.zone_select_cache_seconds > 0:
+            for old_key, (expires, _results) in \
+                    self.child_select_cache.items():
+                if expires <= now:
+                    del self.child_select_cache[old_key]
+            expires = now + datetime.timedelta(
+                    seconds=FLAGS.zone_select_cache_seconds)
+            self.child_select_cache[key] = (expires, child_results)
+        return child_results
+
     def _provision_resource_locally(self, context, weighted_host, request_spec,
-                                    kwargs):
-        """Create the requested resource in this Zone."""
+                                    kwargs, casts=None):
+        """Create the requested resource in this Zone. The run_instance
+        cast is appended to casts for the caller to send, if given."""
         instance = self.create_instance_db_entry(context, request_spec)
-        driver.cast_to_compute_host(context, weighted_host.host,
-                'run_instance', instance_id=instance['id'], **kwargs)
+        # Account for the instance right away so back-to-back requests
+        # don't pick the host before compute reports it back.
+        self.zone_manager.update_instance_info(weighted_host.host, instance)
+        if casts is None:
+            driver.cast_to_compute_host(context, weighted_host.host,
+                    'run_instance', instance_id=instance['id'], **kwargs)
+        else:
+            cast_kwargs = dict(kwargs, instance_id=instance['id'])
+            casts.append((weighted_host.host, cast_kwargs))
         return driver.encode_instance(instance, local=True)
 
     def _make_weighted_host_from_blob(self, blob):
@@ -194,10 +245,7 @@ class DistributedScheduler(driver.Scheduler):
         nova = None
         try:
             # This operation is done as the caller, not the zone admin.
-            nova = novaclient.Client(zone.username, zone.password, None, url,
-                                     token=context.auth_token,
-                                     region_name=zone_name)
-            nova.authenticate()
+            nova = api.zone_client_pool.get(zone, context.auth_token)
         except novaclient_exceptions.BadRequest, e:
             raise exception.NotAuthorized(_("Bad credentials attempting "
                     "to talk to zone at %(url)s.") % locals())
@@ -213,6 +261,7 @@ class DistributedScheduler(driver.Scheduler):
                             meta=meta, files=files,
                             zone_blob=weighted_host.blob,
                             reservation_id=reservation_id)
+        api.zone_client_pool.put(zone, nova, context.auth_token)
         return driver.encode_instance(instance._info, local=False)
 
     def _adjust_child_weights(self, child_results, zones):
@@ -272,45 +321,52 @@ class DistributedScheduler(driver.Scheduler):
 
         options = self._get_configuration_options()
 
-        # Find our local list of acceptable hosts by repeatedly
-        # filtering and weighing our options. Each time we choose a
-        # host, we virtually consume resources on it so subsequent
-        # selections can adjust accordingly.
+        # Find our local list of acceptable hosts by filtering and
+        # weighing all of them once. Each time we choose a host, we
+        # virtually consume resources on it, so only that host needs
+        # to be filtered and weighed again for the next instance.
 
         # unfiltered_hosts_dict is {host : ZoneManager.HostInfo()}
         unfiltered_hosts_dict = self.zone_manager.get_all_host_data(elevated)
         unfiltered_hosts = unfiltered_hosts_dict.items()
 
+        # Filter local hosts based on requirements ...
+        filtered_hosts = self._filter_hosts(topic, request_spec,
+                unfiltered_hosts, options)
+        LOG.debug(_("Filtered %(filtered_hosts)s") % locals())
+
+        # host_heap is [(weight, host, ZoneManager.HostInfo()), ...],
+        # the best host for the job first.
+        host_heap = least_cost.weighted_host_heap(cost_functions,
+                                                  filtered_hosts, options)
+
         num_instances = request_spec.get('num_instances', 1)
         selected_hosts = []
         for num in xrange(num_instances):
-            # Filter local hosts based on requirements ...
-            filtered_hosts = self._filter_hosts(topic, request_spec,
-                    unfiltered_hosts, options)
-
-            if not filtered_hosts:
+            if not host_heap:
                 # Can't get any more locally.
                 break
 
-            LOG.debug(_("Filtered %(filtered_hosts)s") % locals())
-
-            # weighted_host = WeightedHost() ... the best
-            # host for the job.
-            weighted_host = least_cost.weighted_sum(cost_functions,
-                                                filtered_hosts, options)
+            weight, host, hostinfo = heapq.heappop(host_heap)
+            weighted_host = least_cost.WeightedHost(weight, host=host,
+                                                    hostinfo=hostinfo)
             LOG.debug(_("Weighted %(weighted_host)s") % locals())
             selected_hosts.append(weighted_host)
 
             # Now consume the resources so the filter/weights
             # will change for the next instance.
-            weighted_host.hostinfo.consume_resources(disk_requirement_bg,
-                                        ram_requirement_mb)
+            hostinfo.consume_resources(disk_requirement_bg,
+                                       ram_requirement_mb)
+            if self._filter_hosts(topic, request_spec, [(host, hostinfo)],
+                                  options):
+                weight = least_cost.weighted_host_score(cost_functions,
+                                                        hostinfo, options)
+                heapq.heappush(host_heap, (weight, host, hostinfo))
 
         # Next, tack on the host weights from the child zones
-        json_spec = json.dumps(request_spec)
         all_zones = self._zone_get_all(elevated)
-        child_results = self._call_zone_method(elevated, "select",
-                specs=json_spec, zones=all_zones)
+        child_results = self._select_from_child_zones(elevated,
+                request_spec, all_zones)
         selected_hosts.extend(self._adjust_child_weights(
                                                 child_results, all_zones))
         selected_hosts.sort(key=operator.attrgetter('weight'))
@@ -338,6 +394,10 @@ class DistributedScheduler(driver.Scheduler):
             filters = FLAGS.default_host_filters
         if not isinstance(filters, (list, tuple)):
             filters = [filters]
+        cache_key = tuple(filters)
+        if cache_key in self.host_filter_cache:
+            return self.host_filter_cache[cache_key]
+
         good_filters = []
         bad_filters = []
         filter_classes = self._get_filter_classes()
@@ -345,7 +405,7 @@ class DistributedScheduler(driver.Scheduler):
             found_class = False
             for cls in filter_classes:
                 if cls.__name__ == filter_name:
-                    good_filters.append(cls())
+                    good_filters.append(cls(self.zone_manager))
                     found_class = True
                     break
             if not found_class:
@@ -353,6 +413,7 @@ class DistributedScheduler(driver.Scheduler):
         if bad_filters:
             msg = ", ".join(bad_filters)
             raise exception.SchedulerHostFilterNotFound(filter_name=msg)
+        self.host_filter_cache[cache_key] = good_filters
         return good_filters
 
     def _filter_hosts(self, topic, request_spec, hosts, options):
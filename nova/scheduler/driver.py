@@ -70,6 +70,30 @@ def cast_to_compute_host(context, host, method, update_db=True, **kwargs):
     LOG.debug(_("Casted '%(method)s' to compute '%(host)s'") % locals())
 
 
+def cast_to_compute_hosts(context, method, host_kwargs, update_db=True):
+    """Cast method to a number of compute host queues at once.
+
+    host_kwargs is a list of (host, kwargs) pairs, one per cast, and the
+    casts all go out in a single rpc.bulk_cast.
+    """
+
+    now = utils.utcnow()
+    topic_msgs = []
+    for host, kwargs in host_kwargs:
+        if update_db:
+            instance_id = kwargs.get('instance_id', None)
+            if instance_id is not None:
+                db.instance_update(context, instance_id,
+                        {'host': host, 'scheduled_at': now})
+        topic_msgs.append((db.queue_get_for(context, 'compute', host),
+                           {"method": method, "args": kwargs}))
+    if not topic_msgs:
+        return
+    rpc.bulk_cast(context, topic_msgs)
+    count = len(topic_msgs)
+    LOG.debug(_("Casted '%(method)s' to %(count)d compute hosts") % locals())
+
+
 def cast_to_network_host(context, host, method, update_db=False, **kwargs):
     """Cast request to a network host queue"""
 
@@ -358,20 +382,12 @@ class Scheduler(object):
 
         """
 
-        # Getting total available memory and disk of host
-        avail = self._get_compute_info(context, dest, 'memory_mb')
-
-        # Getting total used memory and disk of host
-        # It should be sum of memories that are assigned as max value,
+        # Getting total available memory of host, less the sum of
+        # memories that are assigned to its instances as max value,
         # because overcommiting is risky.
-        used = 0
-        instance_refs = db.instance_get_all_by_host(context, dest)
-        used_list = [i['memory_mb'] for i in instance_refs]
-        if used_list:
-            used = reduce(lambda x, y: x + y, used_list)
+        avail = self._get_compute_usage(context, dest)['free_ram_mb']
 
         mem_inst = instance_ref['memory_mb']
-        avail = avail - used
         if avail <= mem_inst:
             instance_id = ec2utils.id_to_ec2_id(instance_ref['id'])
             reason = _("Unable to migrate %(instance_id)s to %(dest)s: "
@@ -389,20 +405,12 @@ class Scheduler(object):
 
         """
 
-        # Getting total available memory and disk of host
-        avail = self._get_compute_info(context, dest, 'local_gb')
-
-        # Getting total used memory and disk of host
-        # It should be sum of disks that are assigned as max value
+        # Getting total available disk of host, less the sum of
+        # disks that are assigned to its instances as max value
         # because overcommiting is risky.
-        used = 0
-        instance_refs = db.instance_get_all_by_host(context, dest)
-        used_list = [i['local_gb'] for i in instance_refs]
-        if used_list:
-            used = reduce(lambda x, y: x + y, used_list)
+        avail = self._get_compute_usage(context, dest)['free_disk_gb']
 
         disk_inst = instance_ref['local_gb']
-        avail = avail - used
         if avail <= disk_inst:
             instance_id = ec2utils.id_to_ec2_id(instance_ref['id'])
             reason = _("Unable to migrate %(instance_id)s to %(dest)s: "
@@ -410,18 +418,18 @@ class Scheduler(object):
                        "<= instance:%(disk_inst)s)")
             raise exception.MigrationError(reason=reason % locals())
 
-    def _get_compute_info(self, context, host, key):
-        """get compute node's information specified by key
+    def _get_compute_usage(self, context, host):
+        """get compute node's free resources
 
         :param context: security context
         :param host: hostname(must be compute node)
-        :param key: column name of compute_nodes
-        :return: value specified by key
+        :return: dict with free_ram_mb, free_disk_gb and free_vcpus
 
         """
-        compute_node_ref = db.service_get_all_compute_by_host(context, host)
-        compute_node_ref = compute_node_ref[0]['compute_node'][0]
-        return compute_node_ref[key]
+        usage = db.compute_node_get_all_with_usage(context, host=host)
+        if not usage:
+            raise exception.ComputeHostNotFound(host=host)
+        return usage[0]
 
     def mounted_on_same_shared_storage(self, context, instance_ref, dest):
         """Check if the src and dest host mount same shared storage.
@@ -19,6 +19,11 @@ import nova.scheduler
 
 class AbstractHostFilter(object):
     """Base class for host filters."""
+    def __init__(self, zone_manager=None):
+        # The ZoneManager the hosts come from, if the filter wants to
+        # use its indexes. Filters must work without one.
+        self.zone_manager = zone_manager
+
     def instance_type_to_filter(self, instance_type):
         """Convert instance_type into a filter for most common use-case."""
         raise NotImplementedError()
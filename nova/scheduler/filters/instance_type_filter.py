@@ -54,6 +54,12 @@ class InstanceTypeFilter(abstract_filter.AbstractHostFilter):
     def filter_hosts(self, host_list, query, options):
         """Return a list of hosts that can create instance_type."""
         instance_type = query
+        # Let the ZoneManager capability index find the hosts matching
+        # the extra specs, rather than checking every host's capabilities.
+        capable_hosts = None
+        if self.zone_manager and instance_type.get('extra_specs'):
+            capable_hosts = self.zone_manager.get_hosts_with_capabilities(
+                    'compute', instance_type['extra_specs'])
         selected_hosts = []
         for hostname, host_info in host_list:
             if not self._basic_ram_filter(hostname, host_info,
@@ -63,8 +69,11 @@ class InstanceTypeFilter(abstract_filter.AbstractHostFilter):
             if capabilities:
                 if not capabilities.get("enabled", True):
                     continue
-                if not self._satisfies_extra_specs(capabilities,
-                                                   instance_type):
+                if capable_hosts is not None:
+                    if hostname not in capable_hosts:
+                        continue
+                elif not self._satisfies_extra_specs(capabilities,
+                                                     instance_type):
                     continue
 
             selected_hosts.append((hostname, host_info))
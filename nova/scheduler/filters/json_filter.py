@@ -25,6 +25,14 @@ class JsonFilter(abstract_filter.AbstractHostFilter):
     """Host Filter to allow simple JSON-based grammar for
     selecting hosts.
     """
+    # Compiled queries are kept per filter instance, keyed by the
+    # JSON query text.
+    max_compiled_queries = 100
+
+    def __init__(self, zone_manager=None):
+        super(JsonFilter, self).__init__(zone_manager)
+        self.compiled_queries = {}
+
     def _op_compare(self, args, op):
         """Returns True if the specified operator can successfully
         compare the first item in the args with all the rest. Will
@@ -96,49 +104,79 @@ class JsonFilter(abstract_filter.AbstractHostFilter):
                 ['>=', '$compute.disk_available', required_disk]]
         return json.dumps(query)
 
-    def _parse_string(self, string, host, hostinfo):
+    def _compile_variable(self, string):
         """Strings prefixed with $ are capability lookups in the
-        form '$service.capability[.subcap*]'.
+        form '$service.capability[.subcap*]'. Split the path once and
+        return a function that looks it up on a HostInfo.
         """
-        if not string:
-            return None
-        if not string.startswith("$"):
-            return string
-
         path = string[1:].split(".")
-        services = dict(compute=hostinfo.compute, network=hostinfo.network,
-                        volume=hostinfo.volume)
-        service = services.get(path[0], None)
-        if not service:
-            return None
-        for item in path[1:]:
-            service = service.get(item, None)
-            if not service:
+        service_name = path[0]
+        keys = path[1:]
+        if service_name not in ('compute', 'network', 'volume'):
+            return lambda hostinfo: None
+
+        def lookup(hostinfo):
+            value = getattr(hostinfo, service_name)
+            if not value:
                 return None
-        return service
+            for key in keys:
+                value = value.get(key, None)
+                if not value:
+                    return None
+            return value
+        return lookup
+
+    def _compile_arg(self, arg):
+        """Return a function computing the argument for a host, or
+        None if the argument is always dropped.
+        """
+        if isinstance(arg, list):
+            return self._compile(arg)
+        if isinstance(arg, basestring):
+            if not arg:
+                return None
+            if arg.startswith("$"):
+                return self._compile_variable(arg)
+        if arg is None:
+            return None
+        return lambda hostinfo: arg
 
-    def _process_filter(self, query, host, hostinfo):
-        """Recursively parse the query structure."""
+    def _compile(self, query):
+        """Turn the query structure into a function of a HostInfo,
+        so the tree is only walked once per query.
+        """
         if not query:
-            return True
-        cmd = query[0]
-        method = self.commands[cmd]
-        cooked_args = []
-        for arg in query[1:]:
-            if isinstance(arg, list):
-                arg = self._process_filter(arg, host, hostinfo)
-            elif isinstance(arg, basestring):
-                arg = self._parse_string(arg, host, hostinfo)
-            if arg is not None:
-                cooked_args.append(arg)
-        result = method(self, cooked_args)
-        return result
+            return lambda hostinfo: True
+        method = self.commands[query[0]]
+        arg_fns = [fn for fn in [self._compile_arg(arg) for arg in query[1:]]
+                   if fn is not None]
+
+        def evaluate(hostinfo):
+            cooked_args = []
+            for fn in arg_fns:
+                arg = fn(hostinfo)
+                if arg is not None:
+                    cooked_args.append(arg)
+            return method(self, cooked_args)
+        return evaluate
+
+    def _get_compiled_query(self, query):
+        """Return the compiled form of the JSON query text, compiling
+        and caching it on first use.
+        """
+        compiled = self.compiled_queries.get(query)
+        if compiled is None:
+            if len(self.compiled_queries) >= self.max_compiled_queries:
+                self.compiled_queries.clear()
+            compiled = self._compile(json.loads(query))
+            self.compiled_queries[query] = compiled
+        return compiled
 
     def filter_hosts(self, host_list, query, options):
         """Return a list of hosts that can fulfill the requirements
         specified in the query.
         """
-        expanded = json.loads(query)
+        compiled = self._get_compiled_query(query)
         filtered_hosts = []
         for host, hostinfo in host_list:
             if not hostinfo:
@@ -146,7 +184,7 @@ class JsonFilter(abstract_filter.AbstractHostFilter):
             if hostinfo.compute and not hostinfo.compute.get("enabled", True):
                 # Host is disabled
                 continue
-            result = self._process_filter(expanded, host, hostinfo)
+            result = compiled(hostinfo)
             if isinstance(result, list):
                 # If any succeeded, include the host
                 result = any(result)
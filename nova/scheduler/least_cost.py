@@ -22,6 +22,7 @@ The cost-function and weights are tabulated, and the host with the least cost
 is then selected for provisioning.
 """
 
+import heapq
 
 from nova import flags
 from nova import log as logging
@@ -120,3 +121,29 @@ def weighted_sum(weighted_fns, host_list, options):
     final_scores = sorted(final_scores)
     weight, (host, hostinfo) = final_scores[0]  # Lowest score is the winner!
     return WeightedHost(weight, host=host, hostinfo=hostinfo)
+
+
+def weighted_host_score(weighted_fns, host_info, options):
+    """Use the weighted-sum method to score a single host. Lower is
+    better. The score of a host only depends on the host itself, so it
+    only needs to be recomputed when that host changes."""
+    score = 0.0
+    for weight, fn in weighted_fns:
+        score += weight * fn(host_info, options)
+    return score
+
+
+def weighted_host_heap(weighted_fns, host_list, options):
+    """Score every host once and return a heap of
+    (score, host, HostInfo()) tuples, best candidate first.
+
+    host_list - [(host, HostInfo()), ...]
+
+    Picking N hosts off the heap, and pushing back only the hosts whose
+    resources changed, costs O(hosts + N log hosts) instead of
+    re-weighing every host for every pick as weighted_sum() would.
+    """
+    heap = [(weighted_host_score(weighted_fns, host_info, options),
+             host, host_info) for host, host_info in host_list]
+    heapq.heapify(heap)
+    return heap
@@ -77,6 +77,16 @@ class SchedulerManager(manager.Manager):
         self.zone_manager.update_service_capabilities(service_name,
                             host, capabilities)
 
+    def update_instance_info(self, context=None, host=None,
+                             instance_info=None):
+        """Process a notice that an instance consumes resources on host."""
+        self.zone_manager.update_instance_info(host, instance_info)
+
+    def delete_instance_info(self, context=None, host=None,
+                             instance_info=None):
+        """Process a notice that an instance left host."""
+        self.zone_manager.delete_instance_info(host, instance_info)
+
     def select(self, context=None, *args, **kwargs):
         """Select a list of hosts best matching the provided specs."""
         return self.driver.select(context, *args, **kwargs)
@@ -17,18 +17,20 @@
 ZoneManager oversees all communications with child Zones.
 """
 
+import bisect
 import datetime
 import thread
 import traceback
 import UserDict
 
+import eventlet
 from eventlet import greenpool
-from novaclient import v1_1 as novaclient
 
 from nova import db
 from nova import flags
 from nova import log as logging
 from nova import utils
+from nova.scheduler import api
 
 FLAGS = flags.FLAGS
 flags.DEFINE_integer('zone_db_check_interval', 60,
@@ -39,6 +41,9 @@ flags.DEFINE_integer('reserved_host_disk_mb', 0,
         'Amount of disk in MB to reserve for host/dom0')
 flags.DEFINE_integer('reserved_host_memory_mb', 512,
         'Amount of memory in MB to reserve for host/dom0')
+flags.DEFINE_integer('host_state_reconcile_interval', 600,
+        'Seconds between full reconciliations of the cached host '
+        'resource table with the db.')
 
 
 class ZoneState(object):
@@ -99,9 +104,10 @@ def _call_novaclient(zone):
     """Call novaclient. Broken out for testing purposes. Note that
     we have to use the admin credentials for this since there is no
     available context."""
-    client = novaclient.Client(zone.username, zone.password, None,
-                               zone.api_url, region_name=zone.name)
-    return client.zones.info()._info
+    client = api.zone_client_pool.get(zone)
+    info = client.zones.info()._info
+    api.zone_client_pool.put(zone, client)
+    return info
 
 
 def _poll_zone(zone):
@@ -110,8 +116,9 @@ def _poll_zone(zone):
     url = zone.api_url
     logging.debug(_("Polling zone: %(name)s @ %(url)s") % locals())
     try:
-        zone.update_metadata(_call_novaclient(zone))
-    except Exception, e:
+        with eventlet.Timeout(FLAGS.zone_call_timeout):
+            zone.update_metadata(_call_novaclient(zone))
+    except (Exception, eventlet.Timeout), e:
         zone.log_error(traceback.format_exc())
 
 
@@ -187,6 +194,19 @@ class ZoneManager(object):
         self.zone_states = {}  # { <zone_id> : ZoneState }
         self.service_states = {}  # { <host> : { <service> : { cap k : v }}}
         self.green_pool = greenpool.GreenPool()
+        # Cached view of the consumable resources of each compute host.
+        # Seeded from the db, kept current by instance events and
+        # periodically reconciled with the db.
+        self.last_host_state_sync = datetime.datetime.min
+        self.host_resources = {}  # { <host> : { 'free_ram_mb' : v, ... }}
+        self.instance_resources = {}  # { <instance_id> : (host, disk, ram) }
+        # Indexes over the capabilities of enabled services, kept in step
+        # with service_states by update_service_capabilities and
+        # delete_expired_host_services.
+        # { (<service>, <cap>) : { <value> : set([<host>, ...]) }}
+        self.capability_index = {}
+        # { (<service>, <cap>) : [(<value>, <host>), ...] } sorted by value
+        self.sorted_capabilities = {}
 
     def get_zone_list(self):
         """Return the list of zones we know about."""
@@ -204,60 +224,91 @@ class ZoneManager(object):
                 ret.append({"service": svc, "host_name": host})
         return ret
 
-    def _compute_node_get_all(self, context):
+    def _compute_node_get_all_with_usage(self, context):
         """Broken out for testing."""
-        return db.compute_node_get_all(context)
+        return db.compute_node_get_all_with_usage(context)
 
-    def _instance_get_all(self, context):
-        """Broken out for testing."""
-        return db.instance_get_all(context)
+    def _host_state_needs_sync(self):
+        """Check if the cached host resource table should be rebuilt."""
+        diff = utils.utcnow() - self.last_host_state_sync
+        return diff >= datetime.timedelta(
+                seconds=FLAGS.host_state_reconcile_interval)
+
+    def sync_host_state_from_db(self, context):
+        """Rebuild the cached host resource table from the db.
+
+        The per-host usage is summed up by the db in a single query, so
+        this costs O(hosts) here. Instances are only tracked one by one
+        once an event is received for them."""
+        logging.debug(_("Syncing host resource table from db."))
+
+        host_resources = {}
+        for usage in self._compute_node_get_all_with_usage(context):
+            # Reserve resources for host/dom0
+            host_resources[usage['host']] = dict(
+                    free_disk_gb=usage['free_disk_gb'] -
+                                 FLAGS.reserved_host_disk_mb * 1024,
+                    free_ram_mb=usage['free_ram_mb'] -
+                                FLAGS.reserved_host_memory_mb)
+
+        self.host_resources = host_resources
+        self.instance_resources = {}
+        self.last_host_state_sync = utils.utcnow()
+
+    def _consume_host_resources(self, host, disk, ram):
+        resources = self.host_resources.get(host, None)
+        if resources:
+            resources['free_disk_gb'] -= disk
+            resources['free_ram_mb'] -= ram
+
+    def update_instance_info(self, host, instance):
+        """Record that an instance consumes resources on host.
+
+        Resources previously accounted to the same instance since the
+        last sync are released first, so repeated notices for one
+        instance are harmless. Moving an instance that was counted by
+        the db must be preceded by delete_instance_info for its old
+        host."""
+        instance_id = instance['id']
+        tracked = self.instance_resources.pop(instance_id, None)
+        if tracked:
+            old_host, old_disk, old_ram = tracked
+            self._consume_host_resources(old_host, -old_disk, -old_ram)
+        disk = instance['local_gb']
+        ram = instance['memory_mb']
+        self.instance_resources[instance_id] = (host, disk, ram)
+        self._consume_host_resources(host, disk, ram)
+
+    def delete_instance_info(self, host, instance):
+        """Record that an instance no longer consumes resources on host."""
+        tracked = self.instance_resources.pop(instance['id'], None)
+        if tracked:
+            host, disk, ram = tracked
+        else:
+            disk = instance['local_gb']
+            ram = instance['memory_mb']
+        self._consume_host_resources(host, -disk, -ram)
 
     def get_all_host_data(self, context):
         """Returns a dict of all the hosts the ZoneManager
         knows about. Also, each of the consumable resources in HostInfo
-        are pre-populated and adjusted based on data in the db.
+        are pre-populated and adjusted based on the cached host
+        resource table.
 
         For example:
         {'192.168.1.100': HostInfo(), ...}
 
-        Note: this can be very slow with a lot of instances.
-        InstanceType table isn't required since a copy is stored
-        with the instance (in case the InstanceType changed since the
-        instance was created)."""
+        The returned HostInfo objects are private copies, so callers
+        may virtually consume resources on them freely."""
+        if self._host_state_needs_sync():
+            self.sync_host_state_from_db(context)
 
-        # Make a compute node dict with the bare essential metrics.
-        compute_nodes = self._compute_node_get_all(context)
         host_info_map = {}
-        for compute in compute_nodes:
-            all_disk = compute['local_gb']
-            all_ram = compute['memory_mb']
-            service = compute['service']
-            if not service:
-                logging.warn(_("No service for compute ID %s") % compute['id'])
-                continue
-
-            host = service['host']
+        for host, resources in self.host_resources.iteritems():
             caps = self.service_states.get(host, None)
-            host_info = HostInfo(host, caps=caps,
-                    free_disk_gb=all_disk, free_ram_mb=all_ram)
-            # Reserve resources for host/dom0
-            host_info.consume_resources(FLAGS.reserved_host_disk_mb * 1024,
-                    FLAGS.reserved_host_memory_mb)
-            host_info_map[host] = host_info
-
-        # "Consume" resources from the host the instance resides on.
-        instances = self._instance_get_all(context)
-        for instance in instances:
-            host = instance['host']
-            if not host:
-                continue
-            host_info = host_info_map.get(host, None)
-            if not host_info:
-                continue
-            disk = instance['local_gb']
-            ram = instance['memory_mb']
-            host_info.consume_resources(disk, ram)
-
+            host_info_map[host] = HostInfo(host, caps=caps,
+                    free_disk_gb=resources['free_disk_gb'],
+                    free_ram_mb=resources['free_ram_mb'])
         return host_info_map
 
     def get_zone_capabilities(self, context):
@@ -266,10 +317,6 @@ class ZoneManager(object):
            <cap>_min and <cap>_max values."""
         hosts_dict = self.service_states
 
-        # TODO(sandy) - be smarter about fabricating this structure.
-        # But it's likely to change once we understand what the Best-Match
-        # code will need better.
-        combined = {}  # { <service>_<cap> : (min, max), ... }
         stale_host_services = {}  # { host1 : [svc1, svc2], host2 :[svc1]}
         for host, host_dict in hosts_dict.iteritems():
             for service_name, service_dict in host_dict.iteritems():
@@ -282,20 +329,86 @@ class ZoneManager(object):
                     if host not in stale_host_services:
                         stale_host_services[host] = []  # Adding host key once
                     stale_host_services[host].append(service_name)
-                    continue
-                for cap, value in service_dict.iteritems():
-                    if cap == "timestamp":  # Timestamp is not needed
-                        continue
-                    key = "%s_%s" % (service_name, cap)
-                    min_value, max_value = combined.get(key, (value, value))
-                    min_value = min(min_value, value)
-                    max_value = max(max_value, value)
-                    combined[key] = (min_value, max_value)
 
         # Delete the expired host services
         self.delete_expired_host_services(stale_host_services)
+
+        # The remaining enabled services are all in sorted_capabilities,
+        # so min and max are at either end of each list.
+        combined = {}  # { <service>_<cap> : (min, max), ... }
+        for (service_name, cap), values in \
+                self.sorted_capabilities.iteritems():
+            key = "%s_%s" % (service_name, cap)
+            combined[key] = (values[0][0], values[-1][0])
         return combined
 
+    def _index_service_capabilities(self, host, service_name, capabilities):
+        """Add the capabilities of an enabled service to the indexes."""
+        if not capabilities.get("enabled", True):
+            return
+        for cap, value in capabilities.iteritems():
+            if cap == "timestamp":
+                continue
+            key = (service_name, cap)
+            try:
+                values = self.capability_index.setdefault(key, {})
+                values.setdefault(value, set()).add(host)
+            except TypeError:
+                # Unhashable values can only be found by a full scan.
+                pass
+            bisect.insort(self.sorted_capabilities.setdefault(key, []),
+                          (value, host))
+
+    def _unindex_service_capabilities(self, host, service_name,
+                                      capabilities):
+        """Remove the capabilities of a service from the indexes."""
+        for cap, value in capabilities.iteritems():
+            key = (service_name, cap)
+            values = self.capability_index.get(key, None)
+            if values is not None:
+                try:
+                    hosts = values.get(value, None)
+                except TypeError:
+                    # Unhashable values were never indexed.
+                    hosts = None
+                if hosts is not None:
+                    hosts.discard(host)
+                    if not hosts:
+                        del values[value]
+                if not values:
+                    del self.capability_index[key]
+
+            sorted_values = self.sorted_capabilities.get(key, None)
+            if sorted_values is None:
+                continue
+            index = bisect.bisect_left(sorted_values, (value, host))
+            if index < len(sorted_values) and \
+                    sorted_values[index] == (value, host):
+                del sorted_values[index]
+            if not sorted_values:
+                del self.sorted_capabilities[key]
+
+    def get_hosts_with_capabilities(self, service_name, capabilities):
+        """Return the set of hosts whose enabled service_name reports
+        every capability in the capabilities dict with an equal value.
+
+        Returns None if the index can't answer the question, which
+        happens when capabilities is empty or has unhashable values."""
+        if not capabilities:
+            return None
+        host_sets = []
+        try:
+            for cap, value in capabilities.iteritems():
+                values = self.capability_index.get((service_name, cap), {})
+                hosts = values.get(value, None)
+                if not hosts:
+                    return set()
+                host_sets.append(hosts)
+        except TypeError:
+            return None
+        host_sets.sort(key=len)
+        return host_sets[0].intersection(*host_sets[1:])
+
     def _refresh_from_db(self, context):
         """Make our zone state map match the db."""
         # Add/update existing zones ...
@@ -325,6 +438,9 @@ class ZoneManager(object):
             logging.debug(_("Updating zone cache from db."))
             self.last_zone_db_check = utils.utcnow()
             self._refresh_from_db(context)
+        if context and self._host_state_needs_sync():
+            # Reconcile here so scheduling requests rarely pay for it.
+            self.sync_host_state_from_db(context)
         self._poll_zones(context)
 
     def update_service_capabilities(self, service_name, host, capabilities):
@@ -332,7 +448,17 @@ class ZoneManager(object):
         logging.debug(_("Received %(service_name)s service update from "
                 "%(host)s.") % locals())
         service_caps = self.service_states.get(host, {})
+        if (service_name == 'compute' and service_name not in service_caps
+                and host not in self.host_resources):
+            # A compute host we have never accounted for. Pick up its
+            # totals from the db on the next request.
+            self.last_host_state_sync = datetime.datetime.min
         capabilities["timestamp"] = utils.utcnow()  # Reported time
+        old_capabilities = service_caps.get(service_name, None)
+        if old_capabilities:
+            self._unindex_service_capabilities(host, service_name,
+                                               old_capabilities)
+        self._index_service_capabilities(host, service_name, capabilities)
         service_caps[service_name] = capabilities
         self.service_states[host] = service_caps
 
@@ -350,6 +476,8 @@ class ZoneManager(object):
         for host, services in host_services_dict.iteritems():
             service_caps = self.service_states[host]
             for service in services:
+                self._unindex_service_capabilities(host, service,
+                                                   service_caps[service])
                 del service_caps[service]
                 if len(service_caps) == 0:  # Delete host if no services
                     del self.service_states[host]
@@ -250,6 +250,10 @@ class Service(object):
             except Exception:
                 pass
 
+    def get_rpc_stats(self, context=None):
+        """Messages running and queued on this service, by method."""
+        return self.conn.get_dispatch_stats()
+
     def periodic_tasks(self):
         """Tasks to be run at a periodic interval."""
         self.manager.periodic_tasks(context.get_admin_context())
@@ -826,6 +826,48 @@ class CloudTestCase(test.TestCase):
 
         self._tearDownBlockDeviceMapping(inst1, inst2, volumes)
 
+    def test_describe_instances_prefetches(self):
+        """Make sure describe_instances doesn't look things up one instance
+        at a time
+        """
+        (inst1, inst2, volumes) = self._setUpBlockDeviceMapping()
+        service = db.service_create(self.context, {'host': 'host1',
+                                                   'availability_zone': 'z1',
+                                                   'topic': "compute"})
+        db.instance_update(self.context, inst1['id'], {'host': 'host1'})
+        # Make sure the image has an id before the per-image call is
+        # stubbed out.
+        self.cloud._get_image_id(self.context, inst1['image_ref'])
+
+        def fake_lookup(*args, **kwargs):
+            self.fail(_("Instances should be looked up in bulk"))
+
+        for name in ('block_device_mapping_get_all_by_instance',
+                     'service_get_all_by_host', 's3_image_get_by_uuid',
+                     'volume_get'):
+            self.stubs.Set(db, name, fake_lookup)
+
+        ec2_ids = [ec2utils.id_to_ec2_id(inst1['id']),
+                   ec2utils.id_to_ec2_id(inst2['id'])]
+        result = self.cloud.describe_instances(self.context,
+                                               instance_id=ec2_ids)
+        instances = dict((instance['instanceId'], instance)
+                         for reservation in result['reservationSet']
+                         for instance in reservation['instancesSet'])
+        result = instances[ec2_ids[0]]
+        self.assertSubDictMatch(self._expected_instance_bdm1, result)
+        self._assertEqualBlockDeviceMapping(
+            self._expected_block_device_mapping0, result['blockDeviceMapping'])
+        self.assertEqual(result['placement']['availabilityZone'], 'z1')
+        result = instances[ec2_ids[1]]
+        self.assertSubDictMatch(self._expected_instance_bdm2, result)
+        self.assertEqual(result['placement']['availabilityZone'],
+                         'unknown zone')
+
+        self.stubs.UnsetAll()
+        db.service_destroy(self.context, service['id'])
+        self._tearDownBlockDeviceMapping(inst1, inst2, volumes)
+
     def test_describe_images(self):
         describe_images = self.cloud.describe_images
 
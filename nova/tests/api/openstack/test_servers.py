@@ -112,6 +112,15 @@ def return_servers(context, *args, **kwargs):
     for i in xrange(5):
         server = stub_instance(i, 'fake', 'fake', uuid=get_fake_uuid(i))
         servers.append(server)
+    marker = kwargs.get('marker')
+    limit = kwargs.get('limit')
+    if marker is not None:
+        uuids = [server['uuid'] for server in servers]
+        if marker not in uuids:
+            raise exception.MarkerNotFound(marker=marker)
+        servers = servers[uuids.index(marker) + 1:]
+    if limit is not None:
+        servers = servers[:limit]
     return servers
 
 
@@ -841,10 +850,27 @@ class ServersControllerTest(test.TestCase):
         self.assertRaises(webob.exc.HTTPBadRequest,
                           self.controller.index, req)
 
+    def test_get_servers_pages_in_compute(self):
+        def fake_get_all(compute_self, context, search_opts=None,
+                         marker=None, limit=None, columns_to_join=None):
+            self.assertFalse('marker' in search_opts)
+            self.assertFalse('limit' in search_opts)
+            self.assertEqual(marker, get_fake_uuid(1))
+            self.assertEqual(limit, 2)
+            self.assertEqual(columns_to_join, [])
+            return [stub_instance(2, uuid=get_fake_uuid(2))]
+
+        self.stubs.Set(nova.compute.API, 'get_all', fake_get_all)
+
+        url = '/v1.1/fake/servers?limit=2&marker=%s' % get_fake_uuid(1)
+        req = fakes.HTTPRequest.blank(url)
+        servers = self.controller.index(req)['servers']
+        self.assertEqual([s['id'] for s in servers], [get_fake_uuid(2)])
+
     def test_get_servers_with_bad_option(self):
         server_uuid = str(utils.gen_uuid())
 
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None, **kwargs):
             return [stub_instance(100, uuid=server_uuid)]
 
         self.stubs.Set(nova.compute.API, 'get_all', fake_get_all)
@@ -858,7 +884,7 @@ class ServersControllerTest(test.TestCase):
     def test_get_servers_allows_image(self):
         server_uuid = str(utils.gen_uuid())
 
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None, **kwargs):
             self.assertNotEqual(search_opts, None)
             self.assertTrue('image' in search_opts)
             self.assertEqual(search_opts['image'], '12345')
@@ -874,7 +900,7 @@ class ServersControllerTest(test.TestCase):
         self.assertEqual(servers[0]['id'], server_uuid)
 
     def test_tenant_id_filter_converts_to_project_id_for_admin(self):
-        def fake_get_all(context, filters=None, instances=None):
+        def fake_get_all(context, filters=None, instances=None, **kwargs):
             self.assertNotEqual(filters, None)
             self.assertEqual(filters['project_id'], 'fake')
             self.assertFalse(filters.get('tenant_id'))
@@ -893,7 +919,7 @@ class ServersControllerTest(test.TestCase):
     def test_get_servers_allows_flavor(self):
         server_uuid = str(utils.gen_uuid())
 
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None, **kwargs):
             self.assertNotEqual(search_opts, None)
             self.assertTrue('flavor' in search_opts)
             # flavor is an integer ID
@@ -912,7 +938,7 @@ class ServersControllerTest(test.TestCase):
     def test_get_servers_allows_status(self):
         server_uuid = str(utils.gen_uuid())
 
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None, **kwargs):
             self.assertNotEqual(search_opts, None)
             self.assertTrue('vm_state' in search_opts)
             self.assertEqual(search_opts['vm_state'], vm_states.ACTIVE)
@@ -936,7 +962,7 @@ class ServersControllerTest(test.TestCase):
     def test_get_servers_allows_name(self):
         server_uuid = str(utils.gen_uuid())
 
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None, **kwargs):
             self.assertNotEqual(search_opts, None)
             self.assertTrue('name' in search_opts)
             self.assertEqual(search_opts['name'], 'whee.*')
@@ -954,7 +980,7 @@ class ServersControllerTest(test.TestCase):
     def test_get_servers_allows_changes_since(self):
         server_uuid = str(utils.gen_uuid())
 
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None, **kwargs):
             self.assertNotEqual(search_opts, None)
             self.assertTrue('changes-since' in search_opts)
             changes_since = datetime.datetime(2011, 1, 24, 17, 8, 1)
@@ -987,7 +1013,7 @@ class ServersControllerTest(test.TestCase):
 
         server_uuid = str(utils.gen_uuid())
 
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None, **kwargs):
             self.assertNotEqual(search_opts, None)
             # Allowed by user
             self.assertTrue('name' in search_opts)
@@ -1019,7 +1045,7 @@ class ServersControllerTest(test.TestCase):
 
         server_uuid = str(utils.gen_uuid())
 
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None, **kwargs):
             self.assertNotEqual(search_opts, None)
             # Allowed by user
             self.assertTrue('name' in search_opts)
@@ -1049,7 +1075,7 @@ class ServersControllerTest(test.TestCase):
 
         server_uuid = str(utils.gen_uuid())
 
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None, **kwargs):
             self.assertNotEqual(search_opts, None)
             # Allowed by user
             self.assertTrue('name' in search_opts)
@@ -1077,7 +1103,7 @@ class ServersControllerTest(test.TestCase):
 
         server_uuid = str(utils.gen_uuid())
 
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None, **kwargs):
             self.assertNotEqual(search_opts, None)
             self.assertTrue('ip' in search_opts)
             self.assertEqual(search_opts['ip'], '10\..*')
@@ -1100,7 +1126,7 @@ class ServersControllerTest(test.TestCase):
 
         server_uuid = str(utils.gen_uuid())
 
-        def fake_get_all(compute_self, context, search_opts=None):
+        def fake_get_all(compute_self, context, search_opts=None, **kwargs):
             self.assertNotEqual(search_opts, None)
             self.assertTrue('ip6' in search_opts)
             self.assertEqual(search_opts['ip6'], 'ffff.*')
@@ -32,6 +32,8 @@ flags.DECLARE('fake_network', 'nova.network.manager')
 FLAGS['network_size'].SetDefault(8)
 FLAGS['num_networks'].SetDefault(2)
 FLAGS['fake_network'].SetDefault(True)
+flags.DECLARE('iptables_apply_delay', 'nova.network.linux_net')
+FLAGS['iptables_apply_delay'].SetDefault(0)
 FLAGS['image_service'].SetDefault('nova.image.fake.FakeImageService')
 flags.DECLARE('iscsi_num_targets', 'nova.volume.driver')
 FLAGS['iscsi_num_targets'].SetDefault(8)
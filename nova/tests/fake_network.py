@@ -15,6 +15,8 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import netaddr
+
 from nova import db
 from nova import exception
 from nova import flags
@@ -91,20 +93,59 @@ class FakeNetworkManager(network_manager.NetworkManager):
                       {'address': '172.16.1.2'},
                       {'address': '173.16.1.2'}]
 
-            vifs = [{'instance_id': 0,
+            vifs = [{'id': 0,
+                     'instance_id': 0,
+                     'address': 'de:ad:be:ef:00:01',
                      'fixed_ipv6': '2001:db8::dcad:beff:feef:1',
                      'fixed_ips': [{'address': '172.16.0.1',
                                     'floating_ips': [floats[0]]}]},
-                    {'instance_id': 20,
+                    {'id': 1,
+                     'instance_id': 20,
+                     'address': 'de:ad:be:ef:00:02',
                      'fixed_ipv6': '2001:db8::dcad:beff:feef:2',
                      'fixed_ips': [{'address': '172.16.0.2',
                                     'floating_ips': [floats[1]]}]},
-                    {'instance_id': 30,
+                    {'id': 2,
+                     'instance_id': 30,
+                     'address': 'de:ad:be:ef:00:02',
                      'fixed_ipv6': '2002:db8::dcad:beff:feef:2',
                      'fixed_ips': [{'address': '173.16.0.2',
                                     'floating_ips': [floats[2]]}]}]
             return vifs
 
+        def _fixed_ips(self, context):
+            for vif in self.virtual_interface_get_all(context):
+                for fixed_ip in vif['fixed_ips']:
+                    yield dict(fixed_ip, instance_id=vif['instance_id'],
+                               virtual_interface_id=vif['id'],
+                               deleted=False)
+
+        def _in_ranges(self, address, ranges):
+            address = int(netaddr.IPAddress(address))
+            return any(first <= address <= last for first, last in ranges)
+
+        def fixed_ip_get_by_address_ranges(self, context, ranges):
+            return [fixed_ip for fixed_ip in self._fixed_ips(context)
+                    if self._in_ranges(fixed_ip['address'], ranges)]
+
+        def floating_ip_get_by_address_ranges(self, context, ranges):
+            return [dict(floating_ip, fixed_ip=fixed_ip)
+                    for fixed_ip in self._fixed_ips(context)
+                    for floating_ip in fixed_ip['floating_ips']
+                    if self._in_ranges(floating_ip['address'], ranges)]
+
+        def fixed_ip_get_all_addresses(self, context):
+            for fixed_ip in self._fixed_ips(context):
+                for floating_ip in fixed_ip['floating_ips'] or [None]:
+                    yield (fixed_ip['instance_id'], fixed_ip['address'],
+                           floating_ip and floating_ip['address'])
+
+        def virtual_interface_get_ipv6_addresses(self, context,
+                                                 vif_address=None):
+            for vif in self.virtual_interface_get_all(context):
+                if vif_address in (None, vif['address']):
+                    yield vif['instance_id'], vif['fixed_ipv6']
+
         def instance_get_id_to_uuid_mapping(self, context, ids):
             # NOTE(jkoelker): This is just here until we can rely on UUIDs
             mapping = {}
@@ -241,13 +282,27 @@ def fake_get_instance_nw_info(stubs, num_networks=1, ips_per_vif=2,
                 for i in xrange(num_networks) for j in xrange(ips_per_vif)]
 
     def virtual_interfaces_fake(*args, **kwargs):
-        return [vif for vif in vifs(num_networks)]
+        fixed_ips = fixed_ips_fake()
+        for fixed_ip in fixed_ips:
+            fixed_ip['deleted'] = False
+        return [dict(vif, fixed_ips=[fixed_ip for fixed_ip in fixed_ips
+                     if fixed_ip['virtual_interface_id'] == vif['id']])
+                for vif in vifs(num_networks)]
 
     def instance_type_fake(*args, **kwargs):
         return flavor
 
+    def instance_info_cache_get_fake(*args, **kwargs):
+        return None
+
+    def instance_info_cache_update_fake(*args, **kwargs):
+        pass
+
     stubs.Set(db, 'fixed_ip_get_by_instance', fixed_ips_fake)
     stubs.Set(db, 'virtual_interface_get_by_instance', virtual_interfaces_fake)
     stubs.Set(db, 'instance_type_get', instance_type_fake)
+    stubs.Set(db, 'instance_info_cache_get', instance_info_cache_get_fake)
+    stubs.Set(db, 'instance_info_cache_update',
+              instance_info_cache_update_fake)
 
     return network.get_instance_nw_info(None, 0, 0, None)
@@ -17,16 +17,23 @@
 
 
 import datetime
+import StringIO
 import stubout
 
+from glance.common import exception as glance_exception
+
 from nova.tests.api.openstack import fakes
 from nova import context
 from nova import exception
+from nova import flags
 from nova.image import glance
 from nova import test
 from nova.tests.glance import stubs as glance_stubs
 
 
+FLAGS = flags.FLAGS
+
+
 class NullWriter(object):
     """Used to test ImageService.get which takes a writer object"""
 
@@ -204,6 +211,110 @@ class TestGlanceImageService(test.TestCase):
                           self.context,
                           'bad image id')
 
+    def _count_calls(self, method_name):
+        calls = []
+        client = self.service._get_client(self.context)
+        method = getattr(client, method_name)
+
+        def counted(*args, **kwargs):
+            calls.append(kwargs)
+            return method(*args, **kwargs)
+
+        self.stubs.Set(client, method_name, counted)
+        return calls
+
+    def test_show_caches_active_images(self):
+        fixture = self._make_fixture(name='image1', status='active')
+        image_id = self.service.create(self.context, fixture)['id']
+        calls = self._count_calls('get_image_meta')
+        now = [1000.0]
+        self.stubs.Set(glance.time, 'time', lambda: now[0])
+
+        self.service.show(self.context, image_id)
+        self.service.show(self.context, image_id)
+        self.assertEqual(len(calls), 1)
+
+        now[0] += FLAGS.glance_image_cache_ttl
+        self.service.show(self.context, image_id)
+        self.assertEqual(len(calls), 2)
+
+    def test_show_does_not_cache_inactive_images(self):
+        fixture = self._make_fixture(name='image1', status='queued')
+        image_id = self.service.create(self.context, fixture)['id']
+        calls = self._count_calls('get_image_meta')
+
+        self.service.show(self.context, image_id)
+        self.service.show(self.context, image_id)
+        self.assertEqual(len(calls), 2)
+
+    def test_update_uncaches_image(self):
+        fixture = self._make_fixture(name='image1', status='active')
+        image_id = self.service.create(self.context, fixture)['id']
+        self.service.show(self.context, image_id)
+
+        self.service.update(self.context, image_id,
+                            self._make_fixture(name='image2',
+                                               status='active'))
+        self.assertEqual(self.service.show(self.context, image_id)['name'],
+                         'image2')
+
+    def test_show_by_name_filters_and_caches(self):
+        for name in ('image1', 'image2'):
+            self.service.create(self.context,
+                                self._make_fixture(name=name,
+                                                   status='active'))
+        calls = self._count_calls('get_images_detailed')
+
+        image_meta = self.service.show_by_name(self.context, 'image2')
+        self.assertEqual(image_meta['name'], 'image2')
+        self.assertEqual(calls[0]['filters']['name'], 'image2')
+
+        image_meta = self.service.show_by_name(self.context, 'image2')
+        self.assertEqual(image_meta['name'], 'image2')
+        self.assertEqual(len(calls), 1)
+
+    def test_cache_keeps_private_images_per_project(self):
+        private_id = self.service.create(self.context,
+                self._make_fixture(name='private', status='active',
+                                   is_public=False))['id']
+        public_id = self.service.create(self.context,
+                self._make_fixture(name='public', status='active',
+                                   is_public=True))['id']
+        self.service.show(self.context, private_id)
+        self.service.show(self.context, public_id)
+
+        # NOTE: glance hides the private image from other projects
+        client = self.service._get_client(self.context)
+        get_image_meta = client.get_image_meta
+
+        def fake_get_image_meta(image_id):
+            if str(image_id) == str(private_id):
+                raise glance_exception.NotFound()
+            return get_image_meta(image_id)
+
+        self.stubs.Set(client, 'get_image_meta', fake_get_image_meta)
+        calls = self._count_calls('get_image_meta')
+        other = context.RequestContext('other', 'other', auth_token=True)
+
+        self.assertRaises(exception.ImageNotFound,
+                          self.service.show, other, private_id)
+        self.assertEqual(self.service.show(other, public_id)['name'],
+                         'public')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.service.show(self.context,
+                                           private_id)['name'], 'private')
+        self.assertEqual(len(calls), 1)
+
+    def test_fetch_images_pages_without_recursion(self):
+        def fetch_func(marker=None, **kwargs):
+            marker = marker or 0
+            if marker >= 2000:
+                return []
+            return [{'id': marker + 1}]
+
+        image_metas = list(self.service._fetch_images(fetch_func))
+        self.assertEqual(len(image_metas), 2000)
+
     def test_index(self):
         fixture = self._make_fixture(name='test image')
         image_id = self.service.create(self.context, fixture)['id']
@@ -537,6 +648,112 @@ class TestGlanceImageService(test.TestCase):
         self.flags(glance_num_retries=1)
         service.get(self.context, image_id, writer)
 
+    def _ranged_client(self, image_data, supports_ranges=True,
+                       fail_at=None, ranges_until=None):
+        """A client serving image_data that breaks off the first response
+        covering byte fail_at there, and ignores Range headers asking for
+        ranges_until and later."""
+        requests = []
+        failed = []
+        self.stubs.Set(glance.time, 'sleep', lambda seconds: None)
+
+        class FakeResponse(object):
+            def __init__(self, status, data, offset):
+                self.status = status
+                self.data = data
+                self.offset = offset
+
+            def read(self, amt):
+                if (fail_at is not None and not failed and
+                    self.offset <= fail_at < self.offset + len(self.data)):
+                    amt = min(amt, fail_at - self.offset)
+                    if not amt:
+                        failed.append(self.offset)
+                        raise IOError('connection reset')
+                chunk, self.data = self.data[:amt], self.data[amt:]
+                self.offset += len(chunk)
+                return chunk
+
+            def close(self):
+                pass
+
+        class MyGlanceStubClient(glance_stubs.StubGlanceClient):
+            def get_image_meta(self, image_id):
+                return {'id': image_id, 'size': len(image_data)}
+
+            def get_image(self, image_id):
+                requests.append(None)
+                res = FakeResponse(200, image_data, 0)
+                return (self.get_image_meta(image_id),
+                        iter(lambda: res.read(3), ''))
+
+            def do_request(self, method, action, headers=None):
+                start, end = headers['Range'][6:].split('-')
+                start = int(start)
+                end = int(end or len(image_data) - 1) + 1
+                requests.append((start, end))
+                if not supports_ranges or (ranges_until is not None and
+                                           start >= ranges_until):
+                    return FakeResponse(200, image_data, 0)
+                return FakeResponse(206, image_data[start:end], start)
+
+        return MyGlanceStubClient(), requests
+
+    def _get(self, client):
+        writer = StringIO.StringIO()
+        service = glance.GlanceImageService(client=client)
+        service.get(self.context, 1, writer)
+        return writer.getvalue()
+
+    def test_get_in_ranges(self):
+        self.flags(glance_download_range_size=10,
+                   glance_download_concurrency=3)
+        image_data = ''.join(chr(i) for i in xrange(256)) * 2
+        client, requests = self._ranged_client(image_data)
+
+        self.assertEqual(self._get(client), image_data)
+        self.assertEqual(requests, [(start, min(start + 10, 512))
+                                    for start in xrange(0, 512, 10)])
+
+    def test_get_in_ranges_resumes(self):
+        self.flags(glance_download_range_size=10,
+                   glance_download_concurrency=3,
+                   glance_num_retries=1)
+        image_data = ''.join(chr(i) for i in xrange(100))
+        client, requests = self._ranged_client(image_data, fail_at=25)
+
+        self.assertEqual(self._get(client), image_data)
+        self.assertTrue((25, 30) in requests)
+
+    def test_get_without_range_support_streams(self):
+        self.flags(glance_download_range_size=10,
+                   glance_download_concurrency=3)
+        image_data = ''.join(chr(i) for i in xrange(100))
+        client, requests = self._ranged_client(image_data,
+                                               supports_ranges=False)
+
+        self.assertEqual(self._get(client), image_data)
+        self.assertEqual(requests, [(0, 10), None])
+
+    def test_get_ranges_dropped_partway_streams_the_rest(self):
+        self.flags(glance_download_range_size=10,
+                   glance_download_concurrency=2)
+        image_data = ''.join(chr(i) for i in xrange(50))
+        client, requests = self._ranged_client(image_data, ranges_until=20)
+
+        self.assertEqual(self._get(client), image_data)
+        self.assertEqual(requests[-1], (20, 50))
+
+    def test_get_stream_resumes(self):
+        self.flags(glance_download_concurrency=1, glance_num_retries=1)
+        image_data = ''.join(chr(i) for i in xrange(100))
+        client, requests = self._ranged_client(image_data,
+                                               supports_ranges=False,
+                                               fail_at=42)
+
+        self.assertEqual(self._get(client), image_data)
+        self.assertEqual(requests, [None, (42, 100)])
+
     def test_glance_client_image_id(self):
         fixture = self._make_fixture(name='test image')
         image_id = self.service.create(self.context, fixture)['id']
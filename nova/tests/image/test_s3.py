@@ -15,10 +15,20 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import binascii
+import os
+import shutil
+import tarfile
+import tempfile
+
+import eventlet
+
 from nova import context
+from nova import crypto
 import nova.db.api
 from nova import exception
 from nova import test
+from nova import utils
 from nova.image import s3
 
 
@@ -55,6 +65,41 @@ ami_manifest_xml = """<?xml version="1.0" ?>
 """
 
 
+bundle_manifest_xml = """<?xml version="1.0" ?>
+<manifest>
+        <version>2011-06-17</version>
+        <machine_configuration>
+                <architecture>x86_64</architecture>
+        </machine_configuration>
+        <image>
+                <ec2_encrypted_key>%(key)s</ec2_encrypted_key>
+                <ec2_encrypted_iv>%(iv)s</ec2_encrypted_iv>
+                <parts count="%(count)d">%(parts)s</parts>
+        </image>
+</manifest>
+"""
+
+
+class FakeKey(object):
+    def __init__(self, contents):
+        self.contents = contents
+
+    def get_contents_as_string(self):
+        if isinstance(self.contents, Exception):
+            raise self.contents
+        return self.contents
+
+
+class FakeBucket(object):
+    def __init__(self, files):
+        self.files = files
+        self.requested = []
+
+    def get_key(self, name):
+        self.requested.append(name)
+        return FakeKey(self.files[name])
+
+
 class TestS3ImageService(test.TestCase):
     def setUp(self):
         super(TestS3ImageService, self).setUp()
@@ -125,3 +170,161 @@ class TestS3ImageService(test.TestCase):
             {'device_name': '/dev/sdb0',
              'no_device': True}]
         self.assertEqual(block_device_mapping, expected_bdm)
+
+    def _make_bundle(self, image_data, part_size, tarred=True):
+        """Encrypts a tarred image the way euca-bundle-image does."""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        image_file = os.path.join(tmpdir, 'image')
+        with open(image_file, 'w') as f:
+            f.write(image_data)
+        if tarred:
+            tar_file = tarfile.open(os.path.join(tmpdir, 'image.tar.gz'),
+                                    'w:gz')
+            tar_file.add(image_file, 'image')
+            tar_file.close()
+            image_file = tar_file.name
+
+        key = binascii.b2a_hex(os.urandom(16))
+        iv = binascii.b2a_hex(os.urandom(16))
+        encrypted, _err = utils.execute('openssl', 'enc', '-e',
+                                        '-aes-128-cbc', '-K', key, '-iv', iv,
+                                        '-in', image_file)
+        # NOTE: the key and iv are sent in the clear, the rsa step
+        #       is stubbed out below
+        self.stubs.Set(s3.S3ImageService, '_decrypt_image_key',
+                       staticmethod(lambda key, iv, pk: (key, iv)))
+        self.stubs.Set(crypto, 'key_path', lambda project_id: None)
+
+        files = {}
+        parts = ''
+        for i in xrange(0, len(encrypted), part_size):
+            name = 'image.part.%d' % i
+            files[name] = encrypted[i:i + part_size]
+            parts += '<part index="%d"><filename>%s</filename></part>' % (
+                    i, name)
+        files['image.manifest.xml'] = bundle_manifest_xml % {
+                'key': binascii.b2a_hex(key),
+                'iv': binascii.b2a_hex(iv),
+                'count': len(files), 'parts': parts}
+        return FakeBucket(files)
+
+    def _register(self, bucket):
+        uploads = []
+        states = []
+        service = self.image_service.service
+        real_update = service.update
+
+        def fake_update(context, image_id, metadata, data=None):
+            states.append(metadata['properties']['image_state'])
+            if data is not None:
+                uploads.append(''.join(iter(lambda: data.read(4096), '')))
+            return real_update(context, image_id, metadata, data)
+
+        self.stubs.Set(service, 'update', fake_update)
+        conn = self.mox.CreateMockAnything()
+        conn.get_bucket('bucket').AndReturn(bucket)
+        self.stubs.Set(s3.S3ImageService, '_conn',
+                       staticmethod(lambda context: conn))
+        self.mox.ReplayAll()
+
+        metadata = {'properties': {
+            'image_location': 'bucket/image.manifest.xml'}}
+        image = self.image_service._s3_create(self.context, metadata)
+        for _i in xrange(100):
+            if states[-1:] in (['available'], ['failed_download'],
+                               ['failed_decrypt'], ['failed_untar'],
+                               ['failed_upload']):
+                break
+            eventlet.sleep(0.01)
+        return image, states, uploads
+
+    def test_s3_create_streams_bundle(self):
+        self.flags(s3_image_download_concurrency=2)
+        image_data = os.urandom(300 * 1024)
+        bucket = self._make_bundle(image_data, 10 * 1024)
+
+        image, states, uploads = self._register(bucket)
+
+        self.assertEqual(states, ['downloading', 'decrypting',
+                                  'untarring', 'uploading', 'uploading',
+                                  'available'])
+        self.assertEqual(uploads, [image_data])
+        self.assertEqual(sorted(bucket.requested), sorted(bucket.files))
+        self.assertTrue(len(bucket.files) > 30)
+        ret_image = self.image_service.show(self.context, image['id'])
+        self.assertEqual(ret_image['status'], 'active')
+
+    def test_download_parts_is_bounded(self):
+        self.flags(s3_image_download_concurrency=3)
+        bucket = FakeBucket(dict(('part%d' % i, str(i)) for i in xrange(10)))
+        parts = self.image_service._download_parts(
+                bucket, ['part%d' % i for i in xrange(10)])
+
+        self.assertEqual(parts.next(), '0')
+        eventlet.sleep(0)
+        self.assertEqual(bucket.requested, ['part0', 'part1', 'part2'])
+        self.assertEqual(list(parts), [str(i) for i in xrange(1, 10)])
+
+    def test_s3_create_failed_part_download(self):
+        bucket = self._make_bundle(os.urandom(64 * 1024), 10 * 1024)
+        bucket.files['image.part.20480'] = IOError('boom')
+
+        _image, states, uploads = self._register(bucket)
+
+        self.assertEqual(states[-1], 'failed_download')
+
+    def test_s3_create_bad_tarball(self):
+        bucket = self._make_bundle(os.urandom(64 * 1024), 10 * 1024,
+                                   tarred=False)
+
+        _image, states, uploads = self._register(bucket)
+
+        self.assertEqual(states[-1], 'failed_untar')
+
+    def test_s3_create_stops_downloading_after_failure(self):
+        self.flags(s3_image_download_concurrency=1)
+        bucket = self._make_bundle(os.urandom(2 * 1024 * 1024), 10 * 1024,
+                                   tarred=False)
+
+        _image, states, uploads = self._register(bucket)
+
+        self.assertEqual(states[-1], 'failed_untar')
+        self.assertTrue(len(bucket.requested) < len(bucket.files) / 2)
+
+    def _rejected_key(self, bucket):
+        """Returns a key that openssl fails to decrypt bucket with.
+
+        A wrong key only fails when the padding of the last block comes
+        out invalid, which it does not for every key.
+
+        """
+        names = sorted((name for name in bucket.files
+                        if name.startswith('image.part.')),
+                       key=lambda name: int(name.rsplit('.', 1)[1]))
+        encrypted = ''.join(bucket.files[name] for name in names)
+        for i in xrange(256):
+            key = '%02x' % i * 16
+            last_block, _err = utils.execute('openssl', 'enc', '-d',
+                    '-aes-128-cbc', '-nopad', '-K', key,
+                    '-iv', binascii.b2a_hex(encrypted[-32:-16]),
+                    process_input=encrypted[-16:])
+            padding = ord(last_block[-1])
+            if not 1 <= padding <= 16 or \
+               last_block[-padding:] != last_block[-1] * padding:
+                return key
+
+    def test_s3_create_bad_key(self):
+        # NOTE: one part small enough to be written before tar gets to
+        #       read, so openssl has seen all of it when tar fails
+        bucket = self._make_bundle(os.urandom(16 * 1024), 64 * 1024)
+        key = self._rejected_key(bucket)
+        self.stubs.Set(s3.S3ImageService, '_decrypt_image_key',
+                       staticmethod(lambda encrypted_key, encrypted_iv, pk:
+                                    (key, '00' * 16)))
+
+        _image, states, uploads = self._register(bucket)
+
+        # NOTE: tar chokes on the garbage first, but decrypting is
+        #       the stage that failed
+        self.assertEqual(states[-1], 'failed_decrypt')
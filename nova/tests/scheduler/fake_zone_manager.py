@@ -32,6 +32,7 @@ class FakeZoneManager(zone_manager.ZoneManager):
        host4: free_ram_mb=8192  free_disk_gb=8192"""
 
     def __init__(self):
+        super(FakeZoneManager, self).__init__()
         self.service_states = {
             'host1': {
                 'compute': {'host_memory_free': 1073741824},
@@ -55,18 +56,13 @@ class FakeZoneManager(zone_manager.ZoneManager):
             ('host4', dict(free_disk_gb=8192, free_ram_mb=8192)),
         ]
 
-    def _compute_node_get_all(self, context):
+    def _compute_node_get_all_with_usage(self, context):
         return [
-            dict(local_gb=1024, memory_mb=1024, service=dict(host='host1')),
-            dict(local_gb=2048, memory_mb=2048, service=dict(host='host2')),
-            dict(local_gb=4096, memory_mb=4096, service=dict(host='host3')),
-            dict(local_gb=8192, memory_mb=8192, service=dict(host='host4')),
-        ]
-
-    def _instance_get_all(self, context):
-        return [
-            dict(local_gb=512, memory_mb=512, host='host1'),
-            dict(local_gb=512, memory_mb=512, host='host1'),
-            dict(local_gb=512, memory_mb=512, host='host2'),
-            dict(local_gb=1024, memory_mb=1024, host='host3'),
+            dict(host='host1', free_disk_gb=0, free_ram_mb=0, free_vcpus=0),
+            dict(host='host2', free_disk_gb=1536, free_ram_mb=1536,
+                 free_vcpus=0),
+            dict(host='host3', free_disk_gb=3072, free_ram_mb=3072,
+                 free_vcpus=0),
+            dict(host='host4', free_disk_gb=8192, free_ram_mb=8192,
+                 free_vcpus=0),
         ]
@@ -16,14 +16,17 @@
 Tests For Distributed Scheduler.
 """
 
+import datetime
 import json
 
 import nova.db
 
 from nova import context
 from nova import exception
+from nova import flags
 from nova import rpc
 from nova import test
+from nova import utils
 from nova.compute import api as compute_api
 from nova.scheduler import distributed_scheduler
 from nova.scheduler import least_cost
@@ -31,17 +34,18 @@ from nova.scheduler import zone_manager
 from nova.tests.scheduler import fake_zone_manager as ds_fakes
 
 
+FLAGS = flags.FLAGS
+
+
 class FakeEmptyZoneManager(zone_manager.ZoneManager):
     def __init__(self):
+        super(FakeEmptyZoneManager, self).__init__()
         self.service_states = {}
 
     def get_host_list_from_db(self, context):
         return []
 
-    def _compute_node_get_all(*args, **kwargs):
-        return []
-
-    def _instance_get_all(*args, **kwargs):
+    def _compute_node_get_all_with_usage(*args, **kwargs):
         return []
 
 
@@ -172,6 +176,45 @@ class DistributedSchedulerTestCase(test.TestCase):
         self.assertFalse(self.locally_called)
         self.assertEquals(instances, [2])
 
+    def test_run_instance_casts_in_bulk(self):
+        """Instances built locally are cast to their hosts together."""
+        self.bulk_casts = []
+
+        def _fake_schedule(*args, **kwargs):
+            return [least_cost.WeightedHost(1, host='host1'),
+                    least_cost.WeightedHost(2, host='host2')]
+
+        def _fake_create_instance_db_entry(context, request_spec):
+            return dict(id=len(self.bulk_casts) + 100, local_gb=1,
+                        memory_mb=512)
+
+        def _fake_cast(*args, **kwargs):
+            self.fail(_("Instances should not be cast one by one"))
+
+        def _fake_bulk_cast(context, topic_msgs):
+            self.bulk_casts.append(topic_msgs)
+
+        def _fake_queue_get_for(context, topic, host):
+            return '%s.%s' % (topic, host)
+
+        sched = ds_fakes.FakeDistributedScheduler()
+        sched.zone_manager = ds_fakes.FakeZoneManager()
+        self.stubs.Set(sched, '_schedule', _fake_schedule)
+        self.stubs.Set(sched, 'create_instance_db_entry',
+                       _fake_create_instance_db_entry)
+        self.stubs.Set(nova.db, 'instance_update', lambda *args: None)
+        self.stubs.Set(nova.db, 'queue_get_for', _fake_queue_get_for)
+        self.stubs.Set(rpc, 'cast', _fake_cast)
+        self.stubs.Set(rpc, 'bulk_cast', _fake_bulk_cast)
+
+        fake_context = context.RequestContext('user', 'project')
+        instances = sched.schedule_run_instance(fake_context,
+                                                dict(num_instances=2))
+        self.assertEqual(len(instances), 2)
+        self.assertEqual(len(self.bulk_casts), 1)
+        self.assertEqual([topic for topic, msg in self.bulk_casts[0]],
+                         ['compute.host1', 'compute.host2'])
+
     def test_run_instance_non_admin(self):
         """Test creating an instance locally using run_instance, passing
         a non-admin context.  DB actions should work."""
@@ -215,17 +258,16 @@ class DistributedSchedulerTestCase(test.TestCase):
                                                                 options):
             return unfiltered_hosts
 
-        def _fake_weighted_sum(functions, hosts, options):
+        def _fake_weighted_host_score(functions, hostinfo, options):
             self.next_weight += 2.0
-            host, hostinfo = hosts[0]
-            return least_cost.WeightedHost(self.next_weight, host=host,
-                                           hostinfo=hostinfo)
+            return self.next_weight
 
         sched = ds_fakes.FakeDistributedScheduler()
         fake_context = context.RequestContext('user', 'project')
         sched.zone_manager = ds_fakes.FakeZoneManager()
         self.stubs.Set(sched, '_filter_hosts', _fake_filter_hosts)
-        self.stubs.Set(least_cost, 'weighted_sum', _fake_weighted_sum)
+        self.stubs.Set(least_cost, 'weighted_host_score',
+                       _fake_weighted_host_score)
         self.stubs.Set(nova.db, 'zone_get_all', fake_zone_get_all)
         self.stubs.Set(sched, '_call_zone_method', fake_call_zone_method)
 
@@ -243,6 +285,67 @@ class DistributedSchedulerTestCase(test.TestCase):
                 self.assertTrue(weighted_host.host != None)
                 self.assertTrue(weighted_host.zone == None)
 
+    def test_schedule_multiple_instances_locally(self):
+        """Each instance virtually consumes resources on its host, so a
+        batch spreads out once the best host is full."""
+        self.flags(reserved_host_disk_mb=0, reserved_host_memory_mb=0)
+
+        def _fake_empty_call_zone_method(*args, **kwargs):
+            return []
+
+        sched = ds_fakes.FakeDistributedScheduler()
+        fake_context = context.RequestContext('user', 'project')
+        sched.zone_manager = ds_fakes.FakeZoneManager()
+        self.stubs.Set(sched, '_call_zone_method',
+                       _fake_empty_call_zone_method)
+        self.stubs.Set(nova.db, 'zone_get_all', fake_zone_get_all)
+
+        # host1 is full; fill-first prefers the host with the least
+        # free ram that still fits.
+        instance_type = dict(memory_mb=1024, local_gb=1)
+        request_spec = dict(num_instances=4, instance_type=instance_type)
+        weighted_hosts = sched._schedule(fake_context, 'compute',
+                                         request_spec)
+        self.assertEqual([weighted_host.host
+                          for weighted_host in weighted_hosts],
+                         ['host3', 'host2', 'host3', 'host3'])
+        self.assertEqual([weighted_host.weight
+                          for weighted_host in weighted_hosts],
+                         [1024, 1536, 2048, 3072])
+
+    def test_select_from_child_zones_cached(self):
+        """Identical select requests reuse the child zone answers until
+        they expire."""
+        self.child_calls = 0
+
+        def _counting_call_zone_method(*args, **kwargs):
+            self.child_calls += 1
+            return fake_call_zone_method(*args, **kwargs)
+
+        sched = ds_fakes.FakeDistributedScheduler()
+        self.stubs.Set(sched, '_call_zone_method',
+                       _counting_call_zone_method)
+        zones = fake_zone_get_all(None)
+        request_spec = dict(num_instances=1,
+                            instance_type=dict(memory_mb=512, local_gb=1))
+
+        first = sched._select_from_child_zones(None, request_spec, zones)
+        second = sched._select_from_child_zones(None, request_spec, zones)
+        self.assertEqual(first, second)
+        self.assertEqual(self.child_calls, 1)
+
+        request_spec['num_instances'] = 2
+        sched._select_from_child_zones(None, request_spec, zones)
+        self.assertEqual(self.child_calls, 2)
+
+        utils.set_time_override(utils.utcnow() + datetime.timedelta(
+                seconds=FLAGS.zone_select_cache_seconds + 1))
+        try:
+            sched._select_from_child_zones(None, request_spec, zones)
+        finally:
+            utils.clear_time_override()
+        self.assertEqual(self.child_calls, 3)
+
     def test_decrypt_blob(self):
         """Test that the decrypt method works."""
 
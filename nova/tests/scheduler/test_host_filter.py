@@ -164,6 +164,22 @@ class HostFilterTestCase(test.TestCase):
         just_hosts = [host for host, caps in hosts]
         self.assertEquals('host4', just_hosts[0])
 
+    def test_instance_type_filter_extra_specs_index(self):
+        zm = ds_fakes.FakeZoneManager()
+        for host, services in self.zone_manager.service_states.iteritems():
+            zm.update_service_capabilities('compute', host,
+                                           dict(services['compute']))
+        hf = nova.scheduler.filters.InstanceTypeFilter(zm)
+        self.mox.StubOutWithMock(hf, '_satisfies_extra_specs')
+        self.mox.ReplayAll()
+
+        cooked = hf.instance_type_to_filter(self.gpu_instance_type)
+        all_hosts = self._get_all_hosts()
+        hosts = hf.filter_hosts(all_hosts, cooked, {})
+        self.assertEquals(1, len(hosts))
+        just_hosts = [host for host, caps in hosts]
+        self.assertEquals('host4', just_hosts[0])
+
     def test_json_filter(self):
         hf = nova.scheduler.filters.JsonFilter()
         # filter all hosts that can support 30 ram and 300 disk
@@ -251,3 +267,24 @@ class HostFilterTestCase(test.TestCase):
 
         self.assertFalse(hf.filter_hosts(all_hosts,
                 json.dumps(['=', {}, ['>', '$missing....foo']]), {}))
+
+    def test_json_filter_caches_compiled_queries(self):
+        hf = nova.scheduler.filters.JsonFilter()
+        all_hosts = self._get_all_hosts()
+        cooked = hf.instance_type_to_filter(self.instance_type)
+        hosts = hf.filter_hosts(all_hosts, cooked, {})
+        self.assertEquals(1, len(hf.compiled_queries))
+        compiled = hf.compiled_queries[cooked]
+
+        # The same query text reuses the compiled form ...
+        self.assertEquals(hosts, hf.filter_hosts(all_hosts, cooked, {}))
+        self.assertEquals(1, len(hf.compiled_queries))
+        self.assertTrue(compiled is hf.compiled_queries[cooked])
+
+        # ... and the cache is bounded.
+        hf.max_compiled_queries = 2
+        hf.filter_hosts(all_hosts, json.dumps(['=', '$compute.enabled',
+                                               True]), {})
+        self.assertEquals(2, len(hf.compiled_queries))
+        hf.filter_hosts(all_hosts, json.dumps(['not', False]), {})
+        self.assertEquals(1, len(hf.compiled_queries))
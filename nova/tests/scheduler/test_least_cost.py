@@ -15,6 +15,8 @@
 """
 Tests For Least Cost functions.
 """
+import heapq
+
 from nova.scheduler import least_cost
 from nova.scheduler import zone_manager
 from nova import test
@@ -80,3 +82,25 @@ class LeastCostTestCase(test.TestCase):
                                                                     options)
         self.assertEqual(weighted_host.weight, 10000)
         self.assertEqual(weighted_host.host, 'host1')
+
+    def test_weighted_host_heap(self):
+        fn_tuples = [(1.0, offset), (1.0, scale)]
+        hostinfo_list = self.zone_manager.get_all_host_data(None).items()
+
+        # Same scores as weighted_sum, best first.
+        options = {}
+        heap = least_cost.weighted_host_heap(fn_tuples, hostinfo_list,
+                                             options)
+        weight, host, hostinfo = heapq.heappop(heap)
+        self.assertEqual(weight, 10000)
+        self.assertEqual(host, 'host1')
+        weight, host, hostinfo = heapq.heappop(heap)
+        self.assertEqual(weight, 14608)
+        self.assertEqual(host, 'host2')
+        self.assertEqual(len(heap), 2)
+
+    def test_weighted_host_score(self):
+        fn_tuples = [(1.0, offset), (0.5, scale)]
+        hostinfo = zone_manager.HostInfo('host', free_ram_mb=1000)
+        score = least_cost.weighted_host_score(fn_tuples, hostinfo, {})
+        self.assertEqual(score, 12000)
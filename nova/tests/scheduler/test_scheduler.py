@@ -21,7 +21,9 @@ Tests For Scheduler
 
 import datetime
 import mox
+import time
 
+import eventlet
 from novaclient import v1_1 as novaclient
 from novaclient import exceptions as novaclient_exceptions
 
@@ -1199,8 +1201,10 @@ class ZoneRedirectTest(test.TestCase):
         self.stubs.Set(db, 'instance_get_by_uuid',
                        fake_instance_get_by_uuid)
         self.flags(enable_zone_routing=True)
+        api.zone_client_pool.clear()
 
     def tearDown(self):
+        api.zone_client_pool.clear()
         super(ZoneRedirectTest, self).tearDown()
 
     def test_trap_found_locally(self):
@@ -1413,12 +1417,19 @@ class FakeZonesProxy(object):
     def do_something(self, *args, **kwargs):
         return 42
 
+    def sleeps(self, *args, **kwargs):
+        eventlet.sleep(10)
+        return 42
+
     def raises_exception(self, *args, **kwargs):
         raise Exception('testing')
 
 
 class FakeNovaClientZones(object):
+    created = 0
+
     def __init__(self, *args, **kwargs):
+        FakeNovaClientZones.created += 1
         self.zones = FakeZonesProxy()
 
     def authenticate(self):
@@ -1430,8 +1441,10 @@ class CallZoneMethodTest(test.TestCase):
         super(CallZoneMethodTest, self).setUp()
         self.stubs.Set(db, 'zone_get_all', zone_get_all)
         self.stubs.Set(novaclient, 'Client', FakeNovaClientZones)
+        api.zone_client_pool.clear()
 
     def tearDown(self):
+        api.zone_client_pool.clear()
         super(CallZoneMethodTest, self).tearDown()
 
     def test_call_zone_method(self):
@@ -1452,3 +1465,20 @@ class CallZoneMethodTest(test.TestCase):
         context = FakeContext()
         method = 'raises_exception'
         self.assertRaises(Exception, api.call_zone_method, context, method)
+
+    def test_call_zone_method_reuses_clients(self):
+        context = FakeContext()
+        FakeNovaClientZones.created = 0
+        api.call_zone_method(context, 'do_something')
+        results = api.call_zone_method(context, 'do_something')
+        self.assertEqual(FakeNovaClientZones.created, 2)
+        self.assertIn((1, 42), results)
+        self.assertIn((2, 42), results)
+
+    def test_call_zone_method_deadline(self):
+        self.flags(zone_call_timeout=0.1)
+        context = FakeContext()
+        start = time.time()
+        results = api.call_zone_method(context, 'sleeps')
+        self.assertEqual(results, [])
+        self.assertTrue(time.time() - start < 5)
@@ -873,6 +873,22 @@ class ComputeTestCase(BaseTestCase):
         self.assertEqual(len(instances), 1)
         self.assertEqual(power_state.NOSTATE, instances[0]['power_state'])
 
+    def test_manage_image_cache_prefetches_most_used(self):
+        self.flags(image_cache_prefetch_count=1)
+        for image_ref in ('popular', 'popular', 'rare'):
+            self._create_instance({'image_ref': image_ref,
+                                   'kernel_id': 'aki', 'ramdisk_id': 'ari'})
+        prefetched = []
+        self.stubs.Set(self.compute.driver, 'manage_image_cache',
+                       lambda context, images: prefetched.append(images))
+
+        self.compute._manage_image_cache(context.get_admin_context())
+        self.compute._manage_image_cache(context.get_admin_context())
+
+        self.assertEqual(prefetched, [[{'image_ref': 'popular',
+                                        'kernel_id': 'aki',
+                                        'ramdisk_id': 'ari'}]])
+
 
 class ComputeAPITestCase(BaseTestCase):
 
@@ -1047,6 +1063,42 @@ class ComputeAPITestCase(BaseTestCase):
         finally:
             db.instance_destroy(self.context, ref[0]['id'])
 
+    def test_security_group_members_refresh_each_group(self):
+        """Every changed group is refreshed on the hosts that use it"""
+        group = self._create_group()
+        src_groups = [db.security_group_create(self.context,
+                                               {'name': 'src%d' % i,
+                                                'description': 'src',
+                                                'user_id': self.user_id,
+                                                'project_id': self.project_id})
+                      for i in xrange(2)]
+        for src_group in src_groups:
+            db.security_group_rule_create(self.context,
+                                          {'parent_group_id': group['id'],
+                                           'protocol': 'tcp',
+                                           'from_port': 22,
+                                           'to_port': 22,
+                                           'group_id': src_group['id']})
+        instance_id = self._create_instance({'host': 'host1'})
+        db.instance_add_security_group(self.context, instance_id,
+                                       group['id'])
+
+        casts = []
+
+        def fake_cast(context, topic, msg):
+            casts.append((topic, msg['method'],
+                          msg['args']['security_group_id']))
+
+        self.stubs.Set(rpc, 'cast', fake_cast)
+        self.compute_api.trigger_security_group_members_refresh(
+                self.context, [src_group['id'] for src_group in src_groups])
+
+        topic = db.queue_get_for(self.context, FLAGS.compute_topic, 'host1')
+        self.assertEqual(sorted(casts),
+                         [(topic, 'refresh_security_group_members',
+                           src_group['id']) for src_group in src_groups])
+        db.instance_destroy(self.context, instance_id)
+
     def test_rebuild(self):
         instance_id = self._create_instance()
         self.compute.run_instance(self.context, instance_id)
@@ -1270,6 +1322,36 @@ class ComputeAPITestCase(BaseTestCase):
         db.instance_destroy(c, instance_id2)
         db.instance_destroy(c, instance_id3)
 
+    def test_get_all_pages_across_child_zones(self):
+        """Test paging through local and child zone instances together"""
+        c = context.get_admin_context()
+        instance_id1 = self._create_instance()
+        instance_id2 = self._create_instance()
+
+        class Server(object):
+            _info = {'id': 'child-uuid', 'name': 'child'}
+
+        def fake_call_zone_method(*args, **kwargs):
+            return [(1, [Server()])]
+
+        self.stubs.Set(nova.scheduler.api, 'call_zone_method',
+                       fake_call_zone_method)
+
+        instances = self.compute_api.get_all(c, marker=str(instance_id2),
+                                             limit=2)
+        self.assertEqual([instance['id'] for instance in instances],
+                         [instance_id1, 'child-uuid'])
+        self.assertRaises(exception.MarkerNotFound,
+                          self.compute_api.get_all, c, marker='missing')
+
+        instances = self.compute_api.get_all(c, limit=1,
+                search_opts={'local_zone_only': True})
+        self.assertEqual([instance['id'] for instance in instances],
+                         [instance_id2])
+
+        db.instance_destroy(c, instance_id1)
+        db.instance_destroy(c, instance_id2)
+
     def test_get_all_by_instance_name_regexp(self):
         """Test searching instances by name"""
         self.flags(instance_name_template='instance-%d')
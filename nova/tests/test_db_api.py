@@ -20,10 +20,14 @@
 
 import datetime
 
+import netaddr
+
 from nova import test
 from nova import context
 from nova import db
+from nova import exception
 from nova import flags
+from nova import ipv6
 
 FLAGS = flags.FLAGS
 
@@ -101,6 +105,137 @@ class DbApiTestCase(test.TestCase):
         else:
             self.assertTrue(result[1].deleted)
 
+    def test_instance_get_all_by_filters_regexp_and_metadata(self):
+        for name, meta in [('web-1', {'role': 'web'}),
+                           ('Web-2', {'role': 'web'}),
+                           ('db-1', {'role': 'db'}),
+                           ('web_3', {'role': 'db'})]:
+            db.instance_create(self.context, {'display_name': name,
+                                              'project_id': self.project_id,
+                                              'metadata': meta})
+
+        def _names(filters):
+            result = db.instance_get_all_by_filters(self.context, filters)
+            return sorted(instance['display_name'] for instance in result)
+
+        self.assertEqual(['web-1', 'web_3'], _names({'display_name': 'web'}))
+        self.assertEqual(['web-1'], _names({'display_name': '^web-'}))
+        self.assertEqual(['web-1', 'web_3'],
+                         _names({'display_name': 'web.?[-_]'}))
+        self.assertEqual(['Web-2', 'web-1', 'web_3'],
+                         _names({'display_name': '[wW]eb'}))
+        self.assertEqual(['db-1', 'web-1'],
+                         _names({'display_name': 'web-1|db'}))
+        self.assertEqual(['Web-2', 'web-1'],
+                         _names({'metadata': {'role': 'web'}}))
+        self.assertEqual(['web_3'],
+                         _names({'metadata': [{'role': 'db'}],
+                                 'display_name': 'web'}))
+
+    def test_instance_get_all_by_filters_paginate(self):
+        created_at = datetime.datetime(2011, 1, 1)
+        uuids = []
+        for i in xrange(6):
+            # Two instances per timestamp, to page through ties
+            instance = db.instance_create(self.context,
+                    {'display_name': 'server%d' % (i % 3),
+                     'project_id': self.project_id,
+                     'created_at': created_at +
+                                   datetime.timedelta(seconds=i / 2)})
+            uuids.append(instance['uuid'])
+        uuids.reverse()
+
+        def _uuids(filters, **kwargs):
+            result = db.instance_get_all_by_filters(self.context, filters,
+                                                    **kwargs)
+            return [instance['uuid'] for instance in result]
+
+        self.assertEqual(uuids, _uuids({}))
+        self.assertEqual(uuids[:2], _uuids({}, limit=2))
+        self.assertEqual(uuids[2:4], _uuids({}, marker=uuids[1], limit=2))
+        self.assertEqual(uuids[5:], _uuids({}, marker=uuids[4], limit=2))
+
+        # Pages are filled up even when python discards some instances.
+        matching = [uuid for i, uuid in enumerate(uuids)
+                    if (5 - i) % 3 != 1]
+        filters = {'display_name': 'server[02]'}
+        self.assertEqual(matching[:3], _uuids(filters, limit=3))
+        self.assertEqual(matching[3:], _uuids(filters, marker=matching[2],
+                                              limit=3))
+
+        self.assertRaises(exception.MarkerNotFound,
+                          db.instance_get_all_by_filters, self.context, {},
+                          marker='ffffffff-ffff-ffff-ffff-ffffffffffff')
+
+    def test_instance_get_all_by_filters_columns_to_join(self):
+        instance = db.instance_create(self.context,
+                                      {'project_id': self.project_id,
+                                       'metadata': {'a': 'b'}})
+        _setup_networking(instance['id'])
+        result = db.instance_get_all_by_filters(self.context, {},
+                columns_to_join=['metadata'])
+        self.assertEqual(1, len(result))
+        self.assertTrue('metadata' in result[0].__dict__)
+        self.assertFalse('fixed_ips' in result[0].__dict__)
+
+    def test_compute_node_get_all_with_usage(self):
+        ctxt = context.get_admin_context()
+        for host, memory_mb, local_gb, vcpus in [('host1', 4096, 100, 8),
+                                                 ('host2', 2048, 50, 4)]:
+            service = db.service_create(ctxt, {'host': host,
+                                               'binary': 'nova-compute',
+                                               'topic': 'compute'})
+            db.compute_node_create(ctxt, {'service_id': service['id'],
+                                          'memory_mb': memory_mb,
+                                          'local_gb': local_gb,
+                                          'vcpus': vcpus,
+                                          'memory_mb_used': 0,
+                                          'local_gb_used': 0,
+                                          'vcpus_used': 0,
+                                          'hypervisor_type': 'qemu',
+                                          'hypervisor_version': 12003,
+                                          'cpu_info': ''})
+        for memory_mb, local_gb, host in [(512, 10, 'host1'),
+                                          (1024, 20, 'host1'),
+                                          (256, 5, 'host2')]:
+            db.instance_create(ctxt, {'host': host, 'vcpus': 1,
+                                      'memory_mb': memory_mb,
+                                      'local_gb': local_gb})
+        deleted = db.instance_create(ctxt, {'host': 'host2', 'vcpus': 1,
+                                            'memory_mb': 256, 'local_gb': 5})
+        db.instance_destroy(ctxt, deleted['id'])
+
+        result = db.compute_node_get_all_with_usage(ctxt)
+        usage = dict((item['host'], item) for item in result)
+        self.assertEqual(2, len(usage))
+        self.assertEqual(2560, usage['host1']['free_ram_mb'])
+        self.assertEqual(70, usage['host1']['free_disk_gb'])
+        self.assertEqual(6, usage['host1']['free_vcpus'])
+        self.assertEqual(1792, usage['host2']['free_ram_mb'])
+
+        result = db.compute_node_get_all_with_usage(ctxt, host='host2')
+        self.assertEqual(1, len(result))
+        self.assertEqual(45, result[0]['free_disk_gb'])
+        self.assertEqual(3, result[0]['free_vcpus'])
+
+    def test_security_group_get_fixed_addresses(self):
+        ctxt = context.get_admin_context()
+        group = db.security_group_create(ctxt, {'name': 'group',
+                                                'project_id': 'fake'})
+        members = [db.instance_create(ctxt, {}) for i in xrange(3)]
+        outsider = db.instance_create(ctxt, {})
+        for i, instance in enumerate(members + [outsider]):
+            db.fixed_ip_create(ctxt, {'address': '10.0.0.%d' % i,
+                                      'instance_id': instance['id']})
+        for instance in members:
+            db.instance_add_security_group(ctxt, instance['id'],
+                                           group['id'])
+        db.instance_destroy(ctxt, members[2]['id'])
+
+        self.assertEqual(['10.0.0.0', '10.0.0.1'],
+                         db.security_group_get_fixed_addresses(ctxt,
+                                                               group['id']))
+
     def test_migration_get_all_unconfirmed(self):
         ctxt = context.get_admin_context()
 
@@ -148,6 +283,180 @@ class DbApiTestCase(test.TestCase):
         self.assertEqual(0, len(results))
         db.instance_update(ctxt, instance.id, {"task_state": None})
 
+    def _create_fixed_ips(self, count, reserved=()):
+        ctxt = context.get_admin_context()
+        network = db.network_create_safe(ctxt, {'host': 'localhost'})
+        db.fixed_ip_bulk_create(ctxt, [
+                {'address': '10.9.0.%d' % i, 'network_id': network['id'],
+                 'reserved': i in reserved}
+                for i in xrange(count)])
+        return network
+
+    def test_fixed_ip_bulk_create(self):
+        self.flags(fixed_ip_bulk_create_batch=2)
+        ctxt = context.get_admin_context()
+        network = db.network_create_safe(ctxt, {'host': 'localhost'})
+        ips = [{'address': '10.9.0.%d' % i, 'network_id': network['id']}
+               for i in xrange(5)]
+        ips[0]['reserved'] = True
+        ips[1]['address_int'] = int(netaddr.IPAddress('10.9.0.1'))
+        db.fixed_ip_bulk_create(ctxt, ips)
+
+        fixed_ips = sorted([fixed_ip for fixed_ip in db.fixed_ip_get_all(ctxt)
+                            if fixed_ip['network_id'] == network['id']],
+                           key=lambda fixed_ip: fixed_ip['address'])
+        self.assertEqual([(fixed_ip['address'],
+                           fixed_ip['address_int'],
+                           fixed_ip['reserved'],
+                           fixed_ip['deleted'])
+                          for fixed_ip in fixed_ips],
+                         [('10.9.0.%d' % i,
+                           int(netaddr.IPAddress('10.9.0.%d' % i)),
+                           i == 0, False)
+                          for i in xrange(5)])
+        self.assertTrue(all(fixed_ip['created_at'] for fixed_ip in fixed_ips))
+
+    def test_fixed_ip_associate_pool_optimistically(self):
+        self.flags(fixed_ip_allocate_optimistically=True)
+        ctxt = context.get_admin_context()
+        network = self._create_fixed_ips(4, reserved=(0, 1, 2))
+        instance = db.instance_create(ctxt, {})
+
+        address = db.fixed_ip_associate_pool(ctxt, network['id'],
+                                             instance['id'], 'host1')
+
+        self.assertEqual(address, '10.9.0.3')
+        fixed_ip = db.fixed_ip_get_by_address(ctxt, address)
+        self.assertEqual(fixed_ip['instance_id'], instance['id'])
+        self.assertEqual(fixed_ip['host'], 'host1')
+        self.assertRaises(exception.NoMoreFixedIps,
+                          db.fixed_ip_associate_pool,
+                          ctxt, network['id'], instance['id'])
+
+    def test_network_get_fixed_ips_updated_since(self):
+        ctxt = context.get_admin_context()
+        network = self._create_fixed_ips(3)
+        instance = db.instance_create(ctxt, {})
+        db.fixed_ip_associate(ctxt, '10.9.0.2', instance['id'],
+                              network['id'])
+        since = datetime.datetime.utcnow()
+        db.fixed_ip_associate(ctxt, '10.9.0.1', instance['id'],
+                              network['id'])
+        db.fixed_ip_disassociate(ctxt, '10.9.0.2')
+
+        fixed_ips = db.network_get_fixed_ips_updated_since(ctxt,
+                                                           network['id'],
+                                                           since)
+
+        self.assertEqual(sorted([(fixed_ip['address'],
+                                  fixed_ip['instance_id'])
+                                 for fixed_ip in fixed_ips]),
+                         [('10.9.0.1', instance['id']), ('10.9.0.2', None)])
+
+    def test_instance_info_cache(self):
+        ctxt = context.get_admin_context()
+        instance = db.instance_create(ctxt, {})
+        self.assertEqual(db.instance_info_cache_get(ctxt, instance['id']),
+                         None)
+
+        db.instance_info_cache_update(ctxt, instance['id'],
+                                      {'network_info': 'old'})
+        db.instance_info_cache_update(ctxt, instance['id'],
+                                      {'network_info': 'new'})
+        info_cache = db.instance_info_cache_get(ctxt, instance['id'])
+        self.assertEqual(info_cache['network_info'], 'new')
+
+        db.instance_info_cache_invalidate(ctxt, instance['id'])
+        info_cache = db.instance_info_cache_get(ctxt, instance['id'])
+        self.assertEqual(info_cache['network_info'], None)
+
+        db.instance_info_cache_delete(ctxt, instance['id'])
+        self.assertEqual(db.instance_info_cache_get(ctxt, instance['id']),
+                         None)
+
+    def test_instance_info_cache_update_generation(self):
+        ctxt = context.get_admin_context()
+        instance = db.instance_create(ctxt, {})
+        info_cache = db.instance_info_cache_update(ctxt, instance['id'],
+                {'network_info': 'first'}, 0)
+        generation = info_cache['id']
+
+        # NOTE: invalidated while 'stale' was being built
+        db.instance_info_cache_invalidate(ctxt, instance['id'])
+        self.assertEqual(db.instance_info_cache_update(ctxt, instance['id'],
+                {'network_info': 'stale'}, generation), None)
+        info_cache = db.instance_info_cache_get(ctxt, instance['id'])
+        self.assertEqual(info_cache['network_info'], None)
+
+        db.instance_info_cache_update(ctxt, instance['id'],
+                {'network_info': 'fresh'}, info_cache['id'])
+        info_cache = db.instance_info_cache_get(ctxt, instance['id'])
+        self.assertEqual(info_cache['network_info'], 'fresh')
+
+    def test_network_update_invalidates_info_caches(self):
+        ctxt = context.get_admin_context()
+        instance = db.instance_create(ctxt, {})
+        other = db.instance_create(ctxt, {})
+        _setup_networking(instance['id'])
+        for instance_id in (instance['id'], other['id']):
+            db.instance_info_cache_update(ctxt, instance_id,
+                                          {'network_info': 'cached'})
+
+        network = db.project_get_networks(ctxt, 'fake')[0]
+        db.network_update(ctxt, network['id'], {'gateway': '10.0.0.254'})
+
+        info_cache = db.instance_info_cache_get(ctxt, instance['id'])
+        self.assertEqual(info_cache['network_info'], None)
+        info_cache = db.instance_info_cache_get(ctxt, other['id'])
+        self.assertEqual(info_cache['network_info'], 'cached')
+
+    def test_ip_get_by_address_ranges(self):
+        ctxt = context.get_admin_context()
+        instance = db.instance_create(ctxt, {})
+        _setup_networking(instance['id'], ip='10.1.2.3', flo_addr='10.1.3.3')
+        fixed_range = (int(netaddr.IPAddress('10.1.2.0')),
+                       int(netaddr.IPAddress('10.1.2.255')))
+        floating_range = (int(netaddr.IPAddress('10.1.3.0')),
+                          int(netaddr.IPAddress('10.1.3.255')))
+
+        fixed_ips = db.fixed_ip_get_by_address_ranges(ctxt, [fixed_range])
+        self.assertEqual([(fixed_ip['address'], fixed_ip['instance_id'])
+                          for fixed_ip in fixed_ips],
+                         [('10.1.2.3', instance['id'])])
+        self.assertFalse(db.fixed_ip_get_by_address_ranges(ctxt,
+                                                           [floating_range]))
+
+        floating_ips = db.floating_ip_get_by_address_ranges(ctxt,
+                [fixed_range, floating_range])
+        self.assertEqual([(floating_ip['address'],
+                           floating_ip['fixed_ip']['address'])
+                          for floating_ip in floating_ips],
+                         [('10.1.3.3', '10.1.2.3')])
+
+        self.assertEqual(list(db.fixed_ip_get_all_addresses(ctxt)),
+                         [(instance['id'], '10.1.2.3', '10.1.3.3')])
+
+    def test_virtual_interface_get_ipv6_addresses(self):
+        ctxt = context.get_admin_context()
+        instance = db.instance_create(ctxt, {'project_id': 'project1'})
+        network_v4 = db.network_create_safe(ctxt, {})
+        network_v6 = db.network_create_safe(ctxt, {'cidr_v6': 'fd00::/64'})
+        for i, network in enumerate((network_v4, network_v6)):
+            db.virtual_interface_create(ctxt, {
+                    'address': '02:16:3e:00:00:0%d' % i,
+                    'network_id': network['id'],
+                    'instance_id': instance['id']})
+
+        expected = [(instance['id'],
+                     ipv6.to_global('fd00::/64', '02:16:3e:00:00:01',
+                                    'project1'))]
+        self.assertEqual(list(db.virtual_interface_get_ipv6_addresses(ctxt)),
+                         expected)
+        self.assertEqual(list(db.virtual_interface_get_ipv6_addresses(
+                ctxt, '02:16:3e:00:00:01')), expected)
+        self.assertFalse(list(db.virtual_interface_get_ipv6_addresses(
+                ctxt, '02:16:3e:00:00:00')))
+
     def test_network_create_safe(self):
         ctxt = context.get_admin_context()
         values = {'host': 'localhost', 'project_id': 'project1'}
@@ -19,6 +19,8 @@
 
 import os
 
+import eventlet
+
 from nova import test
 from nova.network import linux_net
 
@@ -162,3 +164,54 @@ class IptablesManagerTestCase(test.TestCase):
             self.assertTrue('-A %s -j run_tests.py-%s' \
                             % (chain, chain) in new_lines,
                             "Built-in chain %s not wrapped" % (chain,))
+
+    def _fake_execute(self, *cmd, **kwargs):
+        self.executed.append(cmd)
+        if cmd[0].endswith('-save'):
+            return '\n'.join(self.sample_filter), ''
+        return '', ''
+
+    def test_apply_restores_dirty_tables_only(self):
+        self.flags(iptables_apply_delay=0)
+        self.executed = []
+        self.manager.execute = self._fake_execute
+        self.manager.apply()
+        self.assertEqual(len(self.executed), 6)
+
+        self.executed = []
+        self.manager.apply()
+        self.assertEqual(self.executed, [])
+
+        self.manager.ipv4['filter'].add_rule('FORWARD', '-s 1.2.3.4 -j DROP')
+        self.manager.apply()
+        self.assertEqual(self.executed, [('iptables-save', '-t', 'filter'),
+                                         ('iptables-restore',)])
+
+    def test_concurrent_applies_share_a_restore(self):
+        self.flags(iptables_apply_delay=0.01)
+        self.executed = []
+        self.manager.execute = self._fake_execute
+        self.manager.apply()
+        self.executed = []
+
+        def add_and_apply(i):
+            self.manager.ipv4['filter'].add_rule('FORWARD',
+                                                 '-s 10.0.0.%d -j DROP' % i)
+            self.manager.apply()
+
+        threads = [eventlet.spawn(add_and_apply, i) for i in xrange(50)]
+        for thread in threads:
+            thread.wait()
+        self.assertEqual(self.executed, [('iptables-save', '-t', 'filter'),
+                                         ('iptables-restore',)])
+
+    def test_remove_chain_removes_jumps(self):
+        table = self.manager.ipv4['filter']
+        table.add_chain('inst-1')
+        table.add_rule('inst-1', '-j DROP')
+        table.add_rule('local', '-d 10.0.0.1 -j $inst-1')
+        table.dirty = False
+        table.remove_chain('inst-1')
+        self.assertTrue(table.dirty)
+        self.assertFalse([rule for rule in table.rules
+                          if 'inst-1' in str(rule)])
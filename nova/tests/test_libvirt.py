@@ -16,6 +16,7 @@
 
 import copy
 import eventlet
+import hashlib
 import mox
 import os
 import re
@@ -30,6 +31,7 @@ from nova import context
 from nova import db
 from nova import exception
 from nova import flags
+import nova.image
 from nova import log as logging
 from nova import test
 from nova import utils
@@ -38,7 +40,9 @@ from nova.compute import power_state
 from nova.compute import vm_states
 from nova.virt import driver
 from nova.virt.libvirt import connection
+from nova.virt import images
 from nova.virt.libvirt import firewall
+from nova.virt.libvirt import imagecache
 from nova.virt.libvirt import volume
 from nova.volume import driver as volume_driver
 from nova.tests import fake_network
@@ -185,6 +189,7 @@ class CacheConcurrencyTestCase(test.TestCase):
             pass
 
         self.stubs.Set(os.path, 'exists', fake_exists)
+        self.stubs.Set(os, 'utime', lambda path, times: None)
         self.stubs.Set(utils, 'execute', fake_execute)
 
     def test_same_fname_concurrency(self):
@@ -228,6 +233,123 @@ class CacheConcurrencyTestCase(test.TestCase):
             eventlet.sleep(0)
 
 
+class ImageCacheTestCase(test.TestCase):
+    def setUp(self):
+        super(ImageCacheTestCase, self).setUp()
+        self.instances_path = tempfile.mkdtemp()
+        self.flags(instances_path=self.instances_path)
+        self.base_dir = os.path.join(self.instances_path, '_base')
+        os.mkdir(self.base_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.instances_path)
+        super(ImageCacheTestCase, self).tearDown()
+
+    def _make_base(self, fname, last_used):
+        path = os.path.join(self.base_dir, fname)
+        with open(path, 'w') as f:
+            f.write('x' * 8192)
+        os.utime(path, (last_used, last_used))
+        return os.stat(path).st_blocks * 512
+
+    def test_evict_least_recently_used(self):
+        sizes = {}
+        for last_used, fname in enumerate(['in_use', 'old', 'new', 'newer']):
+            sizes[fname] = self._make_base(fname, 1000 + last_used)
+        self._make_base('downloading.part', 0)
+
+        max_bytes = sum(sizes.values()) - sizes['old']
+        removed = imagecache.evict(set(['in_use']), max_bytes)
+
+        self.assertEqual(removed, ['old'])
+        self.assertEqual(sorted(os.listdir(self.base_dir)),
+                         ['downloading.part', 'in_use', 'new', 'newer'])
+
+    def test_evict_skips_images_used_since_listing(self):
+        self._make_base('fname', 1000)
+        self.assertFalse(imagecache._remove_if_unused_since('fname', 999))
+        self.assertTrue(imagecache._remove_if_unused_since('fname', 1000))
+        self.assertFalse(os.path.exists(os.path.join(self.base_dir,
+                                                     'fname')))
+
+    def test_fetch_marks_cached_image_used(self):
+        self._make_base('fname', 1000)
+        base = imagecache.get_base_path('fname')
+
+        def fail(target):
+            self.fail('cached image fetched again')
+
+        imagecache.fetch(base, fail)
+        self.assertTrue(os.stat(base).st_mtime > 1000)
+
+    def test_manage_image_cache(self):
+        self.flags(base_image_cache_max_gb=1)
+        conn = connection.LibvirtConnection(True)
+        fetched = []
+
+        def fake_fetch_image(context, target, image_id, user_id, project_id,
+                             size=None):
+            fetched.append((image_id, size))
+            open(target, 'w').close()
+
+        evicted = []
+        self.stubs.Set(conn, '_fetch_image', fake_fetch_image)
+        self.stubs.Set(conn, '_get_base_images_in_use',
+                       lambda: set(['backing']))
+        self.stubs.Set(imagecache, 'evict',
+                       lambda in_use, max_bytes: evicted.append(in_use))
+
+        conn.manage_image_cache(context.get_admin_context(),
+                                [{'image_ref': 'ami', 'kernel_id': 'aki',
+                                  'ramdisk_id': None}])
+
+        self.assertEqual(fetched, [('aki', None),
+                                   ('ami', FLAGS.minimum_root_size)])
+        root_fname = hashlib.sha1('ami').hexdigest()
+        self.assertEqual(evicted, [set(['backing', 'aki', root_fname])])
+
+    def test_get_base_images_in_use(self):
+        conn = connection.LibvirtConnection(True)
+        instance_dir = os.path.join(self.instances_path, 'instance-00000001')
+        os.mkdir(instance_dir)
+        for disk_name in ('disk', 'disk.local', 'libvirt.xml'):
+            open(os.path.join(instance_dir, disk_name), 'w').close()
+        backing_files = {
+            'disk': '%s/root (actual path: %s/root)' % (self.base_dir,
+                                                        self.base_dir),
+            'disk.local': '%s/ephemeral_0_20_None' % self.base_dir}
+
+        def fake_qemu_img_info(path):
+            disk_name = os.path.basename(path)
+            self.assertNotEqual(disk_name, 'libvirt.xml')
+            return {'file format': 'qcow2',
+                    'backing file': backing_files[disk_name]}
+
+        self.stubs.Set(images, 'qemu_img_info', fake_qemu_img_info)
+
+        self.assertEqual(conn._get_base_images_in_use(),
+                         set(['root', 'ephemeral_0_20_None']))
+
+    def test_fetch_verifies_checksum(self):
+        class FakeImageService(object):
+            def get(self, context, image_id, data):
+                data.write('image data')
+                return {'checksum': checksum}
+
+        self.stubs.Set(nova.image, 'get_image_service',
+                       lambda context, href: (FakeImageService(), href))
+        path = os.path.join(self.base_dir, 'fname.part')
+
+        checksum = hashlib.md5('image data').hexdigest()
+        images.fetch(None, 'ami', path, None, None)
+        self.assertTrue(os.path.exists(path))
+
+        checksum = hashlib.md5('other data').hexdigest()
+        self.assertRaises(exception.ImageUnacceptable,
+                          images.fetch, None, 'ami', path, None, None)
+        self.assertFalse(os.path.exists(path))
+
+
 class FakeVolumeDriver(object):
     def __init__(self, *args, **kwargs):
         pass
@@ -1313,7 +1435,8 @@ class IptablesFirewallTestCase(test.TestCase):
         linux_net.iptables_manager.execute = fake_iptables_execute
 
         network_info = _fake_network_info(self.stubs, 1)
-        self.stubs.Set(db, 'instance_get_fixed_addresses', get_fixed_ips)
+        self.stubs.Set(db, 'security_group_get_fixed_addresses',
+                       get_fixed_ips)
         self.fw.prepare_instance_filter(instance_ref, network_info)
         self.fw.apply_instance_filter(instance_ref, network_info)
         in_rules = filter(lambda l: not l.startswith('#'),
@@ -1409,6 +1532,171 @@ class IptablesFirewallTestCase(test.TestCase):
         self.mox.ReplayAll()
         self.fw.do_refresh_security_group_rules("fake")
 
+    def test_security_group_rules_cache(self):
+        admin_ctxt = context.get_admin_context()
+        instance_ref = self._create_instance_ref()
+        secgroup = db.security_group_create(admin_ctxt,
+                                            {'user_id': 'fake',
+                                             'project_id': 'fake',
+                                             'name': 'testgroup',
+                                             'description': 'test group'})
+        src_secgroup = db.security_group_create(admin_ctxt,
+                                                {'user_id': 'fake',
+                                                 'project_id': 'fake',
+                                                 'name': 'testsourcegroup',
+                                                 'description': 'src group'})
+        db.security_group_rule_create(admin_ctxt,
+                                      {'parent_group_id': secgroup['id'],
+                                       'protocol': 'tcp',
+                                       'from_port': 22,
+                                       'to_port': 22,
+                                       'group_id': src_secgroup['id']})
+        db.instance_add_security_group(admin_ctxt, instance_ref['id'],
+                                       secgroup['id'])
+
+        lookups = []
+        member_ips = ['10.0.0.1', '10.0.0.2']
+
+        def fake_get_fixed_addresses(context, security_group_id):
+            lookups.append(security_group_id)
+            return member_ips
+
+        self.stubs.Set(db, 'security_group_get_fixed_addresses',
+                       fake_get_fixed_addresses)
+
+        def member_rules():
+            ipv4_rules, _ipv6 = self.fw.instance_rules(instance_ref, [])
+            return [rule for rule in ipv4_rules if '--dport 22' in rule]
+
+        self.assertEqual(member_rules(),
+                         ['-j ACCEPT -p tcp --dport 22 -s 10.0.0.1',
+                          '-j ACCEPT -p tcp --dport 22 -s 10.0.0.2'])
+        member_rules()
+        self.assertEqual(lookups, [src_secgroup['id']])
+
+        executed = []
+
+        def fake_execute(*cmd, **kwargs):
+            executed.append((cmd, kwargs.get('process_input')))
+            return '', ''
+
+        self.stubs.Set(self.fw.iptables, 'execute', fake_execute)
+        self.flags(firewall_ipset_threshold=1)
+        member_ips.append('10.0.0.3')
+        self.fw.refresh_security_group_members(src_secgroup['id'])
+
+        set_name = 'nova-sg-%s' % src_secgroup['id']
+        self.assertEqual(member_rules(),
+                         ['-j ACCEPT -p tcp --dport 22 '
+                          '-m set --match-set %s src' % set_name])
+        self.assertEqual(lookups, [src_secgroup['id']] * 2)
+        ipset_input = [process_input for cmd, process_input in executed
+                       if cmd == ('ipset', 'restore')]
+        self.assertEqual(len(ipset_input), 1)
+        for ip in member_ips:
+            self.assertTrue('add %s-new %s' % (set_name, ip)
+                            in ipset_input[0])
+        db.instance_destroy(admin_ctxt, instance_ref['id'])
+
+    def test_unused_ipsets_destroyed(self):
+        admin_ctxt = context.get_admin_context()
+        instance_ref = self._create_instance_ref()
+        secgroup = db.security_group_create(admin_ctxt,
+                                            {'user_id': 'fake',
+                                             'project_id': 'fake',
+                                             'name': 'testgroup',
+                                             'description': 'test group'})
+        src_secgroup = db.security_group_create(admin_ctxt,
+                                                {'user_id': 'fake',
+                                                 'project_id': 'fake',
+                                                 'name': 'testsourcegroup',
+                                                 'description': 'src group'})
+        db.security_group_rule_create(admin_ctxt,
+                                      {'parent_group_id': secgroup['id'],
+                                       'protocol': 'tcp',
+                                       'from_port': 22,
+                                       'to_port': 22,
+                                       'group_id': src_secgroup['id']})
+        db.instance_add_security_group(admin_ctxt, instance_ref['id'],
+                                       secgroup['id'])
+
+        member_ips = ['10.0.0.1', '10.0.0.2']
+        self.stubs.Set(db, 'security_group_get_fixed_addresses',
+                       lambda context, security_group_id: member_ips)
+        executed = []
+
+        def fake_execute(*cmd, **kwargs):
+            executed.append(cmd)
+            return '', ''
+
+        self.stubs.Set(self.fw.iptables, 'execute', fake_execute)
+        self.flags(firewall_ipset_threshold=1)
+        self.fw.instances[instance_ref['id']] = instance_ref
+        self.fw.network_infos[instance_ref['id']] = []
+
+        set_name = 'nova-sg-%s' % src_secgroup['id']
+        destroy = ('ipset', 'destroy', set_name)
+        self.fw.refresh_security_group_members(src_secgroup['id'])
+        self.assertTrue(('ipset', 'restore') in executed)
+        self.assertFalse(destroy in executed)
+
+        # Down to one member, so the set is no longer matched against
+        member_ips.pop()
+        self.fw.refresh_security_group_members(src_secgroup['id'])
+        self.assertTrue(destroy in executed)
+        self.assertEqual(self.fw.ipsets, {})
+        db.instance_destroy(admin_ctxt, instance_ref['id'])
+
+    def test_destroyed_ipset_recreated_for_cached_rules(self):
+        admin_ctxt = context.get_admin_context()
+        instance_ref = self._create_instance_ref()
+        other_ref = self._create_instance_ref()
+        secgroup = db.security_group_create(admin_ctxt,
+                                            {'user_id': 'fake',
+                                             'project_id': 'fake',
+                                             'name': 'testgroup',
+                                             'description': 'test group'})
+        src_secgroup = db.security_group_create(admin_ctxt,
+                                                {'user_id': 'fake',
+                                                 'project_id': 'fake',
+                                                 'name': 'testsourcegroup',
+                                                 'description': 'src group'})
+        db.security_group_rule_create(admin_ctxt,
+                                      {'parent_group_id': secgroup['id'],
+                                       'protocol': 'tcp',
+                                       'from_port': 22,
+                                       'to_port': 22,
+                                       'group_id': src_secgroup['id']})
+        for ref in (instance_ref, other_ref):
+            db.instance_add_security_group(admin_ctxt, ref['id'],
+                                           secgroup['id'])
+
+        self.stubs.Set(db, 'security_group_get_fixed_addresses',
+                       lambda context, security_group_id: ['10.0.0.1',
+                                                           '10.0.0.2'])
+        executed = []
+
+        def fake_execute(*cmd, **kwargs):
+            executed.append(cmd)
+            return '', ''
+
+        self.stubs.Set(self.fw.iptables, 'execute', fake_execute)
+        self.stubs.Set(self.fw.nwfilter, 'unfilter_instance',
+                       lambda instance, network_info: None)
+        self.flags(firewall_ipset_threshold=1)
+
+        set_name = 'nova-sg-%s' % src_secgroup['id']
+        self.fw.prepare_instance_filter(instance_ref, [])
+        self.fw.unfilter_instance(instance_ref, [])
+        self.assertTrue(('ipset', 'destroy', set_name) in executed)
+
+        del executed[:]
+        self.fw.prepare_instance_filter(other_ref, [])
+        self.assertTrue(('ipset', 'restore') in executed)
+        self.assertEqual(self.fw.ipsets, {set_name: src_secgroup['id']})
+        for ref in (instance_ref, other_ref):
+            db.instance_destroy(admin_ctxt, ref['id'])
+
     @test.skip_if(missing_libvirt(), "Test requires libvirt")
     def test_unfilter_instance_undefines_nwfilter(self):
         admin_ctxt = context.get_admin_context()
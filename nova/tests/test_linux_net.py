@@ -15,6 +15,8 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from eventlet import greenthread
+
 from nova import context
 from nova import db
 from nova import exception
@@ -197,27 +199,20 @@ class LinuxNetworkTestCase(test.TestCase):
         network_driver = FLAGS.network_driver
         self.driver = utils.import_object(network_driver)
         self.driver.db = db
+        self.stubs.Set(linux_net, '_dhcp_hosts', {})
 
     def test_update_dhcp_for_nw00(self):
         self.flags(use_single_default_gateway=True)
         self.mox.StubOutWithMock(db, 'network_get_associated_fixed_ips')
-        self.mox.StubOutWithMock(db, 'virtual_interface_get_by_instance')
+        self.mox.StubOutWithMock(db, 'virtual_interface_get_by_instances')
 
         db.network_get_associated_fixed_ips(mox.IgnoreArg(),
                                             mox.IgnoreArg())\
                                             .AndReturn([fixed_ips[0],
                                                         fixed_ips[3]])
-
-        db.network_get_associated_fixed_ips(mox.IgnoreArg(),
-                                            mox.IgnoreArg())\
-                                            .AndReturn([fixed_ips[0],
-                                                        fixed_ips[3]])
-        db.virtual_interface_get_by_instance(mox.IgnoreArg(),
-                                             mox.IgnoreArg())\
-                                             .AndReturn([vifs[0], vifs[1]])
-        db.virtual_interface_get_by_instance(mox.IgnoreArg(),
-                                             mox.IgnoreArg())\
-                                             .AndReturn([vifs[2], vifs[3]])
+        db.virtual_interface_get_by_instances(mox.IgnoreArg(),
+                                              mox.IgnoreArg())\
+                                              .AndReturn(vifs)
         self.mox.ReplayAll()
 
         self.driver.update_dhcp(None, "eth0", networks[0])
@@ -225,23 +220,15 @@ class LinuxNetworkTestCase(test.TestCase):
     def test_update_dhcp_for_nw01(self):
         self.flags(use_single_default_gateway=True)
         self.mox.StubOutWithMock(db, 'network_get_associated_fixed_ips')
-        self.mox.StubOutWithMock(db, 'virtual_interface_get_by_instance')
-
-        db.network_get_associated_fixed_ips(mox.IgnoreArg(),
-                                            mox.IgnoreArg())\
-                                            .AndReturn([fixed_ips[1],
-                                                        fixed_ips[2]])
+        self.mox.StubOutWithMock(db, 'virtual_interface_get_by_instances')
 
         db.network_get_associated_fixed_ips(mox.IgnoreArg(),
                                             mox.IgnoreArg())\
                                             .AndReturn([fixed_ips[1],
                                                         fixed_ips[2]])
-        db.virtual_interface_get_by_instance(mox.IgnoreArg(),
-                                             mox.IgnoreArg())\
-                                             .AndReturn([vifs[0], vifs[1]])
-        db.virtual_interface_get_by_instance(mox.IgnoreArg(),
-                                             mox.IgnoreArg())\
-                                             .AndReturn([vifs[2], vifs[3]])
+        db.virtual_interface_get_by_instances(mox.IgnoreArg(),
+                                              mox.IgnoreArg())\
+                                              .AndReturn(vifs)
         self.mox.ReplayAll()
 
         self.driver.update_dhcp(None, "eth0", networks[0])
@@ -286,23 +273,16 @@ class LinuxNetworkTestCase(test.TestCase):
 
     def test_get_dhcp_opts_for_nw00(self):
         self.mox.StubOutWithMock(db, 'network_get_associated_fixed_ips')
-        self.mox.StubOutWithMock(db, 'virtual_interface_get_by_instance')
+        self.mox.StubOutWithMock(db, 'virtual_interface_get_by_instances')
 
         db.network_get_associated_fixed_ips(mox.IgnoreArg(),
                                             mox.IgnoreArg())\
                                             .AndReturn([fixed_ips[0],
                                                         fixed_ips[3],
                                                         fixed_ips[4]])
-        db.virtual_interface_get_by_instance(mox.IgnoreArg(),
-                                             mox.IgnoreArg())\
-                                             .AndReturn([vifs[0],
-                                                         vifs[1],
-                                                         vifs[4]])
-        db.virtual_interface_get_by_instance(mox.IgnoreArg(),
-                                             mox.IgnoreArg())\
-                                             .AndReturn([vifs[2],
-                                                         vifs[3],
-                                                         vifs[5]])
+        db.virtual_interface_get_by_instances(mox.IgnoreArg(),
+                                              mox.IgnoreArg())\
+                                              .AndReturn(vifs)
         self.mox.ReplayAll()
 
         expected_opts = 'NW-i00000001-0,3'
@@ -312,23 +292,16 @@ class LinuxNetworkTestCase(test.TestCase):
 
     def test_get_dhcp_opts_for_nw01(self):
         self.mox.StubOutWithMock(db, 'network_get_associated_fixed_ips')
-        self.mox.StubOutWithMock(db, 'virtual_interface_get_by_instance')
+        self.mox.StubOutWithMock(db, 'virtual_interface_get_by_instances')
 
         db.network_get_associated_fixed_ips(mox.IgnoreArg(),
                                             mox.IgnoreArg())\
                                             .AndReturn([fixed_ips[1],
                                                         fixed_ips[2],
                                                         fixed_ips[5]])
-        db.virtual_interface_get_by_instance(mox.IgnoreArg(),
-                                             mox.IgnoreArg())\
-                                             .AndReturn([vifs[0],
-                                                         vifs[1],
-                                                         vifs[4]])
-        db.virtual_interface_get_by_instance(mox.IgnoreArg(),
-                                             mox.IgnoreArg())\
-                                             .AndReturn([vifs[2],
-                                                         vifs[3],
-                                                         vifs[5]])
+        db.virtual_interface_get_by_instances(mox.IgnoreArg(),
+                                              mox.IgnoreArg())\
+                                              .AndReturn(vifs)
         self.mox.ReplayAll()
 
         expected_opts = "NW-i00000000-1,3"
@@ -336,6 +309,70 @@ class LinuxNetworkTestCase(test.TestCase):
 
         self.assertEquals(actual_opts, expected_opts)
 
+    def _fake_restart_dhcp(self):
+        restarts = []
+
+        def fake_restart_dhcp(dev, network_ref):
+            restarts.append(dev)
+        self.stubs.Set(linux_net, '_restart_dhcp', fake_restart_dhcp)
+        return restarts
+
+    def _read_dhcp_file(self, dev, kind):
+        with open(self.driver._dhcp_file(dev, kind)) as f:
+            return f.read()
+
+    def test_update_dhcp_applies_updated_fixed_ips(self):
+        self.flags(use_single_default_gateway=False, dhcp_hup_delay=0)
+        restarts = self._fake_restart_dhcp()
+        self.mox.StubOutWithMock(db, 'network_get_associated_fixed_ips')
+        self.mox.StubOutWithMock(db, 'network_get_fixed_ips_updated_since')
+        released = dict(fixed_ips[0], virtual_interface_id=None,
+                        deleted=False)
+        allocated = dict(fixed_ips[4], deleted=False)
+
+        db.network_get_associated_fixed_ips(mox.IgnoreArg(), 0)\
+                .AndReturn([fixed_ips[0], fixed_ips[3]])
+        db.network_get_fixed_ips_updated_since(mox.IgnoreArg(), 0,
+                                               mox.IgnoreArg())\
+                .AndReturn([released, allocated])
+        db.network_get_fixed_ips_updated_since(mox.IgnoreArg(), 0,
+                                               mox.IgnoreArg())\
+                .AndReturn([allocated])
+        self.mox.ReplayAll()
+
+        self.driver.update_dhcp(None, 'eth0', networks[0])
+        self.assertEqual(self._read_dhcp_file('eth0', 'conf'),
+                         "10.0.0.1,fake_instance00.novalocal,192.168.0.100\n"
+                         "10.0.0.4,fake_instance01.novalocal,192.168.1.101")
+        self.driver.update_dhcp(None, 'eth0', networks[0])
+        self.assertEqual(self._read_dhcp_file('eth0', 'conf'),
+                         "10.0.0.5,fake_instance00.novalocal,192.168.0.102\n"
+                         "10.0.0.4,fake_instance01.novalocal,192.168.1.101")
+        # NOTE: nothing changed, so dnsmasq isn't HUPed again
+        self.driver.update_dhcp(None, 'eth0', networks[0])
+        self.assertEqual(restarts, ['eth0', 'eth0'])
+
+    def test_update_dhcp_coalesces_hups(self):
+        self.flags(use_single_default_gateway=False, dhcp_hup_delay=0.01)
+        restarts = self._fake_restart_dhcp()
+        self.stubs.Set(db, 'network_get_associated_fixed_ips',
+                       lambda context, network_id: [fixed_ips[0]])
+        updated = [[dict(fixed_ips[3], deleted=False)],
+                   [dict(fixed_ips[4], deleted=False)]]
+        self.stubs.Set(db, 'network_get_fixed_ips_updated_since',
+                       lambda context, network_id, since: updated.pop())
+        self.driver.update_dhcp(None, 'eth0', networks[0])
+
+        threads = [greenthread.spawn(self.driver.update_dhcp,
+                                     None, 'eth0', networks[0])
+                   for i in xrange(2)]
+        for thread in threads:
+            thread.wait()
+
+        self.assertEqual(len(self._read_dhcp_file('eth0', 'conf').split()),
+                         3)
+        self.assertEqual(restarts, ['eth0', 'eth0'])
+
     def test_dhcp_opts_not_default_gateway_network(self):
         expected = "NW-i00000000-0,3"
         actual = self.driver._host_dhcp_opts(fixed_ips[0])
@@ -145,3 +145,35 @@ class MetadataTestCase(test.TestCase):
     def test_local_hostname_fqdn(self):
         self.assertEqual(self.request('/meta-data/local-hostname'),
             "%s.%s" % (self.instance['hostname'], FLAGS.dhcp_domain))
+
+    def test_metadata_only_for_undeleted_instances(self):
+        filters = []
+
+        def instance_get_list(context, search_opts, *args, **kwargs):
+            filters.append(search_opts)
+            return []
+
+        self.stubs.Set(api, 'instance_get_all_by_filters', instance_get_list)
+        request = webob.Request.blank('/user-data')
+        request.remote_addr = '127.0.0.1'
+        self.assertEqual(request.get_response(self.app).status_int, 404)
+        self.assertEqual(filters[0]['deleted'], False)
+
+    def test_metadata_is_cached(self):
+        self.instance['user_data'] = base64.b64encode('happy')
+        self.assertEqual(self.request('/user-data'), 'happy')
+
+        def instance_get_fails(*args, **kwargs):
+            self.fail(_("Metadata should have come from the cache"))
+
+        self.stubs.Set(api, 'instance_get', instance_get_fails)
+        self.stubs.Set(api, 'instance_get_all_by_filters', instance_get_fails)
+        self.assertEqual(self.request('/meta-data/hostname'),
+            "%s.%s" % (self.instance['hostname'], FLAGS.dhcp_domain))
+
+    def test_metadata_cache_expires(self):
+        self.flags(metadata_cache_expiration=0)
+        self.instance['user_data'] = base64.b64encode('happy')
+        self.assertEqual(self.request('/user-data'), 'happy')
+        self.instance['user_data'] = base64.b64encode('updated')
+        self.assertEqual(self.request('/user-data'), 'updated')
@@ -14,19 +14,26 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import datetime
+
 import mox
+import netaddr
 
 from nova import context
 from nova import db
 from nova import exception
+from nova import flags
 from nova import log as logging
 from nova import quota
 from nova import rpc
 from nova import test
+from nova import utils
+from nova.network import api as network_api
 from nova.network import manager as network_manager
 from nova.tests import fake_network
 
 
+FLAGS = flags.FLAGS
 LOG = logging.getLogger('nova.tests.network')
 
 
@@ -296,6 +303,7 @@ class VlanNetworkTestCase(test.TestCase):
         self.mox.StubOutWithMock(db, 'fixed_ip_update')
         self.mox.StubOutWithMock(db,
                               'virtual_interface_get_by_instance_and_network')
+        self.mox.StubOutWithMock(db, 'instance_info_cache_invalidate')
 
         db.fixed_ip_associate(mox.IgnoreArg(),
                               mox.IgnoreArg(),
@@ -306,6 +314,7 @@ class VlanNetworkTestCase(test.TestCase):
                            mox.IgnoreArg())
         db.virtual_interface_get_by_instance_and_network(mox.IgnoreArg(),
                 mox.IgnoreArg(), mox.IgnoreArg()).AndReturn({'id': 0})
+        db.instance_info_cache_invalidate(mox.IgnoreArg(), 0)
         self.mox.ReplayAll()
 
         network = dict(networks[0])
@@ -505,11 +514,13 @@ class VlanNetworkTestCase(test.TestCase):
         # fixed ip with remote host
         def fake4(*args, **kwargs):
             return {'address': '10.0.0.1',
+                    'instance_id': 1,
                     'network': {'multi_host': False, 'host': 'jibberjabber'}}
 
         # fixed ip with local host
         def fake5(*args, **kwargs):
             return {'address': '10.0.0.1',
+                    'instance_id': 1,
                     'network': {'multi_host': False, 'host': 'testhost'}}
 
         def fake6(*args, **kwargs):
@@ -566,11 +577,13 @@ class VlanNetworkTestCase(test.TestCase):
         # fixed ip with remote host
         def fake4(*args, **kwargs):
             return {'address': '10.0.0.1',
+                    'instance_id': 1,
                     'network': {'multi_host': False, 'host': 'jibberjabber'}}
 
         # fixed ip with local host
         def fake5(*args, **kwargs):
             return {'address': '10.0.0.1',
+                    'instance_id': 1,
                     'network': {'multi_host': False, 'host': 'testhost'}}
 
         def fake6(*args, **kwargs):
@@ -778,6 +791,36 @@ class CommonNetworkTestCase(test.TestCase):
             self.assertTrue(exp_cidr in cidrs)
         self.assertFalse('192.168.2.0/27' in cidrs)
 
+    def test_validate_cidrs_split_skips_used_cidrs(self):
+        manager = fake_network.FakeNetworkManager()
+        self.mox.StubOutWithMock(manager.db, 'network_get_all')
+        ctxt = mox.IgnoreArg()
+        in_use = [{'id': 1, 'cidr': '192.168.0.0/24'},
+                  {'id': 2, 'cidr': '192.168.1.128/25'},
+                  {'id': 3, 'cidr': '192.168.3.0/24'},
+                  {'id': 4, 'cidr': None}]
+        manager.db.network_get_all(ctxt).AndReturn(in_use)
+        self.mox.ReplayAll()
+        nets = manager.create_networks(None, 'fake', '192.168.0.0/16',
+                                       False, 2, 256, None, None, None, None,
+                                       None)
+        self.assertEqual([str(net['cidr']) for net in nets],
+                         ['192.168.2.0/24', '192.168.4.0/24'])
+
+    def test_validate_cidrs_split_conflict_existing_supernet(self):
+        manager = fake_network.FakeNetworkManager()
+        self.mox.StubOutWithMock(manager.db, 'network_get_all')
+        ctxt = mox.IgnoreArg()
+        in_use = [{'id': 1, 'cidr': '192.168.0.0/24'},
+                  {'id': 2, 'cidr': '192.168.0.0/17'}]
+        manager.db.network_get_all(ctxt).AndReturn(in_use)
+        self.mox.ReplayAll()
+        args = (None, 'fake', '192.168.0.0/16', False, 2, 256, None, None,
+                None, None, None)
+        # ValueError: requested cidr (192.168.1.0/24) conflicts
+        #             with existing supernet
+        self.assertRaises(ValueError, manager.create_networks, *args)
+
     def test_validate_cidrs_split_all_in_use(self):
         manager = fake_network.FakeNetworkManager()
         self.mox.StubOutWithMock(manager.db, 'network_get_all')
@@ -843,6 +886,21 @@ class CommonNetworkTestCase(test.TestCase):
         #             with existing supernet
         self.assertRaises(ValueError, manager.create_networks, *args)
 
+    def test_create_fixed_ips(self):
+        manager = network_manager.VlanManager(host='testhost')
+        self.mox.StubOutWithMock(manager.db, 'network_get')
+        self.mox.StubOutWithMock(manager.db, 'fixed_ip_bulk_create')
+        manager.db.network_get(None, 1).AndReturn({'cidr': '10.0.1.0/29'})
+        manager.db.fixed_ip_bulk_create(None, [
+                {'network_id': 1,
+                 'address': '10.0.1.%d' % index,
+                 'address_int': int(netaddr.IPAddress('10.0.1.%d' % index)),
+                 # NOTE: network, gateway, vpn and broadcast
+                 'reserved': index in (0, 1, 2, 7)}
+                for index in xrange(8)])
+        self.mox.ReplayAll()
+        manager._create_fixed_ips(None, 1)
+
     def test_create_networks(self):
         cidr = '192.168.0.0/24'
         manager = fake_network.FakeNetworkManager()
@@ -1013,3 +1071,104 @@ class FloatingIPTestCase(test.TestCase):
                 instance_id=instance_ref['id'])
         self.network.deallocate_for_instance(self.context,
                 instance_id=instance_ref['id'])
+
+    def test_deallocation_deletes_nw_info_cache(self):
+        instance_ref = db.api.instance_create(self.context,
+                {"project_id": self.project_id})
+        db.instance_info_cache_update(self.context, instance_ref['id'],
+                                      {'network_info': '[]'})
+        self.network.deallocate_for_instance(self.context,
+                instance_id=instance_ref['id'])
+        self.assertEqual(db.instance_info_cache_get(self.context,
+                                                    instance_ref['id']),
+                         None)
+
+    def test_get_instance_nw_info_not_cached_if_invalidated(self):
+        instance_ref = db.api.instance_create(self.context,
+                {"project_id": self.project_id})
+        build = self.network._build_instance_nw_info
+
+        def fake_build(context, instance_id, *args):
+            # NOTE: a deallocation sneaks in while building
+            db.instance_info_cache_invalidate(context, instance_id)
+            return build(context, instance_id, *args)
+
+        self.stubs.Set(self.network, '_build_instance_nw_info', fake_build)
+        self.network.get_instance_nw_info(self.context, instance_ref['id'],
+                                          1, 'testhost')
+        info_cache = db.instance_info_cache_get(self.context,
+                                                instance_ref['id'])
+        self.assertEqual(info_cache['network_info'], None)
+
+        self.stubs.UnsetAll()
+        self.network.get_instance_nw_info(self.context, instance_ref['id'],
+                                          1, 'testhost')
+        info_cache = db.instance_info_cache_get(self.context,
+                                                instance_ref['id'])
+        self.assertNotEqual(info_cache['network_info'], None)
+
+
+class NetworkAPITestCase(test.TestCase):
+    """Tests nova.network.api.API"""
+    def setUp(self):
+        super(NetworkAPITestCase, self).setUp()
+        self.network_api = network_api.API()
+        self.context = context.get_admin_context()
+        self.instance = db.instance_create(self.context,
+                                           {'host': 'testhost',
+                                            'instance_type_id': 1})
+        self.nw_info = [[{'bridge': 'fa0'}, {'ips': [{'ip': '10.0.0.2'}]}]]
+        self.rpc_calls = []
+
+        def fake_call(context, topic, msg):
+            self.rpc_calls.append(msg['method'])
+            return 'from rpc'
+
+        self.stubs.Set(rpc, 'call', fake_call)
+
+    def _cache(self, **kwargs):
+        record = {'version': network_api.NW_INFO_CACHE_VERSION,
+                  'host': 'testhost',
+                  'instance_type_id': 1,
+                  'network_info': self.nw_info}
+        record.update(kwargs)
+        db.instance_info_cache_update(self.context, self.instance['id'],
+                                      {'network_info': utils.dumps(record)})
+
+    def test_get_instance_nw_info_cached(self):
+        self._cache()
+        self.assertEqual(self.network_api.get_instance_nw_info(self.context,
+                                                               self.instance),
+                         self.nw_info)
+        self.assertEqual(self.rpc_calls, [])
+
+    def test_get_instance_nw_info_not_cached(self):
+        self.assertEqual(self.network_api.get_instance_nw_info(self.context,
+                                                               self.instance),
+                         'from rpc')
+        self.assertEqual(self.rpc_calls, ['get_instance_nw_info'])
+
+    def test_get_instance_nw_info_stale_cache(self):
+        for stale in ({'version': network_api.NW_INFO_CACHE_VERSION - 1},
+                      {'host': 'otherhost'},
+                      {'instance_type_id': 2}):
+            self._cache(**stale)
+            self.assertEqual(self.network_api.get_instance_nw_info(
+                    self.context, self.instance), 'from rpc')
+        self.assertEqual(len(self.rpc_calls), 3)
+
+    def test_get_instance_nw_info_expired_cache(self):
+        self._cache()
+        now = utils.utcnow() + datetime.timedelta(
+                seconds=FLAGS.network_info_cache_ttl + 1)
+        self.stubs.Set(utils, 'utcnow', lambda: now)
+        self.assertEqual(self.network_api.get_instance_nw_info(self.context,
+                                                               self.instance),
+                         'from rpc')
+
+    def test_get_instance_nw_info_cache_disabled(self):
+        self._cache()
+        self.flags(network_info_cache_ttl=0)
+        self.assertEqual(self.network_api.get_instance_nw_info(self.context,
+                                                               self.instance),
+                         'from rpc')
@@ -21,6 +21,7 @@ Unittets for S3 objectstore clone.
 """
 
 import boto
+import hashlib
 import os
 import shutil
 import tempfile
@@ -128,6 +129,32 @@ class S3APITestCase(test.TestCase):
 
         self._ensure_no_buckets(bucket.get_all_keys())
 
+    def test_key_contents_streamed_in_chunks(self):
+        """Test objects larger than a chunk go in and out intact."""
+        self.flags(s3_chunk_size=1000)
+        key_contents = ''.join(chr(i % 256) for i in xrange(4500))
+
+        b = self.conn.create_bucket('testbucket')
+        k = b.new_key('bigkey')
+        k.set_contents_from_string(key_contents)
+        md5 = hashlib.md5(key_contents).hexdigest()
+        self.assertEquals(k.etag, '"%s"' % md5)
+
+        key = self.conn.get_bucket('testbucket').get_key('bigkey')
+        self.assertEquals(key.get_contents_as_string(), key_contents)
+
+    def test_get_key_range(self):
+        """Test reading part of an object."""
+        b = self.conn.create_bucket('testbucket')
+        k = b.new_key('somekey')
+        k.set_contents_from_string('0123456789')
+
+        key = self.conn.get_bucket('testbucket').get_key('somekey')
+        self.assertEquals(key.get_contents_as_string(
+                              headers={'Range': 'bytes=2-5'}), '2345')
+        self.assertEquals(key.get_contents_as_string(
+                              headers={'Range': 'bytes=7-'}), '789')
+
     def test_unknown_bucket(self):
         bucket_name = 'falalala'
         self.assertRaises(boto_exception.S3ResponseError,
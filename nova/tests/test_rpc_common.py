@@ -19,9 +19,11 @@
 Unit Tests for remote procedure calls shared between all implementations
 """
 
+import eventlet
+
 from nova import context
 from nova import log as logging
-from nova.rpc.common import RemoteError
+from nova.rpc.common import RemoteError, Timeout
 from nova import test
 
 
@@ -122,6 +124,17 @@ class _BaseRpcTestCase(test.TestCase):
         except RemoteError as exc:
             self.assertEqual(int(exc.value), value)
 
+    def test_call_timeout(self):
+        """Make sure rpc.call will time out"""
+        value = 1
+        self.assertRaises(Timeout,
+                          self.rpc.call,
+                          self.context,
+                          'test',
+                          {"method": "block",
+                           "args": {"value": value}},
+                          timeout=0.1)
+
     def test_nested_calls(self):
         """Test that we can do an rpc.call inside another call."""
         class Nested(object):
@@ -183,6 +196,12 @@ class TestReceiver(object):
         yield value + 1
         yield value + 2
 
+    @staticmethod
+    def block(context, value):
+        """Sleeps for value seconds before returning it."""
+        eventlet.sleep(value)
+        return value
+
     @staticmethod
     def fail(context, value):
         """Raises an exception with the value sent in."""
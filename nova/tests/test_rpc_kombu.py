@@ -19,6 +19,9 @@
 Unit Tests for remote procedure calls using kombu
 """
 
+import eventlet
+from eventlet import event
+
 from nova import context
 from nova import log as logging
 from nova import test
@@ -47,6 +50,180 @@ class RpcKombuTestCase(test_rpc_common._BaseRpcTestCase):
         conn_context.close()
         self.assertEqual(conn1, conn2)
 
+    def test_calls_share_reply_queue(self):
+        """Test that calls don't declare a reply queue each."""
+        self.flags(rpc_shared_reply_queue=True)
+        reply_proxy = self.rpc._get_reply_proxy()
+        declared = []
+
+        class CountingDirectConsumer(impl_kombu.DirectConsumer):
+            def __init__(self, *args, **kwargs):
+                declared.append(args)
+                super(CountingDirectConsumer, self).__init__(*args, **kwargs)
+
+        self.stubs.Set(impl_kombu, 'DirectConsumer', CountingDirectConsumer)
+        for value in xrange(3):
+            result = self.rpc.call(self.context, 'test',
+                                   {"method": "echo",
+                                    "args": {"value": value}})
+            self.assertEqual(value, result)
+
+        self.assertEqual(declared, [])
+        self.assertTrue(self.rpc._get_reply_proxy() is reply_proxy)
+        self.assertEqual(reply_proxy.waiters, {})
+
+    def test_calls_reply_on_own_queue_by_default(self):
+        """Test that calls older services can answer are the default."""
+        declared = []
+        sent = []
+        orig_declare = impl_kombu.Connection.declare_direct_consumer
+        orig_topic_send = impl_kombu.Connection.topic_send
+
+        def _recording_declare(conn, topic, callback):
+            declared.append(topic)
+            orig_declare(conn, topic, callback)
+
+        def _recording_topic_send(conn, topic, msg):
+            sent.append(dict(msg))
+            orig_topic_send(conn, topic, msg)
+
+        self.stubs.Set(impl_kombu.Connection, 'declare_direct_consumer',
+                       _recording_declare)
+        self.stubs.Set(impl_kombu.Connection, 'topic_send',
+                       _recording_topic_send)
+        result = self.rpc.call(self.context, 'test',
+                               {"method": "echo", "args": {"value": 42}})
+        self.assertEqual(result, 42)
+        self.assertEqual(declared, [sent[0]['_msg_id']])
+        self.assertFalse('_reply_q' in sent[0])
+
+    def test_call_timeout_shared_reply_queue(self):
+        """Test that calls on the shared reply queue time out too."""
+        self.flags(rpc_shared_reply_queue=True)
+        self.test_call_timeout()
+
+    def test_publishers_are_reused(self):
+        """Test that sends on a connection share one topic publisher."""
+        created = []
+        orig_reconnect = impl_kombu.Publisher.reconnect
+
+        def _counting_reconnect(publisher, channel):
+            created.append(publisher)
+            orig_reconnect(publisher, channel)
+
+        self.stubs.Set(impl_kombu.Publisher, 'reconnect', _counting_reconnect)
+        conn = self.rpc.create_connection()
+        for topic in ('reuse_a', 'reuse_b', 'reuse_a'):
+            conn.topic_send(topic, 'reuse test message')
+        conn.close()
+        self.assertEqual(len(created), 1)
+
+    def test_bulk_cast(self):
+        """Test casting to several topics in one go"""
+        conn = self.rpc.create_connection()
+        received = []
+
+        def _callback(message):
+            received.append(message['args']['value'])
+
+        conn.declare_topic_consumer('bulk_a', _callback)
+        conn.declare_topic_consumer('bulk_b', _callback)
+        self.rpc.bulk_cast(self.context,
+                           [('bulk_a', {"method": "echo",
+                                         "args": {"value": 'a'}}),
+                            ('bulk_b', {"method": "echo",
+                                         "args": {"value": 'b'}})])
+        conn.consume(limit=2)
+        conn.close()
+
+        self.assertEqual(sorted(received), ['a', 'b'])
+
+    def _fake_blocking_proxy(self):
+        """Return a proxy whose methods wait for self.release."""
+        self.release = event.Event()
+        self.done = []
+        release = self.release
+        done = self.done
+
+        class BlockingProxy(object):
+            def wait(self, context, value):
+                release.wait()
+                done.append(value)
+
+            refresh = wait
+
+        return BlockingProxy()
+
+    def _message(self, method, value):
+        message = {'method': method, 'args': {'value': value}}
+        impl_kombu._pack_context(message, self.context)
+        return message
+
+    def test_proxy_callback_limits_method(self):
+        """Test that messages over a method's limit wait their turn."""
+        self.flags(rpc_method_concurrency=['wait:1'])
+        callback = impl_kombu.ProxyCallback(self._fake_blocking_proxy())
+        for value in xrange(3):
+            callback(self._message('wait', value))
+        eventlet.sleep(0)
+        self.assertEqual(callback.get_stats(),
+                         {'wait': dict(running=1, queued=2)})
+
+        self.release.send()
+        callback.pool.waitall()
+        self.assertEqual(self.done, [0, 1, 2])
+        self.assertEqual(callback.get_stats(), {})
+
+    def test_proxy_callback_coalesces_duplicates(self):
+        """Test that a cast identical to a waiting one is dropped."""
+        self.flags(rpc_method_concurrency=['refresh:1'],
+                   rpc_coalesce_methods=['refresh'])
+        callback = impl_kombu.ProxyCallback(self._fake_blocking_proxy())
+        for value in (1, 1, 1, 2):
+            callback(self._message('refresh', value))
+        self.assertEqual(callback.get_stats(),
+                         {'refresh': dict(running=1, queued=2)})
+
+        self.release.send()
+        callback.pool.waitall()
+        self.assertEqual(self.done, [1, 1, 2])
+
+    def test_proxy_callback_backpressure(self):
+        """Test that the consumer blocks once the backlog is full."""
+        self.flags(rpc_method_concurrency=['wait:1'],
+                   rpc_max_queued_messages=1)
+        callback = impl_kombu.ProxyCallback(self._fake_blocking_proxy())
+        callback(self._message('wait', 0))
+        callback(self._message('wait', 1))
+        consumer = eventlet.spawn(callback, self._message('wait', 2))
+        eventlet.sleep(0)
+        self.assertFalse(consumer.dead)
+        self.assertEqual(callback.get_stats(),
+                         {'wait': dict(running=1, queued=1)})
+
+        self.release.send()
+        consumer.wait()
+        callback.pool.waitall()
+        self.assertEqual(self.done, [0, 1, 2])
+
+    def test_consumers_share_proxy_limits(self):
+        """Test that a proxy's consumers dispatch through one callback."""
+        self.flags(rpc_method_concurrency=['wait:1'])
+        proxy = self._fake_blocking_proxy()
+        conn = self.rpc.create_connection()
+        conn.create_consumer('limits', proxy, fanout=False)
+        conn.create_consumer('limits.host', proxy, fanout=False)
+        self.assertEqual(len(conn.proxy_callbacks), 1)
+
+        callback = conn.proxy_callbacks.values()[0]
+        callback(self._message('wait', 0))
+        callback(self._message('wait', 1))
+        self.assertEqual(conn.get_dispatch_stats(),
+                         {'wait': dict(running=1, queued=1)})
+        self.release.send()
+        callback.pool.waitall()
+        conn.close()
+
     def test_topic_send_receive(self):
         """Test sending to a topic exchange/queue"""
 
@@ -1410,7 +1410,8 @@ class XenAPIDom0IptablesFirewallTestCase(test.TestCase):
             return [ip['ip'] for ip in ips]
 
         network_info = fake_network.fake_get_instance_nw_info(self.stubs, 1)
-        self.stubs.Set(db, 'instance_get_fixed_addresses', get_fixed_ips)
+        self.stubs.Set(db, 'security_group_get_fixed_addresses',
+                       get_fixed_ips)
         self.fw.prepare_instance_filter(instance_ref, network_info)
         self.fw.apply_instance_filter(instance_ref, network_info)
 
@@ -1481,7 +1482,7 @@ class XenAPIDom0IptablesFirewallTestCase(test.TestCase):
                                        'to_port': 299,
                                        'cidr': '192.168.99.0/24'})
         #validate the extra rule
-        self.fw.refresh_security_group_rules(secgroup)
+        self.fw.refresh_security_group_rules(secgroup['id'])
         regex = re.compile('-A .* -j ACCEPT -p udp --dport 200:299'
                            ' -s 192.168.99.0/24')
         self.assertTrue(len(filter(regex.match, self._out_rules)) > 0,
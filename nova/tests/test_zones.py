@@ -17,6 +17,7 @@ Tests For ZoneManager
 """
 
 import datetime
+import eventlet
 import mox
 
 from nova import context
@@ -28,6 +29,7 @@ from nova import rpc
 from nova import utils
 from nova.auth import manager as auth_manager
 from nova.scheduler import zone_manager
+from nova.tests.scheduler import fake_zone_manager
 
 FLAGS = flags.FLAGS
 
@@ -205,6 +207,22 @@ class ZoneManagerTestCase(test.TestCase):
         self.assertEquals(zone_state.attempt, 3)
         self.assertFalse(zone_state.is_active)
 
+    def test_poll_zone_times_out(self):
+        def _slow_novaclient(zone):
+            eventlet.sleep(10)
+
+        self.flags(zone_call_timeout=0.01)
+        self.stubs.Set(zone_manager, "_call_novaclient", _slow_novaclient)
+
+        zone_state = zone_manager.ZoneState()
+        zone_state.update_credentials(FakeZone(id=2,
+                       api_url='http://foo.com', username='user2',
+                       password='pass2', name='child',
+                       weight_offset=0.0, weight_scale=1.0))
+        zone_manager._poll_zone(zone_state)
+        self.assertEquals(zone_state.attempt, 1)
+        self.assertTrue(zone_state.is_active)
+
     def test_host_service_caps_stale_no_stale_service(self):
         zm = zone_manager.ZoneManager()
 
@@ -379,3 +397,177 @@ class ZoneManagerTestCase(test.TestCase):
         utils.set_time_override(time_future)
         caps = zm.get_zone_capabilities(None)
         self.assertEquals(caps, {})
+
+    def test_capability_index(self):
+        zm = zone_manager.ZoneManager()
+        zm.update_service_capabilities("compute", "host1",
+                                       dict(arch="x86", gpus=2))
+        zm.update_service_capabilities("compute", "host2",
+                                       dict(arch="x86", gpus=4))
+        zm.update_service_capabilities("compute", "host3",
+                                       dict(arch="arm", gpus=4))
+        zm.update_service_capabilities("compute", "host4",
+                                       dict(arch="x86", gpus=4,
+                                            enabled=False))
+
+        self.assertEquals(set(["host1", "host2"]),
+                zm.get_hosts_with_capabilities("compute", dict(arch="x86")))
+        self.assertEquals(set(["host2"]),
+                zm.get_hosts_with_capabilities("compute",
+                                               dict(arch="x86", gpus=4)))
+        self.assertEquals(set(),
+                zm.get_hosts_with_capabilities("compute", dict(arch="ppc")))
+        self.assertEquals(set(),
+                zm.get_hosts_with_capabilities("volume", dict(arch="x86")))
+        self.assertEquals(None,
+                zm.get_hosts_with_capabilities("compute", {}))
+        self.assertEquals(None,
+                zm.get_hosts_with_capabilities("compute", dict(arch=[])))
+
+    def test_capability_index_mixed_value_types(self):
+        zm = zone_manager.ZoneManager()
+        cpu_info = dict(arch="x86_64", topology=dict(cores=4))
+        zm.update_service_capabilities("compute", "host1",
+                                       dict(cpu_info="x86_64"))
+        zm.update_service_capabilities("compute", "host2",
+                                       dict(cpu_info=cpu_info))
+
+        # Reports replacing unhashable values must not blow up.
+        zm.update_service_capabilities("compute", "host2",
+                                       dict(cpu_info=cpu_info))
+        zm.update_service_capabilities("compute", "host1",
+                                       dict(cpu_info="x86_64"))
+
+        self.assertEquals(set(["host1"]),
+                zm.get_hosts_with_capabilities("compute",
+                                               dict(cpu_info="x86_64")))
+        self.assertEquals(None,
+                zm.get_hosts_with_capabilities("compute",
+                                               dict(cpu_info=cpu_info)))
+        self.assertEquals(2,
+                len(zm.sorted_capabilities[("compute", "cpu_info")]))
+
+    def test_capability_index_follows_updates(self):
+        zm = zone_manager.ZoneManager()
+        expiry_time = (FLAGS.periodic_interval * 3) + 1
+
+        zm.update_service_capabilities("compute", "host1", dict(arch="x86"))
+        zm.update_service_capabilities("compute", "host2", dict(arch="x86"))
+
+        # A new report replaces the old values ...
+        zm.update_service_capabilities("compute", "host1", dict(arch="arm"))
+        self.assertEquals(set(["host2"]),
+                zm.get_hosts_with_capabilities("compute", dict(arch="x86")))
+        self.assertEquals(set(["host1"]),
+                zm.get_hosts_with_capabilities("compute", dict(arch="arm")))
+
+        # ... disabling a service takes it out of the index ...
+        zm.update_service_capabilities("compute", "host1",
+                                       dict(arch="arm", enabled=False))
+        self.assertEquals(set(),
+                zm.get_hosts_with_capabilities("compute", dict(arch="arm")))
+
+        # ... and so does expiring it.
+        serv_caps = zm.service_states["host2"]["compute"]
+        serv_caps["timestamp"] = utils.utcnow() - \
+                               datetime.timedelta(seconds=expiry_time)
+        self.assertEquals(zm.get_zone_capabilities(None), {})
+        self.assertEquals(set(),
+                zm.get_hosts_with_capabilities("compute", dict(arch="x86")))
+        self.assertEquals({}, zm.capability_index)
+        self.assertEquals({}, zm.sorted_capabilities)
+
+    def _host_data_zone_manager(self):
+        self.flags(reserved_host_disk_mb=0, reserved_host_memory_mb=0)
+        zm = fake_zone_manager.FakeZoneManager()
+        self.sync_calls = 0
+        orig_get_all_with_usage = zm._compute_node_get_all_with_usage
+
+        def _counting_get_all_with_usage(context):
+            self.sync_calls += 1
+            return orig_get_all_with_usage(context)
+
+        self.stubs.Set(zm, '_compute_node_get_all_with_usage',
+                       _counting_get_all_with_usage)
+        return zm
+
+    def test_get_all_host_data_seeds_cache_once(self):
+        zm = self._host_data_zone_manager()
+        host_data = zm.get_all_host_data(None)
+        self.assertEquals(host_data['host1'].free_ram_mb, 0)
+        self.assertEquals(host_data['host3'].free_ram_mb, 3072)
+
+        # Consuming from the returned copies must not leak into the cache.
+        host_data['host3'].consume_resources(1024, 1024)
+        host_data = zm.get_all_host_data(None)
+        self.assertEquals(host_data['host3'].free_ram_mb, 3072)
+        self.assertEquals(self.sync_calls, 1)
+
+    def test_get_all_host_data_applies_reserved_resources(self):
+        zm = self._host_data_zone_manager()
+        self.flags(reserved_host_memory_mb=512)
+        host_data = zm.get_all_host_data(None)
+        self.assertEquals(host_data['host3'].free_ram_mb, 2560)
+        self.assertEquals(host_data['host3'].free_disk_gb, 3072)
+
+    def test_get_all_host_data_instance_events(self):
+        zm = self._host_data_zone_manager()
+        zm.get_all_host_data(None)
+
+        zm.update_instance_info('host4',
+                                dict(id=5, local_gb=100, memory_mb=1024))
+        # Repeated notices for the same instance are counted once.
+        zm.update_instance_info('host4',
+                                dict(id=5, local_gb=100, memory_mb=1024))
+        host_data = zm.get_all_host_data(None)
+        self.assertEquals(host_data['host4'].free_ram_mb, 7168)
+        self.assertEquals(host_data['host4'].free_disk_gb, 8092)
+
+        # A resize onto another host releases the old resources.
+        zm.update_instance_info('host3',
+                                dict(id=5, local_gb=200, memory_mb=2048))
+        host_data = zm.get_all_host_data(None)
+        self.assertEquals(host_data['host4'].free_ram_mb, 8192)
+        self.assertEquals(host_data['host3'].free_ram_mb, 1024)
+
+        # Instance 4 was only counted by the db.
+        zm.delete_instance_info('host3',
+                                dict(id=4, local_gb=1024, memory_mb=1024))
+        # The tracked size wins over the one in the notice.
+        zm.delete_instance_info('host4',
+                                dict(id=5, local_gb=1, memory_mb=1))
+        host_data = zm.get_all_host_data(None)
+        self.assertEquals(host_data['host3'].free_ram_mb, 4096)
+        self.assertEquals(host_data['host3'].free_disk_gb, 4096)
+        self.assertEquals(host_data['host4'].free_ram_mb, 8192)
+        self.assertEquals(self.sync_calls, 1)
+
+    def test_get_all_host_data_reconciles_periodically(self):
+        zm = self._host_data_zone_manager()
+        zm.get_all_host_data(None)
+        zm.delete_instance_info('host3',
+                                dict(id=4, local_gb=1024, memory_mb=1024))
+
+        interval = FLAGS.host_state_reconcile_interval + 1
+        time_future = utils.utcnow() + datetime.timedelta(seconds=interval)
+        utils.set_time_override(time_future)
+        host_data = zm.get_all_host_data(None)
+        utils.clear_time_override()
+        self.assertEquals(host_data['host3'].free_ram_mb, 3072)
+        self.assertEquals(self.sync_calls, 2)
+
+    def test_get_all_host_data_new_compute_host(self):
+        zm = self._host_data_zone_manager()
+        zm.get_all_host_data(None)
+        zm.update_service_capabilities("compute", "host1", dict(a=1))
+        zm.get_all_host_data(None)
+        self.assertEquals(self.sync_calls, 1)
+
+        zm.update_service_capabilities("compute", "host5", dict(a=1))
+        zm.get_all_host_data(None)
+        self.assertEquals(self.sync_calls, 2)
+
+        # host5 has no compute node yet; don't rescan on every report.
+        zm.update_service_capabilities("compute", "host5", dict(a=1))
+        zm.get_all_host_data(None)
+        self.assertEquals(self.sync_calls, 2)
@@ -505,6 +505,15 @@ class ComputeDriver(object):
         # TODO(Vek): Need to pass context in for access to auth_token
         raise NotImplementedError()
 
+    def manage_image_cache(self, context, images):
+        """Prefetch images into the local image cache and evict unused
+        images from it.
+
+        :param images: dicts with the image_ref, kernel_id and ramdisk_id
+                       to prefetch
+        """
+        raise NotImplementedError()
+
     def host_power_action(self, host, action):
         """Reboots, shuts down or powers up the host."""
         raise NotImplementedError()
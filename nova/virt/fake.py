@@ -144,6 +144,9 @@ class FakeConnection(driver.ComputeDriver):
     def poll_unconfirmed_resizes(self, resize_confirm_window):
         pass
 
+    def manage_image_cache(self, context, images):
+        pass
+
     def pause(self, instance):
         pass
 
@@ -17,8 +17,11 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import re
+
 from nova import context
 from nova import db
+from nova import exception
 from nova import flags
 from nova import log as logging
 from nova import utils
@@ -32,6 +35,13 @@ flags.DEFINE_string('firewall_driver',
 flags.DEFINE_bool('allow_same_net_traffic',
                   True,
                   'Whether to allow network traffic from same network')
+flags.DEFINE_integer('firewall_ipset_threshold',
+                     0,
+                     'Match source security groups with more members than '
+                     'this through an ipset instead of a rule per member '
+                     'address (0 disables ipsets)')
+
+_MATCH_SET_RE = re.compile(r'--match-set (\S+) src')
 
 
 class FirewallDriver(object):
@@ -105,6 +115,14 @@ class IptablesFirewallDriver(FirewallDriver):
         self.instances = {}
         self.network_infos = {}
         self.basicly_filtered = False
+        # security group id -> (ipv4 rules, ipv6 rules, grantee group ids)
+        self.sg_rules_cache = {}
+        # security group id -> fixed addresses of its instances
+        self.sg_member_ips = {}
+        # ipsets we created -> their security group id, and the names of
+        # those each instance's rules match against
+        self.ipsets = {}
+        self.instance_ipsets = {}
 
         self.iptables.ipv4['filter'].add_chain('sg-fallback')
         self.iptables.ipv4['filter'].add_rule('sg-fallback', '-j DROP')
@@ -123,6 +141,7 @@ class IptablesFirewallDriver(FirewallDriver):
             self.network_infos.pop(instance['id'])
             self.remove_filters_for_instance(instance)
             self.iptables.apply()
+            self._destroy_unused_ipsets()
         else:
             LOG.info(_('Attempted to unfilter instance %s which is not '
                      'filtered'), instance['id'])
@@ -172,9 +191,13 @@ class IptablesFirewallDriver(FirewallDriver):
         self._add_filters('local', ipv4_rules, ipv6_rules)
         ipv4_rules, ipv6_rules = self.instance_rules(instance, network_info)
         self._add_filters(chain_name, ipv4_rules, ipv6_rules)
+        self.instance_ipsets[instance['id']] = set(
+                match.group(1) for match in
+                (_MATCH_SET_RE.search(rule) for rule in ipv4_rules) if match)
 
     def remove_filters_for_instance(self, instance):
         chain_name = self._instance_chain_name(instance)
+        self.instance_ipsets.pop(instance['id'], None)
 
         self.iptables.ipv4['filter'].remove_chain(chain_name)
         if FLAGS.use_ipv6:
@@ -268,65 +291,156 @@ class IptablesFirewallDriver(FirewallDriver):
 
         # then, security group chains and rules
         for security_group in security_groups:
-            rules = db.security_group_rule_get_by_security_group(ctxt,
+            sg_ipv4_rules, sg_ipv6_rules = self._security_group_rules(ctxt,
                                                           security_group['id'])
+            ipv4_rules += sg_ipv4_rules
+            ipv6_rules += sg_ipv6_rules
 
-            for rule in rules:
-                LOG.debug(_('Adding security group rule: %r'), rule)
-
-                if not rule.cidr:
-                    version = 4
-                else:
-                    version = netutils.get_ip_version(rule.cidr)
-
-                if version == 4:
-                    fw_rules = ipv4_rules
-                else:
-                    fw_rules = ipv6_rules
-
-                protocol = rule.protocol
-                if version == 6 and rule.protocol == 'icmp':
-                    protocol = 'icmpv6'
-
-                args = ['-j ACCEPT']
-                if protocol:
-                    args += ['-p', protocol]
-
-                if protocol in ['udp', 'tcp']:
-                    args += self._build_tcp_udp_rule(rule, version)
-                elif protocol == 'icmp':
-                    args += self._build_icmp_rule(rule, version)
-                if rule.cidr:
-                    LOG.info('Using cidr %r', rule.cidr)
-                    args += ['-s', rule.cidr]
-                    fw_rules += [' '.join(args)]
-                else:
-                    if rule['grantee_group']:
-                        for instance in rule['grantee_group']['instances']:
-                            LOG.info('instance: %r', instance)
-                            ips = db.instance_get_fixed_addresses(ctxt,
-                                                                instance['id'])
-                            LOG.info('ips: %r', ips)
-                            for ip in ips:
-                                subrule = args + ['-s %s' % ip]
-                                fw_rules += [' '.join(subrule)]
-
-                LOG.info('Using fw_rules: %r', fw_rules)
         ipv4_rules += ['-j $sg-fallback']
         ipv6_rules += ['-j $sg-fallback']
 
         return ipv4_rules, ipv6_rules
 
+    def _security_group_rules(self, ctxt, security_group_id):
+        """Return the ipv4 and ipv6 rules a security group allows.
+
+        The rules are compiled once and kept until a refresh of the group,
+        or of a group it grants access to, invalidates them.
+
+        """
+        cached = self.sg_rules_cache.get(security_group_id)
+        if cached is not None:
+            return cached[0], cached[1]
+
+        ipv4_rules = []
+        ipv6_rules = []
+        grantees = set()
+        rules = db.security_group_rule_get_by_security_group(ctxt,
+                                                             security_group_id)
+
+        for rule in rules:
+            LOG.debug(_('Adding security group rule: %r'), rule)
+
+            if not rule.cidr:
+                version = 4
+            else:
+                version = netutils.get_ip_version(rule.cidr)
+
+            if version == 4:
+                fw_rules = ipv4_rules
+            else:
+                fw_rules = ipv6_rules
+
+            protocol = rule.protocol
+            if version == 6 and rule.protocol == 'icmp':
+                protocol = 'icmpv6'
+
+            args = ['-j ACCEPT']
+            if protocol:
+                args += ['-p', protocol]
+
+            if protocol in ['udp', 'tcp']:
+                args += self._build_tcp_udp_rule(rule, version)
+            elif protocol == 'icmp':
+                args += self._build_icmp_rule(rule, version)
+            if rule.cidr:
+                LOG.info('Using cidr %r', rule.cidr)
+                args += ['-s', rule.cidr]
+                fw_rules += [' '.join(args)]
+            else:
+                if rule['grantee_group']:
+                    grantee_id = rule['grantee_group']['id']
+                    grantees.add(grantee_id)
+                    ips = self._security_group_member_ips(ctxt, grantee_id)
+                    LOG.info('ips: %r', ips)
+                    threshold = FLAGS.firewall_ipset_threshold
+                    if threshold and len(ips) > threshold:
+                        set_name = self._ensure_ipset(grantee_id, ips)
+                        subrule = args + ['-m set --match-set %s src' %
+                                          set_name]
+                        fw_rules += [' '.join(subrule)]
+                    else:
+                        for ip in ips:
+                            subrule = args + ['-s %s' % ip]
+                            fw_rules += [' '.join(subrule)]
+
+            LOG.info('Using fw_rules: %r', fw_rules)
+
+        self.sg_rules_cache[security_group_id] = (ipv4_rules, ipv6_rules,
+                                                  grantees)
+        return ipv4_rules, ipv6_rules
+
+    def _security_group_member_ips(self, ctxt, security_group_id):
+        ips = self.sg_member_ips.get(security_group_id)
+        if ips is None:
+            ips = db.security_group_get_fixed_addresses(ctxt,
+                                                        security_group_id)
+            self.sg_member_ips[security_group_id] = ips
+        return ips
+
+    def _ensure_ipset(self, security_group_id, ips):
+        """Make the ipset for a security group hold exactly ips.
+
+        The new members are loaded into a scratch set which is then
+        swapped in, so rules matching the set never see it half filled.
+
+        """
+        set_name = 'nova-sg-%s' % (security_group_id,)
+        new_name = '%s-new' % (set_name,)
+        lines = ['create %s hash:ip family inet -exist' % (set_name,),
+                 'create %s hash:ip family inet -exist' % (new_name,),
+                 'flush %s' % (new_name,)]
+        lines += ['add %s %s' % (new_name, ip) for ip in ips]
+        lines += ['swap %s %s' % (new_name, set_name),
+                  'destroy %s' % (new_name,)]
+        self.iptables.execute('ipset', 'restore', run_as_root=True,
+                              process_input='\n'.join(lines) + '\n')
+        self.ipsets[set_name] = security_group_id
+        return set_name
+
+    def _destroy_unused_ipsets(self):
+        """Destroy the ipsets no instance's rules match against anymore.
+
+        Must run after the rules that used them have been applied, as the
+        kernel refuses to destroy a set that is still referenced. Cached
+        rules matching against a destroyed set are dropped, so the set is
+        created again when they are next needed.
+
+        """
+        in_use = set()
+        for set_names in self.instance_ipsets.values():
+            in_use.update(set_names)
+        for set_name in set(self.ipsets) - in_use:
+            try:
+                self.iptables.execute('ipset', 'destroy', set_name,
+                                      run_as_root=True)
+            except exception.ProcessExecutionError:
+                LOG.warn(_('Failed to destroy unused ipset %s'), set_name)
+                continue
+            self._forget_rules_granting(self.ipsets.pop(set_name))
+
+    def _forget_rules_granting(self, security_group_id):
+        """Drop the cached rules of the groups granting access to
+        security_group_id."""
+        for cached_group_id, cached in self.sg_rules_cache.items():
+            if security_group_id in cached[2]:
+                del self.sg_rules_cache[cached_group_id]
+
     def instance_filter_exists(self, instance, network_info):
         pass
 
     def refresh_security_group_members(self, security_group):
+        self.sg_member_ips.pop(security_group, None)
+        self._forget_rules_granting(security_group)
         self.do_refresh_security_group_rules(security_group)
         self.iptables.apply()
+        self._destroy_unused_ipsets()
 
     def refresh_security_group_rules(self, security_group):
+        self.sg_rules_cache.pop(security_group, None)
         self.do_refresh_security_group_rules(security_group)
         self.iptables.apply()
+        self._destroy_unused_ipsets()
 
     @utils.synchronized('iptables', external=True)
     def do_refresh_security_group_rules(self, security_group):
@@ -21,6 +21,7 @@
 Handling of VM disk images.
 """
 
+import hashlib
 import os
 
 from nova import exception
@@ -43,31 +44,55 @@ def fetch(context, image_href, path, _user_id, _project_id):
     (image_service, image_id) = nova.image.get_image_service(context,
                                                              image_href)
     with open(path, "wb") as image_file:
-        metadata = image_service.get(context, image_id, image_file)
+        checksum_file = _ChecksumFile(image_file)
+        metadata = image_service.get(context, image_id, checksum_file)
+
+    expected = metadata.get('checksum')
+    if expected and expected != checksum_file.hexdigest():
+        os.unlink(path)
+        raise exception.ImageUnacceptable(image_id=image_href,
+            reason=_("checksum %(actual)s does not match %(expected)s") %
+            {'actual': checksum_file.hexdigest(), 'expected': expected})
     return metadata
 
 
-def fetch_to_raw(context, image_href, path, user_id, project_id):
-    path_tmp = "%s.part" % path
-    metadata = fetch(context, image_href, path_tmp, user_id, project_id)
+class _ChecksumFile(object):
+    """Computes the md5 checksum of what is written through it, the same
+    as glance does when storing an image."""
+
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+        self.file_obj.write(data)
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
 
-    def _qemu_img_info(path):
 
-        out, err = utils.execute('env', 'LC_ALL=C', 'LANG=C',
-            'qemu-img', 'info', path)
+def qemu_img_info(path):
+    out, err = utils.execute('env', 'LC_ALL=C', 'LANG=C',
+        'qemu-img', 'info', path)
 
-        # output of qemu-img is 'field: value'
-        # the fields of interest are 'file format' and 'backing file'
-        data = {}
-        for line in out.splitlines():
-            (field, val) = line.split(':', 1)
-            if val[0] == " ":
-                val = val[1:]
-            data[field] = val
+    # output of qemu-img is 'field: value'
+    # the fields of interest are 'file format' and 'backing file'
+    data = {}
+    for line in out.splitlines():
+        (field, val) = line.split(':', 1)
+        if val[0] == " ":
+            val = val[1:]
+        data[field] = val
 
-        return(data)
+    return(data)
+
+
+def fetch_to_raw(context, image_href, path, user_id, project_id):
+    path_tmp = "%s.part" % path
+    metadata = fetch(context, image_href, path_tmp, user_id, project_id)
 
-    data = _qemu_img_info(path_tmp)
+    data = qemu_img_info(path_tmp)
 
     fmt = data.get("file format", None)
     if fmt == None:
@@ -88,7 +113,7 @@ def fetch_to_raw(context, image_href, path, user_id, project_id):
                                  path_tmp, staged)
         os.unlink(path_tmp)
 
-        data = _qemu_img_info(staged)
+        data = qemu_img_info(staged)
         if data.get('file format', None) != "raw":
             os.unlink(staged)
             raise exception.ImageUnacceptable(image_id=image_href,
@@ -71,6 +71,7 @@ from nova.virt import disk
 from nova.virt import driver
 from nova.virt import images
 from nova.virt import netutils
+from nova.virt.libvirt import imagecache
 
 
 libvirt = None
@@ -802,24 +803,82 @@ class LibvirtConnection(driver.ComputeDriver):
         """
 
         if not os.path.exists(target):
-            base_dir = os.path.join(FLAGS.instances_path, '_base')
-            if not os.path.exists(base_dir):
-                os.mkdir(base_dir)
-            base = os.path.join(base_dir, fname)
+            base = imagecache.get_base_path(fname)
 
+            # NOTE: the copy is made under the lock too, so that the
+            #       base image can't be evicted before it is used.
             @utils.synchronized(fname)
             def call_if_not_exists(base, fn, *args, **kwargs):
-                if not os.path.exists(base):
-                    fn(target=base, *args, **kwargs)
+                imagecache.fetch(base, fn, *args, **kwargs)
+                if cow:
+                    utils.execute('qemu-img', 'create', '-f', 'qcow2', '-o',
+                                  'cluster_size=2M,backing_file=%s' % base,
+                                  target)
+                else:
+                    utils.execute('cp', base, target)
 
             call_if_not_exists(base, fn, *args, **kwargs)
 
-            if cow:
-                utils.execute('qemu-img', 'create', '-f', 'qcow2', '-o',
-                              'cluster_size=2M,backing_file=%s' % base,
-                              target)
-            else:
-                utils.execute('cp', base, target)
+    @staticmethod
+    def _prefetch_image(fn, fname, *args, **kwargs):
+        """Like _cache_image, but only fetches the base image."""
+        base = imagecache.get_base_path(fname)
+
+        @utils.synchronized(fname)
+        def call_if_not_exists(base, fn, *args, **kwargs):
+            imagecache.fetch(base, fn, *args, **kwargs)
+
+        call_if_not_exists(base, fn, *args, **kwargs)
+
+    def manage_image_cache(self, context, images):
+        """Fetches the base images for each of images, then evicts base
+        images no instance uses down to base_image_cache_max_gb."""
+        fetched = set()
+        for image in images:
+            fnames = []
+            for image_id in (image['kernel_id'], image['ramdisk_id']):
+                if image_id:
+                    fnames.append((image_id, image_id, None))
+            root_fname = hashlib.sha1(image['image_ref']).hexdigest()
+            fnames.append((root_fname, image['image_ref'],
+                           FLAGS.minimum_root_size))
+
+            try:
+                for fname, image_id, size in fnames:
+                    self._prefetch_image(fn=self._fetch_image,
+                                         context=context,
+                                         fname=fname,
+                                         image_id=image_id,
+                                         user_id=None,
+                                         project_id=None,
+                                         size=size)
+                    fetched.add(fname)
+            except Exception:
+                LOG.exception(_("Failed to prefetch image %s"),
+                              image['image_ref'])
+
+        if FLAGS.base_image_cache_max_gb:
+            in_use = self._get_base_images_in_use() | fetched
+            imagecache.evict(in_use,
+                             FLAGS.base_image_cache_max_gb * 1024 ** 3)
+
+    def _get_base_images_in_use(self):
+        """Returns the fnames of the base images backing instance disks."""
+        in_use = set()
+        for name in os.listdir(FLAGS.instances_path):
+            instance_dir = os.path.join(FLAGS.instances_path, name)
+            if name == '_base' or not os.path.isdir(instance_dir):
+                continue
+            for disk_name in os.listdir(instance_dir):
+                if not disk_name.startswith('disk'):
+                    continue
+                info = images.qemu_img_info(os.path.join(instance_dir,
+                                                         disk_name))
+                # NOTE: newer qemu-img adds " (actual path: ...)"
+                backing_file = info.get('backing file', '').split(' (')[0]
+                if backing_file:
+                    in_use.add(os.path.basename(backing_file))
+        return in_use
 
     def _fetch_image(self, context, target, image_id, user_id, project_id,
                      size=None):
@@ -0,0 +1,127 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2011 Openstack, LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Base image cache for the libvirt driver.
+
+Base images are kept in instances_path/_base, one file per fname, and
+instance disks are copied from or backed by them.  A base image's mtime
+records when it was last used, so the least recently used ones can be
+evicted when the cache grows past base_image_cache_max_gb.
+
+Callers must hold utils.synchronized(fname) while fetching or using a
+base image, so that it is not evicted under them.
+"""
+
+import os
+
+from nova import flags
+from nova import log as logging
+from nova import utils
+
+
+LOG = logging.getLogger('nova.virt.libvirt.imagecache')
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('base_image_cache_max_gb', 0,
+                     'Size the base images not used by any instance are '
+                     'evicted down to, 0 means no limit')
+flags.DECLARE('instances_path', 'nova.compute.manager')
+
+# NOTE: left behind by images.fetch_to_raw while it is fetching
+_PARTIAL_SUFFIXES = ('.part', '.converted')
+
+
+def get_base_dir():
+    return os.path.join(FLAGS.instances_path, '_base')
+
+
+def get_base_path(fname):
+    """Returns the path of base image fname, creating the cache dir."""
+    base_dir = get_base_dir()
+    if not os.path.exists(base_dir):
+        os.mkdir(base_dir)
+    return os.path.join(base_dir, fname)
+
+
+def fetch(base, fn, *args, **kwargs):
+    """Calls fn to create base unless it is cached and marks it used."""
+    if not os.path.exists(base):
+        fn(target=base, *args, **kwargs)
+    os.utime(base, None)
+
+
+def list_cached_images():
+    """Returns (last used, fname, bytes on disk) for each base image."""
+    base_dir = get_base_dir()
+    if not os.path.exists(base_dir):
+        return []
+
+    cached = []
+    for fname in os.listdir(base_dir):
+        if fname.endswith(_PARTIAL_SUFFIXES):
+            continue
+        try:
+            stat = os.stat(os.path.join(base_dir, fname))
+        except OSError:
+            # NOTE: removed since we listed the directory
+            continue
+        cached.append((stat.st_mtime, fname, stat.st_blocks * 512))
+    return cached
+
+
+def evict(in_use, max_bytes):
+    """Removes least recently used base images until the cache fits in
+    max_bytes.  Base images whose fname is in in_use are kept.
+
+    Returns the fnames removed.
+
+    """
+    cached = list_cached_images()
+    total = sum(size for _mtime, _fname, size in cached)
+    removed = []
+    for mtime, fname, size in sorted(cached):
+        if total <= max_bytes:
+            break
+        if fname in in_use:
+            continue
+        if _remove_if_unused_since(fname, mtime):
+            total -= size
+            removed.append(fname)
+
+    if removed:
+        LOG.info(_("Evicted base images %(removed)s, %(total)d bytes of "
+                   "base images remain"), locals())
+    if total > max_bytes:
+        LOG.warn(_("Base images in use take %(total)d bytes, more than "
+                   "%(max_bytes)d"), locals())
+    return removed
+
+
+def _remove_if_unused_since(fname, mtime):
+    path = os.path.join(get_base_dir(), fname)
+
+    @utils.synchronized(fname)
+    def remove():
+        try:
+            if os.stat(path).st_mtime != mtime:
+                return False
+            os.unlink(path)
+        except OSError:
+            return False
+        return True
+
+    return remove()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2011 Openstack, LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Time creating a /16 flat network with all of its fixed ips, and carving
+num_networks vlan networks out of a /16 that already has networks in it.
+
+    tools/benchmark_create_networks.py [num_networks]
+
+Pass --sql_connection to run against a real database, a scratch sqlite
+database is used otherwise.
+"""
+
+import gettext
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# If ../nova/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir))
+if os.path.exists(os.path.join(POSSIBLE_TOPDIR, 'nova', '__init__.py')):
+    sys.path.insert(0, POSSIBLE_TOPDIR)
+
+gettext.install('nova', unicode=1)
+
+from nova import context
+from nova import db
+from nova import flags
+from nova.db import migration
+from nova.network import manager
+
+
+FLAGS = flags.FLAGS
+
+
+def _time(fn, *args, **kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return result, time.time() - start
+
+
+def main(num_networks=256):
+    scratch_dir = None
+    if not any(arg.startswith('--sql_connection') for arg in sys.argv):
+        scratch_dir = tempfile.mkdtemp()
+        sys.argv.append('--sql_connection=sqlite:///%s/nova.sqlite' %
+                        scratch_dir)
+    FLAGS(sys.argv[:1] + [arg for arg in sys.argv[1:]
+                          if arg.startswith('--')])
+
+    try:
+        migration.db_sync()
+        ctxt = context.get_admin_context()
+
+        flat_manager = manager.FlatManager(host='benchmark')
+        networks, elapsed = _time(flat_manager.create_networks, ctxt,
+                                  label='flat', cidr='10.0.0.0/16',
+                                  multi_host=False, num_networks=1,
+                                  network_size=65536, cidr_v6=None,
+                                  gateway=None, gateway_v6=None,
+                                  bridge='br100', bridge_interface=None)
+        print "flat: created a /16 with %d fixed ips in %.3f seconds" % (
+                len(db.fixed_ip_get_all(ctxt)), elapsed)
+
+        # NOTE: every other /24 is already taken, so the free ones
+        #       have to be searched for
+        vlan_manager = manager.VlanManager(host='benchmark')
+        for index in xrange(0, 256, 2):
+            db.network_create_safe(ctxt, {'cidr': '10.2.%d.0/24' % index})
+        networks, elapsed = _time(vlan_manager.create_networks, ctxt,
+                                  label='vlan', cidr='10.2.0.0/15',
+                                  multi_host=False,
+                                  num_networks=num_networks,
+                                  network_size=256, cidr_v6=None,
+                                  gateway=None, gateway_v6=None,
+                                  bridge=None, bridge_interface=None,
+                                  vlan_start=100, vpn_start=1000)
+        print ("vlan: created %d /24 networks and their fixed ips in %.3f "
+               "seconds" % (len(networks), elapsed))
+    finally:
+        if scratch_dir:
+            shutil.rmtree(scratch_dir)
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    main(*[int(arg) for arg in args[:1]])
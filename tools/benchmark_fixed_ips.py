@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2011 Openstack, LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Time concurrent fixed ip allocations from one network, locking the first
+free fixed ip and allocating optimistically, and count the fixed ips that
+were handed out twice.
+
+    tools/benchmark_fixed_ips.py [num_allocations] [num_threads]
+
+Pass --sql_connection to run against a real database, a scratch sqlite
+database is used otherwise.
+"""
+
+import gettext
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# If ../nova/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir))
+if os.path.exists(os.path.join(POSSIBLE_TOPDIR, 'nova', '__init__.py')):
+    sys.path.insert(0, POSSIBLE_TOPDIR)
+
+gettext.install('nova', unicode=1)
+
+from nova import context
+from nova import db
+from nova import exception
+from nova import flags
+from nova.db import migration
+
+
+FLAGS = flags.FLAGS
+
+
+def _create_network(ctxt, num_addresses):
+    network = db.network_create_safe(ctxt, {'host': 'benchmark'})
+    db.fixed_ip_bulk_create(ctxt, [
+            {'address': '10.%d.%d.%d' % (network['id'], i / 256, i % 256),
+             'network_id': network['id']}
+            for i in xrange(num_addresses)])
+    return network
+
+
+def _allocate(ctxt, network_id, instance_ids, num_threads):
+    """Allocates a fixed ip for each of instance_ids from num_threads
+    threads and returns the addresses and the seconds it took."""
+    addresses = []
+    failures = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not instance_ids:
+                    return
+                instance_id = instance_ids.pop()
+            try:
+                address = db.fixed_ip_associate_pool(ctxt, network_id,
+                                                     instance_id)
+            except exception.Error as e:
+                with lock:
+                    failures.append(e)
+                continue
+            with lock:
+                addresses.append(address)
+
+    threads = [threading.Thread(target=worker) for i in xrange(num_threads)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return addresses, failures, time.time() - start
+
+
+def main(num_allocations=500, num_threads=16):
+    scratch_dir = None
+    if not any(arg.startswith('--sql_connection') for arg in sys.argv):
+        scratch_dir = tempfile.mkdtemp()
+        sys.argv.append('--sql_connection=sqlite:///%s/nova.sqlite' %
+                        scratch_dir)
+    FLAGS(sys.argv[:1] + [arg for arg in sys.argv[1:]
+                          if arg.startswith('--')])
+
+    try:
+        migration.db_sync()
+        ctxt = context.get_admin_context()
+        instances = [db.instance_create(ctxt, {})['id']
+                     for i in xrange(num_allocations)]
+
+        for optimistic in (False, True):
+            FLAGS.fixed_ip_allocate_optimistically = optimistic
+            network = _create_network(ctxt, num_allocations * 2)
+            addresses, failures, elapsed = _allocate(ctxt, network['id'],
+                                                     list(instances),
+                                                     num_threads)
+            print ("%s: %d allocations from %d threads in %.3f seconds "
+                   "(%.1f/s), %d failed, %d handed out twice" % (
+                       optimistic and 'optimistic' or 'locking',
+                       len(addresses), num_threads, elapsed,
+                       len(addresses) / elapsed, len(failures),
+                       len(addresses) - len(set(addresses))))
+    finally:
+        if scratch_dir:
+            shutil.rmtree(scratch_dir)
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    main(*[int(arg) for arg in args[:2]])
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2011 Openstack, LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Time how long the DistributedScheduler takes to place a multi-instance
+request on a large zone, without a database or child zones.
+
+    tools/benchmark_scheduler.py [num_hosts] [num_instances]
+"""
+
+import gettext
+import os
+import random
+import sys
+import time
+
+# If ../nova/__init__.py exists, add ../ to Python search path, so that
+# it will override what happens to be installed in /usr/(local/)lib/python...
+POSSIBLE_TOPDIR = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir))
+if os.path.exists(os.path.join(POSSIBLE_TOPDIR, 'nova', '__init__.py')):
+    sys.path.insert(0, POSSIBLE_TOPDIR)
+
+gettext.install('nova', unicode=1)
+
+from nova import context
+from nova import flags
+from nova.scheduler import distributed_scheduler
+from nova.scheduler import zone_manager
+
+
+FLAGS = flags.FLAGS
+
+
+class BenchmarkZoneManager(zone_manager.ZoneManager):
+    """ZoneManager reporting num_hosts randomly loaded compute hosts."""
+    def __init__(self, num_hosts):
+        super(BenchmarkZoneManager, self).__init__()
+        self.num_hosts = num_hosts
+
+    def _compute_node_get_all_with_usage(self, context):
+        return [dict(host='host%05d' % i,
+                     free_ram_mb=random.randint(0, 64) * 1024,
+                     free_disk_gb=random.randint(0, 64) * 40,
+                     free_vcpus=random.randint(0, 16))
+                for i in xrange(self.num_hosts)]
+
+
+class BenchmarkScheduler(distributed_scheduler.DistributedScheduler):
+    """DistributedScheduler without child zones."""
+    def _zone_get_all(self, context):
+        return []
+
+    def _call_zone_method(self, context, method, specs, zones):
+        return []
+
+
+def main(num_hosts=10000, num_instances=1000):
+    FLAGS(sys.argv[:1])
+    random.seed(0)
+    sched = BenchmarkScheduler()
+    sched.set_zone_manager(BenchmarkZoneManager(num_hosts))
+    ctxt = context.get_admin_context()
+    request_spec = dict(num_instances=num_instances,
+                        instance_type=dict(memory_mb=2048, local_gb=40))
+
+    # Seed the host resource table outside of the measurement, the same
+    # as a running scheduler would have.
+    sched.zone_manager.get_all_host_data(ctxt)
+
+    start = time.time()
+    weighted_hosts = sched._schedule(ctxt, 'compute', request_spec)
+    elapsed = time.time() - start
+    print "Placed %d instances on %d hosts in %.3f seconds" % (
+            len(weighted_hosts), num_hosts, elapsed)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])